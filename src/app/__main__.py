@@ -1,7 +1,10 @@
 """Entry CLI module for Sales System"""
 
+import os
+import sys
 import click
-from app.core import create_app
+from app.core import create_app, export
+from app.core.menu import WriteMenuFile
 
 app = create_app('app.settings')
 
@@ -16,8 +19,102 @@ def createdb():
   app.system.InitializeDb()
 
 
+@main.command()
+def migrate():
+  """Upgrade the database schema to the latest version"""
+  applied = app.system.Migrate()
+  click.echo("Applied migrations %s" % (applied or "none"))
+
+
+@main.command()
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--replace', is_flag=True, help="Delete the current menu first")
+def loadmenu(path, replace):
+  """Load a JSON or YAML menu definition into the database"""
+  try:
+    app.system.LoadMenu(path, replace=replace)
+  except ValueError as e:
+    raise click.ClickException(str(e))
+  click.echo("Loaded menu %s" % path)
+
+
+@main.command()
+@click.argument('path', required=False)
+def exportmenu(path):
+  """Write the menu in the database as JSON, or YAML for .yaml files"""
+  menu = app.system.ExportMenu()
+  if path is None:
+    WriteMenuFile(menu, sys.stdout)
+    return
+  with open(path, 'w', encoding='utf-8') as f:
+    WriteMenuFile(menu, f, yaml_format=path.endswith(('.yaml', '.yml')))
+
+
+@main.command()
+@click.option(
+    '--format', 'fmt', type=click.Choice(export.FORMATS), default='csv')
+@click.option('--start', help="First day of creation, YYYY-MM-DD")
+@click.option('--end', help="Day after the last one, YYYY-MM-DD")
+@click.option('--status', help="Only orders with this status, e.g. paid")
+@click.option('--output', '-o', type=click.File('w', lazy=False), default='-')
+def exportorders(fmt, start, end, status, output):  # pylint: disable=too-many-arguments
+  """Stream orders with their item lines for accounting"""
+  try:
+    start, end = export.ParseDate(start), export.ParseDate(end)
+    status = export.ParseStatus(status)
+  except ValueError as e:
+    raise click.BadParameter(str(e))
+  with app.app_context():
+    for chunk in export.ExportOrders(fmt, start, end, status):
+      output.write(chunk)
+
+
+@main.command()
+def rebuildrollups():
+  """Recompute the sales rollups from all paid orders"""
+  click.echo("Recorded %d orders" % app.system.RebuildRollups())
+
+
+@main.command()
+def foldrollups():
+  """Add sales of recently paid orders to the sales rollups"""
+  click.echo("Folded %d orders" % app.system.FoldRollups())
+
+
+@main.command()
+def backfillorderlines():
+  """Write the order lines of orders paid before they existed"""
+  click.echo("Wrote lines of %d orders" % app.system.BackfillOrderLines())
+
+
+@main.command()
+@click.option('--checkouts', default=200, help="Total connection checkouts")
+@click.option('--threads', default=8, help="Concurrent threads")
+@click.option(
+    '--hold', default=0.01, help="Seconds each connection is kept out")
+def diagnosepool(checkouts, threads, hold):
+  """Report connection pool checkout times under concurrent use"""
+  report = app.system.DiagnosePool(checkouts, threads, hold)
+  click.echo("Engine options: %s" % (report["options"] or "defaults"))
+  click.echo("%s: %s" % (report["pool"], report["status"]))
+  click.echo("%d checkouts, %d failed" % (report["checkouts"],
+                                          report["errors"]))
+  for name, millis in report["checkout_ms"].items():
+    click.echo("  %-4s %10.3fms" % (name, millis))
+
+
+@main.command()
+def sweepreservations():
+  """Release stock held by abandoned orders"""
+  click.echo("Released %d orders" % app.system.SweepReservations())
+
+
 @main.command()
 def run():
+  # in debug mode the reloader runs the server in a child process, which
+  # alone sweeps
+  if not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+    app.system.StartReservationSweeper()
   app.run(host='0.0.0.0', port=8000)
 
 
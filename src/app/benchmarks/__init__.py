@@ -0,0 +1,19 @@
+"""Benchmarks for the sales system
+
+Each module can be run on its own from src/, e.g.
+
+  python -m app.benchmarks.codec
+"""
+
+import timeit
+
+
+def BestOf(func, repeat=5, number=None):
+  """Return the best per-call time of func in seconds
+
+  If number is None, it is picked so that each repeat takes about 0.2s.
+  """
+  timer = timeit.Timer(func)
+  if number is None:
+    number, _ = timer.autorange()
+  return min(timer.repeat(repeat=repeat, number=number)) / number
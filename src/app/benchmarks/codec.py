@@ -0,0 +1,55 @@
+"""Benchmark encoding and decoding of Order.content
+
+Compares the legacy nested-dict JSON format (v1) against the current flat
+node table (v4) at 10, 100 and 1000 nodes.
+"""
+
+import json
+from app.core.models.order import ItemNode, IGNode, EncodeContent, \
+    DecodeContent
+from . import BestOf
+
+SIZES = (10, 100, 1000)
+
+
+def BuildTree(size):
+  """Build a list of root items of a burger-like shape with ~size nodes"""
+  roots = []
+  count = 0
+  while count < size:
+    root = ItemNode(1, "Main", 1, 0)
+    group = IGNode(1, "Main Type")
+    group.fulfilled = True
+    burger = ItemNode(2, "Customizable Burger", 1, 999)
+    for ig_id, name in ((2, "Bun"), (3, "Patties"), (4, "Other Ingredients")):
+      sub = IGNode(ig_id, name)
+      sub.fulfilled = True
+      sub.AddChild(ItemNode(10 + ig_id, name + " option", 2, 198))
+      burger.AddChild(sub)
+    group.AddChild(burger)
+    root.AddChild(group)
+    roots.append(root)
+    count += 9
+  return roots
+
+
+def main():
+  print("%6s %12s %12s %12s %12s %9s" % ("nodes", "v1 encode", "v1 decode",
+                                         "v4 encode", "v4 decode", "v4 size"))
+  for size in SIZES:
+    roots = BuildTree(size)
+    legacy = json.dumps([root.ToDict() for root in roots])
+    compact = EncodeContent(roots)
+    timings = (
+        BestOf(lambda roots=roots: json.dumps([r.ToDict() for r in roots])),
+        BestOf(lambda legacy=legacy: DecodeContent(legacy)),
+        BestOf(lambda roots=roots: EncodeContent(roots)),
+        BestOf(lambda compact=compact: DecodeContent(compact)),
+    )
+    print("%6d %10.1fus %10.1fus %10.1fus %10.1fus %8d%%" %
+          ((size,) + tuple(t * 1e6 for t in timings) +
+           (len(compact) * 100 // len(legacy),)))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,181 @@
+"""Load test of the customer ordering flow
+
+Simulates concurrent customers, each one signing up, then for every order
+opening /order, filling in the menu with repeated POSTs to
+/order/<oid>/menu and paying at /order/<oid>/checkout. Requests go through
+the WSGI app in-process, one thread per customer, against a database given
+by --database (a temporary SQLite file by default, or e.g. a local MySQL
+URI). Reports requests/sec, latency percentiles and database queries per
+request for each route.
+
+  python -m app.benchmarks.loadtest --customers 8 --orders 5
+"""
+
+import argparse
+from collections import defaultdict
+import os
+import re
+import tempfile
+import threading
+import time
+from sqlalchemy import event
+from app.core import create_app
+from app.core.models.catalog import GetCatalog
+from app.core.models.inventory import Stock
+from app.core.models.order import Order
+from app.core.models import db
+
+PATH_RE = re.compile(rb'/order/(\d+)/')
+
+
+class Recorder:
+  """Collect latency and query counts of requests, keyed by route"""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.latencies = defaultdict(list)
+    self.queries = defaultdict(int)
+    self.errors = defaultdict(int)
+    self.local = threading.local()
+
+  def CountQuery(self, *args):  # pylint: disable=unused-argument
+    route = getattr(self.local, 'route', None)
+    if route is not None:
+      self.local.queries += 1
+
+  def Request(self, route, func, *args, **kwargs):
+    """Run func as a request to route and record it"""
+    self.local.route = route
+    self.local.queries = 0
+    start = time.perf_counter()
+    try:
+      response = func(*args, **kwargs)
+    finally:
+      elapsed = time.perf_counter() - start
+      self.local.route = None
+    with self.lock:
+      self.latencies[route].append(elapsed)
+      self.queries[route] += self.local.queries
+      if response.status_code >= 400 or b'burger-alert-error' in response.data:
+        self.errors[route] += 1
+    return response
+
+  def Report(self, wall_time):
+    print("%-24s %7s %6s %8s %8s %8s %8s %8s" %
+          ("route", "count", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms",
+           "queries"))
+    for route, latencies in self.latencies.items():
+      latencies.sort()
+      print("%-24s %7d %6d %8.1f %8.2f %8.2f %8.2f %8.1f" %
+            (route, len(latencies), self.errors[route],
+             len(latencies) / wall_time, Percentile(latencies, 50) * 1e3,
+             Percentile(latencies, 95) * 1e3, Percentile(latencies, 99) *
+             1e3, self.queries[route] / len(latencies)))
+
+
+def Percentile(ordered, percent):
+  return ordered[int(round(percent / 100 * (len(ordered) - 1)))]
+
+
+def NextChoice(app, oid, turn):
+  """Return the form filling in the next ingredient group of an order
+
+  None if the order is complete. Options are picked in turn so that runs
+  cover every branch of the menu.
+  """
+  with app.app_context():
+    igdetails = Order.query.get(oid).GetUnfulfilledIGDetails()
+    if igdetails is None:
+      return None
+    group = GetCatalog().GetGroup(igdetails['id'])
+  noptions = min(max(group.GetMinOption() or 0, 1), len(group.options))
+  start = turn % len(group.options)
+  options = (group.options[start:] + group.options[:start])[:noptions]
+  numbers = [1] * noptions
+  numbers[0] += max((group.GetMinItem() or 0) - noptions, 0)
+  return {
+      "path": igdetails['path'],
+      "items": [str(item.GetID()) for item in options],
+      "numbers": [str(number) for number in numbers],
+  }
+
+
+def Customer(app, recorder, number, orders):
+  """Sign up and place orders"""
+  client = app.test_client()
+  recorder.Request(
+      "signup",
+      client.post,
+      "/accounts/signup",
+      data={
+          "name": "customer%d" % number,
+          "email": "customer%d@example.com" % number,
+          "password": "password",
+      })
+  with app.app_context():
+    roots = [str(item.GetID()) for item in GetCatalog().GetRootItems()]
+  for turn in range(orders):
+    response = recorder.Request("/order", client.get, "/order")
+    oid = PATH_RE.search(response.headers['Location'].encode()).group(1)
+    oid = int(oid)
+    recorder.Request("/order/<oid>/menu GET", client.get,
+                     "/order/%d/menu" % oid)
+    form = {"path": "root", "items": roots, "numbers": ["1"] * len(roots)}
+    step = 0
+    while form is not None:
+      recorder.Request(
+          "/order/<oid>/menu POST",
+          client.post,
+          "/order/%d/menu" % oid,
+          data=form)
+      step += 1
+      form = NextChoice(app, oid, number + turn + step)
+      if step > 100:
+        break
+    recorder.Request("/order/<oid>/checkout", client.post,
+                     "/order/%d/checkout" % oid)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument("--customers", type=int, default=8)
+  parser.add_argument("--orders", type=int, default=5, help="per customer")
+  parser.add_argument(
+      "--database", help="SQLAlchemy URI, a temporary SQLite file if omitted")
+  args = parser.parse_args()
+
+  path = None
+  if args.database is None:
+    fd, path = tempfile.mkstemp(suffix=".sql")
+    os.close(fd)
+    args.database = "sqlite:///" + path
+  app = create_app('app.tests.settings',
+                   TESTING=False,
+                   SQLALCHEMY_DATABASE_URI=args.database)
+  app.system.InitializeDb()
+  recorder = Recorder()
+  with app.app_context():
+    # enough stock that no order is refused
+    Stock.query.update({Stock.amount: 10**9})
+    db.session.commit()
+    event.listen(db.engine, "before_cursor_execute", recorder.CountQuery)
+
+  try:
+    threads = [
+        threading.Thread(
+            target=Customer, args=(app, recorder, number, args.orders))
+        for number in range(args.customers)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    recorder.Report(time.perf_counter() - start)
+  finally:
+    if path is not None:
+      os.remove(path)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,72 @@
+"""Benchmark the admin order list query at 100k paid orders
+
+Compares loading every paid order and its user one by one (the previous
+behaviour of the page) against a keyset page, both first and deep.
+"""
+
+from datetime import datetime, timedelta
+from app.core import create_app
+from app.core.models.order import Order, OrderStatus
+from app.core.models.user import User
+from app.core.models import db
+from . import BestOf
+
+ORDERS = 100000
+USERS = 1000
+PAGE_SIZE = 50
+
+
+def Populate():
+  """Insert USERS users and ORDERS orders, 90% of them paid"""
+  db.session.execute(User.__table__.insert(), [{
+      "id": uid,
+      "name": "user%d" % uid,
+      "email": "user%d@example.com" % uid,
+  } for uid in range(1, USERS + 1)])
+  start = datetime(2020, 1, 1)
+  db.session.execute(Order.__table__.insert(), [{
+      "id": oid,
+      "user_id": oid % USERS + 1,
+      "status": "CREATED" if oid % 10 == 0 else "PAID",
+      "price_cents": oid % 5000,
+      "updated_at": start + timedelta(seconds=oid),
+      "content": "[]",
+  } for oid in range(1, ORDERS + 1)])
+  db.session.commit()
+
+
+def LoadAll():
+  orders = Order.query.filter(Order.status == OrderStatus.PAID).order_by(
+      Order.updated_at.desc()).all()
+  return [order.user.name for order in orders]
+
+
+def LoadPage(after=None):
+  orders, after = Order.GetPage(OrderStatus.PAID, PAGE_SIZE, after)
+  return [order.user.name for order in orders], after
+
+
+def main():
+  app = create_app('app.tests.settings')
+  with app.app_context():
+    db.create_all()
+    Populate()
+    _, after = LoadPage()
+    for _ in range(ORDERS // PAGE_SIZE // 2):
+      _, after = Order.GetPage(OrderStatus.PAID, PAGE_SIZE, after)
+
+    def Run(func):
+      db.session.expunge_all()
+      func()
+
+    print("%-28s %10s" % ("query", "time"))
+    for name, func in (("all orders, lazy users", LoadAll),
+                       ("first page", LoadPage),
+                       ("page %d" % (ORDERS // PAGE_SIZE // 2),
+                        lambda: LoadPage(after))):
+      millis = BestOf(lambda func=func: Run(func), repeat=3) * 1e3
+      print("%-28s %8.2fms" % (name, millis))
+
+
+if __name__ == '__main__':
+  main()
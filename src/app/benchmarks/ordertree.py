@@ -0,0 +1,200 @@
+"""Microbenchmarks of the order tree
+
+Times the node operations behind the menu and checkout pages on synthetic
+menus larger than the seed data. A menu of a given depth has depth levels
+of ingredient groups below one root item; every item above the last level
+has `groups` groups, each offering `width` items of the next level, and
+every other item is non-identical so it fans out into one node per unit.
+Orders choose every option `units` times.
+
+  python -m app.benchmarks.ordertree              # print timings
+  python -m app.benchmarks.ordertree --save       # update the baseline
+  python -m app.benchmarks.ordertree --compare    # print ratios to it
+
+Baselines are stored as JSON in app/benchmarks/baselines/.
+"""
+
+import argparse
+import json
+import os
+import tracemalloc
+from app.core import create_app
+from app.core.models.catalog import GetCatalog
+from app.core.models.inventory import Item, IngredientGroup, Stock, \
+    item_ig, ig_item
+from app.core.models.order import ItemNode, IGNode
+from app.core.models import db
+from . import BestOf
+
+# (depth, width, groups, units)
+SHAPES = ((1, 4, 2, 2), (2, 4, 2, 2), (3, 4, 2, 2), (2, 8, 3, 2))
+BASELINE = os.path.join(
+    os.path.dirname(__file__), "baselines", "ordertree.json")
+
+
+def ShapeName(shape):
+  return "depth=%d,width=%d,groups=%d,units=%d" % shape
+
+
+def Populate(depth, width, groups):
+  """Insert a synthetic menu and return the id of its root item
+
+  Items of a level are shared by all groups of the level above, so the
+  catalog stays small while the order tree grows exponentially with depth.
+  """
+  item_rows = [{
+      "id": 1,
+      "root": True,
+      "name": "Root",
+      "price_cents": 500,
+      "identical": True
+  }]
+  stock_rows = []
+  group_rows = []
+  item_ig_rows = []
+  ig_item_rows = []
+  parents = [1]
+  for level in range(depth):
+    level_groups = []
+    for index in range(groups):
+      ig_id = len(group_rows) + 1
+      group_rows.append({"id": ig_id, "name": "Group %d.%d" % (level, index)})
+      level_groups.append(ig_id)
+    for item_id in parents:
+      for ig_id in level_groups:
+        item_ig_rows.append({"item_id": item_id, "ig_id": ig_id})
+    parents = []
+    for index in range(width):
+      item_id = len(item_rows) + 1
+      stock_id = len(stock_rows) + 1
+      stock_rows.append({
+          "id": stock_id,
+          "name": "Stock %d" % stock_id,
+          "amount": 10**15
+      })
+      item_rows.append({
+          "id": item_id,
+          "root": False,
+          "name": "Item %d.%d" % (level, index),
+          "price_cents": 99,
+          "stock_id": stock_id,
+          "stock_unit": 1,
+          "identical": index % 2 == 0,
+      })
+      parents.append(item_id)
+      for ig_id in level_groups:
+        ig_item_rows.append({"item_id": item_id, "ig_id": ig_id})
+  db.session.execute(Stock.__table__.insert(), stock_rows)
+  db.session.execute(Item.__table__.insert(), item_rows)
+  db.session.execute(IngredientGroup.__table__.insert(), group_rows)
+  db.session.execute(item_ig.insert(), item_ig_rows)
+  db.session.execute(ig_item.insert(), ig_item_rows)
+  db.session.commit()
+  return 1
+
+
+def Fill(node, units, stocks):
+  """Choose every option units times in all groups below an item node"""
+  for group in node.children:
+    options = [option.GetID() for option in GetCatalog().GetGroup(
+        group.GetID()).options]
+    group.SetItems(options, [units] * len(options), stocks=stocks)
+    for child in group.children:
+      Fill(child, units, stocks)
+
+
+def TreeSize(plain):
+  """Return the memory in KiB taken by a tree decoded from plain"""
+  tracemalloc.start()
+  try:
+    tree = ItemNode.FromDict(plain)
+    size = tracemalloc.get_traced_memory()[0]
+  finally:
+    tracemalloc.stop()
+  del tree
+  return size / 1024
+
+
+def Measure(shape):
+  """Return the node count, tree size and best per-call times in us"""
+  depth, width, groups, units = shape
+  app = create_app('app.tests.settings')
+  with app.app_context():
+    db.create_all()
+    root_id = Populate(depth, width, groups)
+    catalog = GetCatalog()
+    root = catalog.GetItem(root_id)
+    stocks = Stock.LoadMany(range(1, width * depth + 1))
+    tree = ItemNode.FromItem(root, 1)
+    Fill(tree, units, stocks)
+    plain = tree.ToDict()
+    first_group = root.ingredientgroups[0]
+    first_options = [option.GetID() for option in first_group.options]
+
+    def SetItems():
+      IGNode.FromIG(first_group).SetItems(
+          first_options, [units] * len(first_options), stocks=stocks)
+
+    timings = {
+        "FromItem": BestOf(lambda: ItemNode.FromItem(root, 1)),
+        "SetItems": BestOf(SetItems),
+        "ToDict": BestOf(tree.ToDict),
+        "FromDict": BestOf(lambda: ItemNode.FromDict(plain)),
+        "GetDetailsString": BestOf(tree.GetDetailsString),
+        "GetUnfulfilledIGDetails": BestOf(
+            lambda: tree.GetUnfulfilledIGDetails("0", tree.name)),
+        "DeductStock": BestOf(
+            lambda: tree.DeductStock(stocks=stocks, catalog=catalog)),
+    }
+    result = {
+        "nodes": sum(1 for _ in tree.Walk()),
+        "tree_kib": round(TreeSize(plain), 1),
+    }
+    result.update((name, round(seconds * 1e6, 2))
+                  for name, seconds in timings.items())
+    db.session.remove()
+    db.drop_all()
+  return result
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument(
+      "--shape",
+      nargs=4,
+      type=int,
+      action="append",
+      metavar=("DEPTH", "WIDTH", "GROUPS", "UNITS"),
+      help="menu shape to run, may be repeated")
+  parser.add_argument(
+      "--save", action="store_true", help="write results as the baseline")
+  parser.add_argument(
+      "--compare", action="store_true", help="print ratios to the baseline")
+  args = parser.parse_args()
+
+  baseline = {}
+  if args.compare:
+    with open(BASELINE, encoding="utf-8") as f:
+      baseline = json.load(f)
+  results = {}
+  for shape in map(tuple, args.shape or SHAPES):
+    name = ShapeName(shape)
+    results[name] = result = Measure(shape)
+    print("%s, %d nodes" % (name, result["nodes"]))
+    print("  %-24s %12.1fKiB" % ("tree size", result["tree_kib"]))
+    for bench, micros in result.items():
+      if bench in ("nodes", "tree_kib"):
+        continue
+      line = "  %-24s %12.1fus" % (bench, micros)
+      if bench in baseline.get(name, {}):
+        line += " %6.2fx" % (micros / baseline[name][bench])
+      print(line)
+  if args.save:
+    os.makedirs(os.path.dirname(BASELINE), exist_ok=True)
+    with open(BASELINE, "w", encoding="utf-8") as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+      f.write("\n")
+
+
+if __name__ == '__main__':
+  main()
@@ -3,26 +3,35 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from app.core.system import SalesSystem
+from app.core import instrumentation, metrics
 
 
-def create_app(config_filename):
+def create_app(config_filename, **overrides):
   """Create flask app
 
-  Create flask app based on given configuration
+  Create flask app based on given configuration. Background work such as
+  the reservation sweeper is left to the server, see
+  SalesSystem.StartReservationSweeper.
 
   Arguments:
     config_filename: String, path to config file
+    overrides: settings replacing those of the config file
   """
   app = Flask(__name__)
   app.config.from_object(config_filename)
+  app.config.update(overrides)
   app.system = SalesSystem(app)
+  instrumentation.Install(app)
+  metrics.Install(app)
   # app.system.InitializeDb()
 
   from app.core.accounts import bp as accounts_bp
+  from app.core.api import bp as api_bp
   from app.core.admin import bp as admin_bp
   from app.core.customer import bp as customer_bp
 
   app.register_blueprint(accounts_bp)
+  app.register_blueprint(api_bp)
   app.register_blueprint(admin_bp)
   app.register_blueprint(customer_bp)
 
@@ -1,12 +1,26 @@
 """Admin blueprint views"""
 
-from flask import render_template, session, redirect, request, flash
+from datetime import datetime, timedelta
+import hmac
+import json
+from flask import render_template, session, redirect, request, flash, \
+    current_app, Response, jsonify, stream_with_context
+from app.core import export, metrics
+from app.core.models.catalog import GetCatalog
 from app.core.models.order import Order, OrderStatus
+from app.core.models.rollup import Bucket, GetSales, GetTopItems, \
+    GetTotalSales, GetUnfolded
 from app.core.models.user import User, UserType
 from app.core.models.inventory import Stock
+from app.core.models.money import FormatCents
 from app.core.models import db
 from . import bp as app  # Note that app = blueprint, current_app = flask context
 
+ORDER_PAGE_SIZE = 50
+MAX_ORDER_PAGE_SIZE = 500
+DASHBOARD_DAYS = 7
+MAX_DASHBOARD_DAYS = 366
+
 
 @app.route("/")
 def Home():
@@ -50,9 +64,168 @@ def OrderList():
   if user.GetType() == UserType.CUSTOMER:
     flash("Access denied", "error")
     return redirect("/")
-  orders = Order.query.filter(Order.status == OrderStatus.PAID).order_by(
-      Order.updated_at.desc()).all()
-  return render_template("admin/orderlist.html", orders=orders)
+  page_size = min(
+      max(request.args.get('size', ORDER_PAGE_SIZE, type=int), 1),
+      MAX_ORDER_PAGE_SIZE)
+  try:
+    orders, after = Order.GetPage(OrderStatus.PAID, page_size,
+                                  request.args.get('after'))
+  except ValueError:
+    flash("Invalid page", "error")
+    return redirect("/admin/orderlist")
+  # read from the daily rollups, a handful of rows however many orders
+  _, total = GetTotalSales()
+  return render_template(
+      "admin/orderlist.html",
+      orders=orders,
+      after=after,
+      page_size=page_size,
+      total=FormatCents(total))
+
+
+@app.route("/dashboard")
+def Dashboard():
+  """Show sales of the last ?days days, read from the sales rollups
+
+  Rollups are folded by the sweeper or the foldrollups command, the page
+  shows how many paid orders they don't count yet.
+  """
+  if 'uid' not in session:
+    flash("Please sign in first", "error")
+    return redirect("/accounts/signin")
+  user = User.query.get(session['uid'])
+  if user.GetType() == UserType.CUSTOMER:
+    flash("Access denied", "error")
+    return redirect("/")
+  days = min(
+      max(request.args.get('days', DASHBOARD_DAYS, type=int), 1),
+      MAX_DASHBOARD_DAYS)
+  unfolded, unfolded_since = GetUnfolded()
+  today = Bucket("day", datetime.now())
+  start, end = today - timedelta(days=days - 1), today + timedelta(days=1)
+  daily = GetSales("day", start, end)
+  orders = sum(row.orders for row in daily)
+  revenue = sum(row.revenue_cents for row in daily)
+  catalog = GetCatalog()
+  top_items = []
+  for item_id, quantity, item_revenue in GetTopItems(start, end):
+    item = catalog.GetItem(item_id)
+    top_items.append((item.GetName() if item else "#%d" % item_id, quantity,
+                      FormatCents(item_revenue)))
+  return render_template(
+      "admin/dashboard.html",
+      days=days,
+      orders=orders,
+      revenue=FormatCents(revenue),
+      average=FormatCents(revenue // orders if orders else 0),
+      daily=daily,
+      hourly=GetSales("hour", today, end),
+      top_items=top_items,
+      unfolded=unfolded,
+      unfolded_since=unfolded_since,
+      FormatCents=FormatCents)
+
+
+@app.route("/export")
+def ExportOrders():
+  """Download orders as CSV or NDJSON
+
+  Takes ?format=csv|ndjson, a date range of creation ?start=YYYY-MM-DD and
+  ?end=YYYY-MM-DD (exclusive), and ?status=created|paid|ready.
+  """
+  if 'uid' not in session:
+    flash("Please sign in first", "error")
+    return redirect("/accounts/signin")
+  user = User.query.get(session['uid'])
+  if user.GetType() == UserType.CUSTOMER:
+    flash("Access denied", "error")
+    return redirect("/")
+  fmt = request.args.get('format', 'csv')
+  try:
+    chunks = export.ExportOrders(
+        fmt,
+        start=export.ParseDate(request.args.get('start')),
+        end=export.ParseDate(request.args.get('end')),
+        status=export.ParseStatus(request.args.get('status')))
+  except ValueError as e:
+    flash(str(e), "error")
+    return redirect("/admin/orderlist")
+  return Response(
+      stream_with_context(chunks),
+      mimetype=export.MIMETYPES[fmt],
+      headers={
+          "Content-Disposition": "attachment; filename=orders.%s" % fmt,
+          "X-Accel-Buffering": "no"
+      })
+
+
+@app.route("/orderfeed")
+def OrderFeed():
+  """Stream order changes as server-sent events"""
+  if 'uid' not in session:
+    flash("Please sign in first", "error")
+    return redirect("/accounts/signin")
+  user = User.query.get(session['uid'])
+  if user.GetType() == UserType.CUSTOMER:
+    flash("Access denied", "error")
+    return redirect("/")
+  hub = current_app.system.hub
+  keepalive = current_app.config.get('ORDER_FEED_KEEPALIVE', 15)
+  # don't hold a database connection for the lifetime of the stream
+  db.session.remove()
+
+  def Stream():
+    with hub.Subscribe("orders") as subscription:
+      yield "retry: 3000\n\n"
+      while True:
+        message = subscription.Get(keepalive)
+        if message is None:
+          yield ": keepalive\n\n"
+        else:
+          yield "event: order\ndata: %s\n\n" % json.dumps(message)
+
+  return Response(
+      Stream(),
+      mimetype="text/event-stream",
+      headers={
+          "Cache-Control": "no-cache",
+          "X-Accel-Buffering": "no"
+      })
+
+
+@app.route("/querystats")
+def QueryStats():
+  """Show per endpoint query counts and timings as JSON"""
+  if 'uid' not in session:
+    flash("Please sign in first", "error")
+    return redirect("/accounts/signin")
+  user = User.query.get(session['uid'])
+  if user.GetType() == UserType.CUSTOMER:
+    flash("Access denied", "error")
+    return redirect("/")
+  return jsonify(
+      enabled=bool(current_app.config.get('SQL_INSTRUMENTATION')),
+      endpoints=current_app.request_stats.ToDict())
+
+
+@app.route("/metrics")
+def Metrics():
+  """Export metrics in the Prometheus text format
+
+  Scrapers authenticate with the METRICS_TOKEN setting as a bearer token.
+  """
+  token = current_app.config.get('METRICS_TOKEN')
+  if not token or not hmac.compare_digest(
+      request.headers.get('Authorization', ''), "Bearer %s" % token):
+    if 'uid' not in session:
+      flash("Please sign in first", "error")
+      return redirect("/accounts/signin")
+    user = User.query.get(session['uid'])
+    if user.GetType() == UserType.CUSTOMER:
+      flash("Access denied", "error")
+      return redirect("/")
+  return Response(
+      metrics.Expose(), content_type="text/plain; version=0.0.4")
 
 
 @app.route("/order/<oid>/done")
@@ -68,6 +241,7 @@ def MarkOrder(oid):
   order = Order.query.get(oid)
   order.SetStatus(OrderStatus.READY)
   db.session.commit()
+  current_app.system.PublishOrder(order)
   return redirect("/order/%d" % order.GetID())
 
 
@@ -0,0 +1,7 @@
+"""JSON API Blueprint"""
+
+from flask import Blueprint
+
+bp = Blueprint("api", __name__, url_prefix="/api")
+
+from . import views  #pylint: disable=wrong-import-position
@@ -0,0 +1,190 @@
+"""JSON API blueprint views
+
+Every action of the ordering flow is a single request answered with the
+resulting order state, so clients need no redirects. Users sign in through
+/accounts/signin as for the HTML views.
+"""
+
+from flask import request, session, jsonify, current_app
+from app.core.metrics import ORDERS_CREATED
+from app.core.models.catalog import GetCatalog
+from app.core.models.inventory import Stock
+from app.core.models.order import Order, OrderStatus
+from app.core.models import db
+from . import bp as app  # Note that app = blueprint, current_app = flask context
+
+
+class ApiError(Exception):
+  """Error answered as {"error": message} with an HTTP status"""
+
+  def __init__(self, message, status=400):
+    super().__init__(message)
+    self.status = status
+
+
+@app.errorhandler(ApiError)
+def HandleApiError(e):
+  db.session.rollback()
+  return jsonify(error=str(e)), e.status
+
+
+def ItemToJSON(item, stocks):
+  return {
+      "id": item.GetID(),
+      "name": item.GetName(),
+      "price_cents": item.GetPriceCents(),
+      "image": item.GetImage(),
+      "available": item.HasEnoughStock(1, stocks),
+      "groups": [ig.GetID() for ig in item.ingredientgroups],
+  }
+
+
+def GroupToJSON(ig, stocks):
+  return {
+      "id": ig.GetID(),
+      "name": ig.GetName(),
+      "min_item": ig.GetMinItem(),
+      "max_item": ig.GetMaxItem(),
+      "min_option": ig.GetMinOption(),
+      "max_option": ig.GetMaxOption(),
+      "options": [ItemToJSON(item, stocks) for item in ig.options],
+  }
+
+
+def OrderToJSON(order):
+  """Return the state of an order with the choices of its next step"""
+  ret = {
+      "id": order.GetID(),
+      "status": order.GetStatusText(),
+      "price_cents": order.GetPriceCents(),
+      "items": [node.ToDict() for node in order.GetTree()],
+      "next": None,
+  }
+  igdetails = order.GetUnfulfilledIGDetails()
+  if igdetails is not None:
+    catalog = GetCatalog()
+    ig = catalog.GetGroup(igdetails['id'])
+    stocks = Stock.LoadMany(catalog.GetStockIDs(x.id for x in ig.options))
+    ret["next"] = dict(
+        GroupToJSON(ig, stocks),
+        path=igdetails['path'],
+        item_name=igdetails['item_name'])
+  return ret
+
+
+def GetUserOrder(oid):
+  if 'uid' not in session:
+    raise ApiError("Please sign in first", 401)
+  order = Order.query.get(oid)
+  if order is None or order.GetUserID() != session['uid']:
+    raise ApiError("Wrong order ID", 404)
+  return order
+
+
+def GetEditableOrder(oid):
+  """Return the order like GetUserOrder, answering 409 once it's paid"""
+  order = GetUserOrder(oid)
+  if order.GetStatus() != OrderStatus.CREATED:
+    raise ApiError("Order is already paid", 409)
+  return order
+
+
+def GetChoices():
+  """Return the items and numbers lists of the JSON request body"""
+  data = request.get_json(silent=True)
+  if not isinstance(data, dict):
+    raise ApiError("Expected a JSON object")
+  try:
+    items = [int(x) for x in data['items']]
+    numbers = [int(x) for x in data['numbers']]
+  except (KeyError, TypeError, ValueError) as e:
+    raise ApiError("items and numbers must be lists of integers") from e
+  if len(items) != len(numbers):
+    raise ApiError("items and numbers must have the same length")
+  return data, items, numbers
+
+
+def ApplyChange(order, change):
+  """Run change on order and commit it, or answer with its error"""
+  try:
+    change()
+  except ValueError as e:
+    raise ApiError(str(e)) from e
+  except RuntimeError as e:
+    raise ApiError(str(e), 409) from e
+  db.session.commit()
+  return jsonify(OrderToJSON(order))
+
+
+@app.route("/menu")
+def Menu():
+  """Return the whole offering tree with the availability of each item"""
+  catalog = GetCatalog()
+  stocks = Stock.LoadMany(catalog.GetStockIDs(catalog.items))
+  return jsonify(
+      version=catalog.GetVersion(),
+      roots=[item.GetID() for item in catalog.GetRootItems()],
+      items=[ItemToJSON(item, stocks) for item in catalog.items.values()],
+      groups=[GroupToJSON(ig, stocks) for ig in catalog.groups.values()])
+
+
+@app.route("/orders", methods=["POST"])
+def CreateOrder():
+  if 'uid' not in session:
+    raise ApiError("Please sign in first", 401)
+  order = Order(user_id=session['uid'], status=OrderStatus.CREATED, price=0)
+  db.session.add(order)
+  db.session.commit()
+  ORDERS_CREATED.Inc()
+  return jsonify(OrderToJSON(order)), 201
+
+
+@app.route("/orders/<int:oid>")
+def GetOrder(oid):
+  return jsonify(OrderToJSON(GetUserOrder(oid)))
+
+
+@app.route("/orders/<int:oid>/items", methods=["POST"])
+def AddRootItems(oid):
+  """Add root items, {"items": [ids], "numbers": [numbers]}"""
+  order = GetEditableOrder(oid)
+  _, items, numbers = GetChoices()
+  catalog = GetCatalog()
+  for item_id in items:
+    item = catalog.GetItem(item_id)
+    if item is None or not item.IsRoot():
+      raise ApiError("Item %d is not on the menu" % item_id)
+
+  def Change():
+    for item_id, number in zip(items, numbers):
+      if number > 0:
+        order.AddRootItem(item_id, number)
+
+  return ApplyChange(order, Change)
+
+
+@app.route("/orders/<int:oid>/groups", methods=["POST"])
+def FillGroup(oid):
+  """Fill in a group, {"path": path, "items": [ids], "numbers": [numbers]}"""
+  order = GetEditableOrder(oid)
+  data, items, numbers = GetChoices()
+  path = data.get('path')
+  if path is None:
+    path = (order.GetUnfulfilledIGDetails() or {}).get('path')
+  if not isinstance(path, str):
+    raise ApiError("No ingredient group to fill in")
+  try:
+    node, _, _ = order.GetTree().Resolve(path)
+  except ValueError:
+    node = None
+  if node is None or node.GetType() != "ig":
+    raise ApiError("Invalid ingredient group path %s" % path)
+  return ApplyChange(order, lambda: order.AddIG(path, items, numbers))
+
+
+@app.route("/orders/<int:oid>/checkout", methods=["POST"])
+def Checkout(oid):
+  order = GetEditableOrder(oid)
+  response = ApplyChange(order, order.Pay)
+  current_app.system.PublishOrder(order)
+  return response
@@ -1,9 +1,11 @@
 """Customer blueprint views"""
 
-from flask import render_template, request, session, redirect, flash
-from app.core.models.inventory import IngredientGroup
+from flask import render_template, request, session, redirect, flash, \
+    current_app, jsonify
+from app.core.metrics import ORDERS_CREATED
+from app.core.models.catalog import GetCatalog
 from app.core.models.order import Order, OrderStatus
-from app.core.models.inventory import Item
+from app.core.models.inventory import Stock
 from app.core.models.user import User, UserType
 from app.core.models import db
 from . import bp as app  # Note that app = blueprint, current_app = flask context
@@ -48,9 +50,16 @@ def OrderDetailsPage(oid):
       flash("Wrong order ID", "error")
       return redirect("/")
 
+  stock_usage = []
+  if user.GetType() == UserType.ADMIN:
+    requirements = order.ComputeStockRequirements()
+    stocks = Stock.LoadMany(requirements)
+    stock_usage = [(stocks[stock_id].GetName(), requirements[stock_id])
+                   for stock_id in sorted(requirements)]
   return render_template(
       "customer/orderDetailsPage.html",
       order=order,
+      stock_usage=stock_usage,
       isadmin=(user.GetType() == UserType.ADMIN))
 
 
@@ -59,6 +68,7 @@ def NewOrder():
   order = Order(user_id=session['uid'], status=OrderStatus.CREATED, price=0)
   db.session.add(order)
   db.session.commit()
+  ORDERS_CREATED.Inc()
   return redirect("/order/%d/menu" % order.GetID())
 
 
@@ -82,44 +92,104 @@ def OrderMenuPage(oid):
       else:
         order.AddIG(path, items, numbers)
       db.session.commit()
-  except ValueError as e:
-    flash(str(e), "error")
-  except RuntimeError as e:
+  except (ValueError, RuntimeError) as e:
+    db.session.rollback()
     flash(str(e), "error")
 
   igdetails = order.GetUnfulfilledIGDetails()
-  order.DeductStock()
-  # WARNING: DON'T COMMIT DB AFTER THIS
-  # this is to avoid the scenario where
-  # we have stock for 3 cokes, and the user orders 5 separate ones
-  # in this case we won't be able to tell coke is out of stock
-  # we can only tell customer that we are out of stock when he/she checks out
-  #
-  # this is a hacky fix toward this issue for better user experience
 
+  catalog = GetCatalog()
   if igdetails is None:
-    items = Item.query.filter(Item.root).all()
+    items = catalog.GetRootItems()
     return render_template(
         "customer/menu.html",
         order=order,
         items=items,
+        # stock already held by this order is not available, so the menu
+        # shows when e.g. the fourth coke can't be added with three left
+        stocks=Stock.LoadMany(catalog.GetStockIDs(x.id for x in items)),
         path="root",
         header="Menu",
         showcheckout=True,
         style="multi")
-  ig = IngredientGroup.query.get(igdetails['id'])
+  ig = catalog.GetGroup(igdetails['id'])
   style = "pickone" if ig.GetMinOption() == 1 and ig.GetMaxOption(
   ) == 1 and ig.GetMinItem() == 1 and ig.GetMaxItem() == 1 else "multi"
   return render_template(
       "customer/menu.html",
       order=order,
       items=ig.options,
+      stocks=Stock.LoadMany(catalog.GetStockIDs(x.id for x in ig.options)),
       path=igdetails['path'],
       header="Choose %s for %s" % (ig.name, igdetails['item_name']),
       showcheckout=False,
       style=style)
 
 
+@app.route("/order/<oid>/bulk", methods=["POST"])
+def OrderBulkAdd(oid):
+  """Add several root items configured the same way to an order
+
+  Takes a JSON body {"item": id, "quantity": n, "config": {path: {"items":
+  [ids], "numbers": [numbers]}}} and answers in JSON, or a form with item,
+  quantity, and items.<path> and numbers.<path> lists for each ingredient
+  group path relative to the item, and goes back to the menu.
+  """
+  order = Order.query.get(oid)
+  if order is None or order.user.GetID() != session.get('uid'):
+    if request.is_json:
+      return jsonify(error="Wrong order ID"), 404
+    flash("Wrong order ID. Do you want to create an order instead?", "error")
+    return redirect("/")
+
+  try:
+    if request.is_json:
+      data = request.get_json()
+      if not isinstance(data, dict) or not isinstance(
+          data.get('config', {}), dict):
+        raise ValueError("Invalid request")
+      item_id = int(data['item'])
+      quantity = int(data.get('quantity', 1))
+      config = {
+          path: (list(map(int, choice['items'])),
+                 list(map(int, choice['numbers'])))
+          for path, choice in data.get('config', {}).items()
+      }
+    else:
+      item_id = int(request.form['item'])
+      quantity = int(request.form.get('quantity', 1))
+      # an empty items.<path> field stands for a group left empty
+      config = {
+          key[len("items."):]: (
+              [int(x) for x in request.form.getlist(key) if x],
+              [int(x) for x in request.form.getlist(
+                  "numbers." + key[len("items."):]) if x])
+          for key in request.form
+          if key.startswith("items.")
+      }
+    price_cents = order.AddConfiguredItem(item_id, config, quantity)
+    db.session.commit()
+  except (KeyError, TypeError):
+    return _BulkAddError(oid, "Invalid request")
+  except (ValueError, RuntimeError) as e:
+    return _BulkAddError(oid, str(e))
+  if request.is_json:
+    return jsonify(
+        order=order.GetID(),
+        added_cents=price_cents,
+        price_cents=order.GetPriceCents())
+  flash("Added %d items" % quantity, "success")
+  return redirect("/order/%d/menu" % order.GetID())
+
+
+def _BulkAddError(oid, message):
+  db.session.rollback()
+  if request.is_json:
+    return jsonify(error=message), 400
+  flash(message, "error")
+  return redirect("/order/%d/menu" % int(oid))
+
+
 @app.route("/order/<oid>/checkout", methods=["GET", "POST"])
 def OrderCheckout(oid):
   """Display checkout page of an order"""
@@ -132,10 +202,13 @@ def OrderCheckout(oid):
   try:
     order.Pay()
   except ValueError as e:
+    db.session.rollback()
     flash("Something went wrong: " + str(e), "error")
     return render_template("/customer/checkout.html", order=order)
   except RuntimeError as e:
+    db.session.rollback()
     flash("Something went wrong: " + str(e), "error")
     return render_template("/customer/checkout.html", order=order)
   db.session.commit()
+  current_app.system.PublishOrder(order)
   return redirect("/order/%d" % int(oid))
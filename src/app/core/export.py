@@ -0,0 +1,131 @@
+"""Export module
+
+Streams orders for accounting as CSV, one row per item line with prices in
+dollars, or NDJSON, one object per order with prices in cents. Orders are
+read through a server-side cursor in batches and written out as they are
+read, so the memory used doesn't depend on the number of orders exported.
+"""
+
+import csv
+from datetime import datetime
+import io
+import json
+from app.core.models.order import Order, OrderStatus, DecodeContent, \
+    FlattenTree
+from app.core.models.user import User
+from app.core.models.money import FormatCents
+from app.core.models import db
+
+FORMATS = ("csv", "ndjson")
+MIMETYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+DATE_FORMAT = "%Y-%m-%d"
+BATCH_SIZE = 500
+
+CSV_COLUMNS = ("order_id", "user", "status", "order_price", "created_at",
+               "updated_at", "path", "item_id", "item_name", "group",
+               "quantity", "price")
+
+
+def ParseDate(text):
+  """Parse an optional YYYY-MM-DD date, raising ValueError if malformed"""
+  if not text:
+    return None
+  return datetime.strptime(text, DATE_FORMAT)
+
+
+def ParseStatus(text):
+  """Return the OrderStatus named text, None for all, or raise ValueError"""
+  if not text:
+    return None
+  try:
+    return OrderStatus[text.upper()]
+  except KeyError as e:
+    raise ValueError("Unknown order status %s" % text) from e
+
+
+def IterOrders(start=None, end=None, status=None):
+  """Yield (row, lines) of orders created in [start, end) in id order
+
+  row holds the order columns and the user name, lines the item lines of
+  its content as given by FlattenTree.
+  """
+  table = Order.__table__
+  query = db.select([
+      table.c.id, table.c.status, table.c.price_cents, table.c.created_at,
+      table.c.updated_at, table.c.content,
+      User.__table__.c.name.label("user")
+  ]).select_from(table.outerjoin(User.__table__)).order_by(table.c.id)
+  if start is not None:
+    query = query.where(table.c.created_at >= start)
+  if end is not None:
+    query = query.where(table.c.created_at < end)
+  if status is not None:
+    query = query.where(table.c.status == status)
+  result = db.session.connection().execution_options(
+      stream_results=True).execute(query)
+  try:
+    while True:
+      rows = result.fetchmany(BATCH_SIZE)
+      if not rows:
+        break
+      for row in rows:
+        yield row, FlattenTree(DecodeContent(row.content))
+  finally:
+    result.close()
+
+
+def _OrderFields(row):
+  return {
+      "order_id": row.id,
+      "user": row.user,
+      "status": row.status.name.lower(),
+      "price_cents": row.price_cents or 0,
+      "created_at": row.created_at.isoformat(sep=" "),
+      "updated_at": row.updated_at.isoformat(sep=" "),
+  }
+
+
+def ExportCSV(orders):
+  """Yield CSV text of orders from IterOrders, one chunk per batch"""
+  buf = io.StringIO()
+  writer = csv.writer(buf)
+  writer.writerow(CSV_COLUMNS)
+  count = 0
+  for row, lines in orders:
+    fields = _OrderFields(row)
+    order_columns = [
+        fields["order_id"], fields["user"], fields["status"],
+        FormatCents(fields["price_cents"]), fields["created_at"],
+        fields["updated_at"]
+    ]
+    empty = True
+    for line in lines:
+      empty = False
+      writer.writerow(order_columns + [
+          line["path"], line["item_id"], line["item_name"], line["ig_name"],
+          line["quantity"], FormatCents(line["price_cents"])
+      ])
+    if empty:
+      writer.writerow(order_columns + [""] * 6)
+    count += 1
+    if count % BATCH_SIZE == 0:
+      yield buf.getvalue()
+      buf.seek(0)
+      buf.truncate()
+  yield buf.getvalue()
+
+
+def ExportNDJSON(orders):
+  """Yield one JSON object per line for orders from IterOrders"""
+  for row, lines in orders:
+    fields = _OrderFields(row)
+    fields["lines"] = list(lines)
+    yield json.dumps(fields) + "\n"
+
+
+def ExportOrders(fmt, start=None, end=None, status=None):
+  """Return a generator of the export text of matching orders in fmt"""
+  if fmt not in FORMATS:
+    raise ValueError("Unknown export format %s" % fmt)
+  orders = IterOrders(start, end, status)
+  return ExportCSV(orders) if fmt == "csv" else ExportNDJSON(orders)
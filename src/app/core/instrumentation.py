@@ -0,0 +1,192 @@
+"""Instrumentation module
+
+Opt-in recording of database and template work per request, enabled with
+the SQL_INSTRUMENTATION setting. Each request records its number of
+queries, time spent in the database, slowest statement and template render
+time. These are aggregated per endpoint into RequestStats, and in debug
+mode are also sent back in X-DB-* response headers.
+"""
+
+import bisect
+import threading
+import time
+from flask import g, has_request_context, request, current_app
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# upper bounds in ms of the request duration histogram buckets
+DURATION_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class RequestRecord:
+  """Database and template work done by a single request"""
+
+  __slots__ = ('start', 'queries', 'db_time', 'slowest', 'slowest_time',
+               'render_time')
+
+  def __init__(self):
+    self.start = time.perf_counter()
+    self.queries = 0
+    self.db_time = 0.0
+    self.slowest = None
+    self.slowest_time = 0.0
+    self.render_time = 0.0
+
+  def AddQuery(self, statement, elapsed):
+    self.queries += 1
+    self.db_time += elapsed
+    if elapsed >= self.slowest_time:
+      self.slowest = statement
+      self.slowest_time = elapsed
+
+
+class EndpointStats:
+  """Aggregate of the requests to one endpoint"""
+
+  def __init__(self):
+    self.requests = 0
+    self.queries = 0
+    self.max_queries = 0
+    self.time = 0.0
+    self.db_time = 0.0
+    self.render_time = 0.0
+    self.slowest = None
+    self.slowest_time = 0.0
+    # one count per DURATION_BUCKETS bound plus one for slower requests
+    self.buckets = [0] * (len(DURATION_BUCKETS) + 1)
+
+  def Add(self, record, elapsed):
+    """Count a request that took elapsed seconds"""
+    self.requests += 1
+    self.queries += record.queries
+    self.max_queries = max(self.max_queries, record.queries)
+    self.time += elapsed
+    self.db_time += record.db_time
+    self.render_time += record.render_time
+    if record.slowest is not None and record.slowest_time >= self.slowest_time:
+      self.slowest = record.slowest
+      self.slowest_time = record.slowest_time
+    self.buckets[bisect.bisect_left(DURATION_BUCKETS, elapsed * 1e3)] += 1
+
+  def ToDict(self):
+    return {
+        "requests": self.requests,
+        "queries": self.queries,
+        "max_queries": self.max_queries,
+        "time_ms": self.time * 1e3,
+        "db_time_ms": self.db_time * 1e3,
+        "render_time_ms": self.render_time * 1e3,
+        "slowest_statement": self.slowest,
+        "slowest_statement_ms": self.slowest_time * 1e3,
+        "duration_buckets_ms": {
+            str(bound): count
+            for bound, count in zip(DURATION_BUCKETS + ("+Inf",), self.buckets)
+        },
+    }
+
+
+class RequestStats:
+  """In-process aggregate of request records, keyed by endpoint"""
+
+  def __init__(self):
+    self.endpoints = {}
+    self.lock = threading.Lock()
+
+  def Add(self, endpoint, record, elapsed):
+    with self.lock:
+      stats = self.endpoints.get(endpoint)
+      if stats is None:
+        stats = self.endpoints[endpoint] = EndpointStats()
+      stats.Add(record, elapsed)
+
+  def ToDict(self):
+    with self.lock:
+      return {
+          endpoint: stats.ToDict()
+          for endpoint, stats in sorted(self.endpoints.items())
+      }
+
+  def Reset(self):
+    with self.lock:
+      self.endpoints = {}
+
+
+# generate_async and make_module_async are left to Template: streamed output
+# is rendered after the request and modules aren't rendered
+class TimedTemplate(Template):  # pylint: disable=abstract-method
+  """Template adding its render time to the current request record"""
+
+  def render(self, *args, **kwargs):
+    record = _CurrentRecord()
+    if record is None:
+      return super().render(*args, **kwargs)
+    start = time.perf_counter()
+    try:
+      return super().render(*args, **kwargs)
+    finally:
+      record.render_time += time.perf_counter() - start
+
+  def render_async(self, *args, **kwargs):
+    rendering = super().render_async(*args, **kwargs)
+    record = _CurrentRecord()
+    if record is None:
+      return rendering
+    return _TimeRendering(rendering, record)
+
+
+async def _TimeRendering(rendering, record):
+  start = time.perf_counter()
+  try:
+    return await rendering
+  finally:
+    record.render_time += time.perf_counter() - start
+
+
+def _CurrentRecord():
+  if not has_request_context():
+    return None
+  return g.get('request_record')
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _OnBeforeExecute(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=unused-argument,too-many-arguments
+  if _CurrentRecord() is not None:
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _OnAfterExecute(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=unused-argument,too-many-arguments
+  record = _CurrentRecord()
+  if record is not None and conn.info.get('query_start'):
+    record.AddQuery(statement,
+                    time.perf_counter() - conn.info['query_start'].pop())
+
+
+def Install(app):
+  """Hook request instrumentation into app
+
+  Requests are only recorded while app.config['SQL_INSTRUMENTATION'] is
+  set, and the stats are kept in app.request_stats.
+  """
+  app.request_stats = RequestStats()
+  app.jinja_env.template_class = TimedTemplate
+
+  @app.before_request
+  def StartRecord():  # pylint: disable=unused-variable
+    if current_app.config.get('SQL_INSTRUMENTATION'):
+      g.request_record = RequestRecord()
+
+  @app.after_request
+  def FinishRecord(response):  # pylint: disable=unused-variable
+    record = g.pop('request_record', None)
+    if record is None:
+      return response
+    elapsed = time.perf_counter() - record.start
+    current_app.request_stats.Add(request.endpoint or "unknown", record,
+                                  elapsed)
+    if current_app.debug:
+      response.headers['X-DB-Queries'] = str(record.queries)
+      response.headers['X-DB-Time'] = "%.2fms" % (record.db_time * 1e3)
+      response.headers['X-Render-Time'] = "%.2fms" % (record.render_time * 1e3)
+    return response
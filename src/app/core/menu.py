@@ -0,0 +1,230 @@
+"""Menu module
+
+Declarative menu definitions, loaded into and exported from the database.
+A menu is a JSON (or YAML, with PyYAML installed) object of three lists,
+where ids are the database ids and the only way entries refer to each
+other:
+
+  stocks: {id, name, amount}
+  groups: {id, name, min_item, max_item, min_option, max_option,
+           options: [item ids]}
+  items:  {id, name, root, price_cents, stock, stock_unit, max_item, image,
+           identical, groups: [group ids]}
+
+Fields other than id and name may be left out to take their defaults.
+"""
+
+import json
+from app.core.models.catalog import BumpCatalogVersion
+from app.core.models.inventory import Item, IngredientGroup, Stock, \
+    item_ig, ig_item
+from app.core.models.order import Order
+from app.core.models.reservation import StockReservation
+from app.core.models import db
+
+STOCK_FIELDS = {'amount': 0}
+GROUP_FIELDS = {
+    'min_item': None,
+    'max_item': None,
+    'min_option': None,
+    'max_option': None,
+}
+ITEM_FIELDS = {
+    'root': False,
+    'price_cents': 0,
+    'stock': None,
+    'stock_unit': 1,
+    'max_item': None,
+    'image': "default.png",
+    'identical': False,
+}
+
+
+def ReadMenuFile(path):
+  """Parse a menu file, YAML if its name ends in .yaml or .yml"""
+  with open(path, encoding="utf-8") as f:
+    if path.endswith(('.yaml', '.yml')):
+      import yaml  # pylint: disable=import-outside-toplevel
+      return yaml.safe_load(f)
+    return json.load(f)
+
+
+def WriteMenuFile(menu, f, yaml_format=False):
+  if yaml_format:
+    import yaml  # pylint: disable=import-outside-toplevel
+    yaml.safe_dump(menu, f, sort_keys=False)
+  else:
+    json.dump(menu, f, indent=2)
+    f.write("\n")
+
+
+def _Entries(menu, kind, fields):
+  """Return the entries of kind with defaults filled in, keyed by id"""
+  entries = {}
+  for entry in menu.get(kind, ()):
+    if not isinstance(entry, dict):
+      raise ValueError("%s entries must be objects" % kind)
+    if not isinstance(entry.get('id'), int) or not entry.get('name'):
+      raise ValueError("%s entries need an integer id and a name" % kind)
+    if entry['id'] in entries:
+      raise ValueError("Duplicate %s id %d" % (kind, entry['id']))
+    unknown = set(entry) - set(fields) - {'id', 'name', 'options', 'groups'}
+    if unknown:
+      raise ValueError("Unknown %s field %s" % (kind, min(unknown)))
+    full = dict(fields)
+    full.update(entry)
+    entries[entry['id']] = full
+  return entries
+
+
+def _CheckField(entry, field, kind, minimum=0, optional=False):
+  """Raise ValueError unless entry[field] is of kind and in range
+
+  kind is int or bool; None is accepted for optional fields, and integers
+  must be at least minimum.
+  """
+  value = entry[field]
+  if value is None and optional:
+    return
+  if kind is bool:
+    if not isinstance(value, bool):
+      raise ValueError("%s of %s must be true or false" %
+                       (field, entry['name']))
+  elif isinstance(value, bool) or not isinstance(value, int) or \
+      value < minimum:
+    raise ValueError("%s of %s must be an integer of at least %d" %
+                     (field, entry['name'], minimum))
+
+
+def _CheckIDs(entry, field):
+  """Raise ValueError unless entry[field] is a list of distinct ids"""
+  ids = entry[field]
+  if not isinstance(ids, list) or not all(
+      isinstance(x, int) and not isinstance(x, bool) for x in ids):
+    raise ValueError("%s of %s must be a list of ids" % (field, entry['name']))
+  if len(set(ids)) != len(ids):
+    raise ValueError("%s of %s lists an id twice" % (field, entry['name']))
+
+
+def ValidateMenu(menu):
+  """Check a menu definition, raising ValueError on the first problem
+
+  Fields are checked for their types and ranges, so a valid menu loads
+  without database errors. Returns the stocks, groups and items with
+  defaults filled in, keyed by id.
+  """
+  if not isinstance(menu, dict):
+    raise ValueError("A menu must be an object")
+  stocks = _Entries(menu, 'stocks', STOCK_FIELDS)
+  groups = _Entries(menu, 'groups', dict(GROUP_FIELDS, options=[]))
+  items = _Entries(menu, 'items', dict(ITEM_FIELDS, groups=[]))
+  for stock in stocks.values():
+    _CheckField(stock, 'amount', int)
+  for group in groups.values():
+    for field in GROUP_FIELDS:
+      _CheckField(group, field, int, optional=True)
+    for low, high in (('min_item', 'max_item'), ('min_option', 'max_option')):
+      if group[low] is not None and group[high] is not None and \
+          group[low] > group[high]:
+        raise ValueError("%s of %s exceeds its %s" % (low, group['name'], high))
+    _CheckIDs(group, 'options')
+    for item_id in group['options']:
+      if item_id not in items:
+        raise ValueError("%s offers unknown item %r" % (group['name'], item_id))
+  for item in items.values():
+    _CheckField(item, 'root', bool)
+    _CheckField(item, 'identical', bool)
+    _CheckField(item, 'price_cents', int)
+    _CheckField(item, 'stock_unit', int, minimum=1)
+    _CheckField(item, 'max_item', int, optional=True)
+    if not isinstance(item['image'], str):
+      raise ValueError("image of %s must be a file name" % item['name'])
+    if item['stock'] is not None and item['stock'] not in stocks:
+      raise ValueError("%s uses unknown stock %r" %
+                       (item['name'], item['stock']))
+    _CheckIDs(item, 'groups')
+    for ig_id in item['groups']:
+      if ig_id not in groups:
+        raise ValueError("%s has unknown group %r" % (item['name'], ig_id))
+  return stocks, groups, items
+
+
+def LoadMenu(menu, replace=False):
+  """Insert a menu definition with one bulk insert per table
+
+  The database must not have a menu yet unless replace is set, in which case
+  the current menu, stock and stock holds are deleted first. Orders, their
+  lines and the sales rollups refer to items by id, so a menu can't be
+  replaced once there are orders. Everything happens in the current
+  transaction, which the caller commits.
+  """
+  stocks, groups, items = ValidateMenu(menu)
+  if replace:
+    if db.session.query(Order.query.exists()).scalar():
+      raise ValueError("The menu of a database with orders can't be replaced")
+    for table in (item_ig, ig_item, StockReservation.__table__,
+                  Item.__table__, IngredientGroup.__table__, Stock.__table__):
+      db.session.execute(table.delete())
+  elif db.session.query(Item.query.exists()).scalar():
+    raise ValueError("The database already has a menu")
+
+  rows = (
+      (Stock.__table__, [{
+          'id': stock['id'],
+          'name': stock['name'],
+          'amount': stock['amount'],
+          'reserved': 0,
+      } for stock in stocks.values()]),
+      (IngredientGroup.__table__, [{
+          field: group[field] for field in ('id', 'name', *GROUP_FIELDS)
+      } for group in groups.values()]),
+      (Item.__table__, [dict({
+          field: item[field] for field in ('id', 'name', *ITEM_FIELDS)
+          if field != 'stock'
+      }, stock_id=item['stock']) for item in items.values()]),
+      (item_ig, [{
+          'item_id': item['id'],
+          'ig_id': ig_id
+      } for item in items.values() for ig_id in item['groups']]),
+      (ig_item, [{
+          'ig_id': group['id'],
+          'item_id': item_id
+      } for group in groups.values() for item_id in group['options']]),
+  )
+  for table, table_rows in rows:
+    if table_rows:
+      db.session.execute(table.insert(), table_rows)
+  BumpCatalogVersion(db.session)
+
+
+def ExportMenu():
+  """Return the menu in the database as a menu definition"""
+  options = {}
+  for row in db.session.execute(ig_item.select()):
+    options.setdefault(row.ig_id, []).append(row.item_id)
+  item_groups = {}
+  for row in db.session.execute(item_ig.select()):
+    item_groups.setdefault(row.item_id, []).append(row.ig_id)
+  stocks = db.session.execute(Stock.__table__.select().order_by(Stock.id))
+  groups = db.session.execute(IngredientGroup.__table__.select().order_by(
+      IngredientGroup.id))
+  items = db.session.execute(Item.__table__.select().order_by(Item.id))
+  return {
+      'stocks': [{
+          'id': row.id,
+          'name': row.name,
+          'amount': row.amount,
+      } for row in stocks],
+      'groups': [
+          dict({field: row[field] for field in ('id', 'name', *GROUP_FIELDS)},
+               options=options.get(row.id, [])) for row in groups
+      ],
+      'items': [
+          dict({
+              field: bool(row[field]) if field in ('root', 'identical') else
+                     row[field] for field in ('id', 'name', *ITEM_FIELDS)
+              if field != 'stock'
+          }, stock=row.stock_id, groups=item_groups.get(row.id, []))
+          for row in items
+      ],
+  }
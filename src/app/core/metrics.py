@@ -0,0 +1,183 @@
+"""Metrics module
+
+Counters and histograms exported in the Prometheus text format at
+/admin/metrics. Every thread updates its own shard of a metric, so the hot
+path takes no lock; shards are only summed when the metrics are scraped.
+"""
+
+import abc
+import bisect
+import threading
+import time
+from flask import g, request
+
+# upper bounds in seconds of request latency buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metric(abc.ABC):
+  """Base of metrics keeping one shard of values per thread"""
+
+  kind = None
+
+  def __init__(self, name, documentation, labels=()):
+    self.name = name
+    self.documentation = documentation
+    self.labels = tuple(labels)
+    self.local = threading.local()
+    # shards of live threads keyed by thread, and the sum of finished ones
+    self.shards = {}
+    self.retired = {}
+    self.lock = threading.Lock()
+
+  def _Shard(self):
+    """Return the values of the current thread, keyed by label values"""
+    shard = getattr(self.local, 'shard', None)
+    if shard is None:
+      shard = self.local.shard = {}
+      with self.lock:
+        for thread in [t for t in self.shards if not t.is_alive()]:
+          self._Merge(self.retired, self.shards.pop(thread))
+        self.shards[threading.current_thread()] = shard
+    return shard
+
+  @abc.abstractmethod
+  def _Merge(self, totals, shard):
+    """Add the values of shard to totals"""
+
+  def _Totals(self):
+    """Return the sum of all shards, keyed by label values"""
+    totals = {}
+    with self.lock:
+      shards = [self.retired] + list(self.shards.values())
+      for shard in shards:
+        self._Merge(totals, shard)
+    return totals
+
+  def _Key(self, labels):
+    return tuple(str(labels[label]) for label in self.labels)
+
+  def _Labels(self, key, extra=None):
+    pairs = list(zip(self.labels, key))
+    if extra is not None:
+      pairs.append(extra)
+    if not pairs:
+      return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, EscapeLabel(value)) for name, value in pairs)
+
+  @abc.abstractmethod
+  def Collect(self):
+    """Return the exposition lines of this metric"""
+
+  def Expose(self):
+    return ["# HELP %s %s" % (self.name, self.documentation),
+            "# TYPE %s %s" % (self.name, self.kind)] + self.Collect()
+
+
+class Counter(Metric):
+  """Monotonic count, e.g. COUNTER.Inc(reason="ValueError")"""
+
+  kind = "counter"
+
+  def Inc(self, amount=1, **labels):
+    shard = self._Shard()
+    key = self._Key(labels)
+    shard[key] = shard.get(key, 0) + amount
+
+  def Get(self, **labels):
+    return self._Totals().get(self._Key(labels), 0)
+
+  def _Merge(self, totals, shard):
+    for key, value in list(shard.items()):
+      totals[key] = totals.get(key, 0) + value
+
+  def Collect(self):
+    totals = self._Totals()
+    return [
+        "%s%s %s" % (self.name, self._Labels(key), value)
+        for key, value in sorted(totals.items())
+    ]
+
+
+class Histogram(Metric):
+  """Distribution of observed values in cumulative buckets"""
+
+  kind = "histogram"
+
+  def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+    super().__init__(name, documentation, labels)
+    self.buckets = tuple(buckets)
+
+  def Observe(self, value, **labels):
+    shard = self._Shard()
+    key = self._Key(labels)
+    values = shard.get(key)
+    if values is None:
+      # one count per bucket, one for larger values, then the sum
+      values = shard[key] = [0] * (len(self.buckets) + 1) + [0.0]
+    values[bisect.bisect_left(self.buckets, value)] += 1
+    values[-1] += value
+
+  def _Merge(self, totals, shard):
+    for key, values in list(shard.items()):
+      total = totals.setdefault(key, [0] * len(values))
+      for idx, value in enumerate(list(values)):
+        total[idx] += value
+
+  def Collect(self):
+    lines = []
+    for key, values in sorted(self._Totals().items()):
+      count = 0
+      for bound, value in zip(self.buckets + ("+Inf",), values):
+        count += value
+        lines.append("%s_bucket%s %d" %
+                     (self.name, self._Labels(key, ("le", bound)), count))
+      lines.append("%s_sum%s %s" % (self.name, self._Labels(key), values[-1]))
+      lines.append("%s_count%s %d" % (self.name, self._Labels(key), count))
+    return lines
+
+
+def EscapeLabel(value):
+  return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace(
+      '"', '\\"')
+
+
+ORDERS_CREATED = Counter("sales_orders_created_total", "Orders created")
+ITEMS_ADDED = Counter("sales_items_added_total",
+                      "Items added to orders, root items or ingredients",
+                      ("kind",))
+CHECKOUTS = Counter("sales_checkouts_total",
+                    "Order payments by result and error type",
+                    ("result", "reason"))
+STOCK_OUTS = Counter("sales_stock_outs_total",
+                     "Requests refused for lack of a stock", ("stock",))
+REQUEST_LATENCY = Histogram("sales_request_duration_seconds",
+                            "Request latency by endpoint", ("endpoint",))
+
+REGISTRY = (ORDERS_CREATED, ITEMS_ADDED, CHECKOUTS, STOCK_OUTS,
+            REQUEST_LATENCY)
+
+
+def Expose():
+  """Return all metrics in the Prometheus text format"""
+  lines = []
+  for metric in REGISTRY:
+    lines.extend(metric.Expose())
+  return "\n".join(lines) + "\n"
+
+
+def Install(app):
+  """Record the latency of every request to app"""
+
+  @app.before_request
+  def StartTimer():  # pylint: disable=unused-variable
+    g.metrics_start = time.perf_counter()
+
+  @app.after_request
+  def ObserveLatency(response):  # pylint: disable=unused-variable
+    start = g.pop('metrics_start', None)
+    if start is not None:
+      REQUEST_LATENCY.Observe(
+          time.perf_counter() - start, endpoint=request.endpoint or "unknown")
+    return response
@@ -0,0 +1,51 @@
+"""Migrations module
+
+Forward-only schema migrations. Each script in SCRIPTS brings the schema
+from the previous version to its position in the list, and the version
+reached is kept in the schema_version table. Tables missing altogether are
+left to db.create_all(), which creates them in their current form.
+
+Add a migration by writing the next mNNNN_<name>.py script with an
+Upgrade(connection) function and appending it to SCRIPTS; never edit or
+reorder shipped ones.
+"""
+
+from sqlalchemy import MetaData, Table, Column, Integer, insert, update
+from . import m0001_price_cents, m0002_stock_reserved, m0003_lookup_indexes
+
+SCRIPTS = (m0001_price_cents, m0002_stock_reserved, m0003_lookup_indexes)
+LATEST = len(SCRIPTS)
+
+schema_version = Table('schema_version', MetaData(),
+                       Column('version', Integer, nullable=False))
+
+
+def GetVersion(connection):
+  """Return the schema version of the database, 0 if never migrated"""
+  if not schema_version.exists(connection):
+    return 0
+  return connection.execute(schema_version.select()).scalar() or 0
+
+
+def SetVersion(connection, version):
+  schema_version.create(connection, checkfirst=True)
+  if connection.execute(update(schema_version).values(
+      version=version)).rowcount == 0:
+    connection.execute(insert(schema_version).values(version=version))
+
+
+def Upgrade(engine, target=LATEST):
+  """Run the scripts needed to bring the database to target
+
+  Each script runs in its own transaction together with the version bump.
+  Returns the list of versions applied.
+  """
+  applied = []
+  with engine.connect() as connection:
+    current = GetVersion(connection)
+    for version in range(current + 1, target + 1):
+      with connection.begin():
+        SCRIPTS[version - 1].Upgrade(connection)
+        SetVersion(connection, version)
+      applied.append(version)
+  return applied
@@ -0,0 +1,13 @@
+"""Store item and order prices as integer cents
+
+The old price columns are kept but no longer used.
+"""
+
+from .schema import AddColumn, Quote
+
+
+def Upgrade(connection):
+  for table in ('item', 'order'):
+    if AddColumn(connection, table, 'price_cents', 'INTEGER DEFAULT 0'):
+      connection.execute('UPDATE %s SET price_cents = ROUND(price * 100)' %
+                         Quote(connection, table))
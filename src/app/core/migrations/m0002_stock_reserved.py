@@ -0,0 +1,7 @@
+"""Track stock held by unpaid orders"""
+
+from .schema import AddColumn
+
+
+def Upgrade(connection):
+  AddColumn(connection, 'stock', 'reserved', 'INTEGER NOT NULL DEFAULT 0')
@@ -0,0 +1,11 @@
+"""Index the columns driving the order list, menu and stock lookups"""
+
+from .schema import CreateIndex
+
+
+def Upgrade(connection):
+  CreateIndex(connection, 'order', 'ix_order_status_updated_at',
+              ('status', 'updated_at', 'id'))
+  CreateIndex(connection, 'order', 'ix_order_user_id', ('user_id',))
+  CreateIndex(connection, 'item', 'ix_item_root', ('root',))
+  CreateIndex(connection, 'item', 'ix_item_stock_id', ('stock_id',))
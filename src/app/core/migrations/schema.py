@@ -0,0 +1,44 @@
+"""Schema inspection helpers for migration scripts
+
+Scripts must be safe to run on a database that already has some of their
+changes, or lacks the tables they touch, so they check before altering.
+"""
+
+from sqlalchemy import inspect
+
+
+def HasTable(connection, table):
+  return table in inspect(connection).get_table_names()
+
+
+def HasColumn(connection, table, column):
+  return column in {c['name'] for c in inspect(connection).get_columns(table)}
+
+
+def HasIndex(connection, table, name):
+  return name in {i['name'] for i in inspect(connection).get_indexes(table)}
+
+
+def Quote(connection, name):
+  return connection.dialect.identifier_preparer.quote(name)
+
+
+def AddColumn(connection, table, column, definition):
+  """Add a column to table if both the table exists and the column doesn't
+
+  Returns whether the column was added.
+  """
+  if not HasTable(connection, table) or HasColumn(connection, table, column):
+    return False
+  connection.execute('ALTER TABLE %s ADD COLUMN %s %s' %
+                     (Quote(connection, table), column, definition))
+  return True
+
+
+def CreateIndex(connection, table, name, columns):
+  """Create an index on the columns of table unless it exists"""
+  if not HasTable(connection, table) or HasIndex(connection, table, name):
+    return
+  connection.execute('CREATE INDEX %s ON %s (%s)' %
+                     (name, Quote(connection, table), ", ".join(
+                         Quote(connection, column) for column in columns)))
@@ -2,4 +2,18 @@
 
 from flask_sqlalchemy import SQLAlchemy
 
-db = SQLAlchemy()
+
+class SalesSQLAlchemy(SQLAlchemy):
+  """SQLAlchemy extension applying SQLALCHEMY_ENGINE_OPTIONS on any version
+
+  Flask-SQLAlchemy only reads SQLALCHEMY_ENGINE_OPTIONS from 2.4 on, so the
+  options are also merged here, after the driver defaults, for 2.3.
+  """
+
+  def apply_driver_hacks(self, app, sa_url, options):
+    ret = super().apply_driver_hacks(app, sa_url, options)
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    return ret
+
+
+db = SalesSQLAlchemy()
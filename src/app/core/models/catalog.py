@@ -0,0 +1,298 @@
+"""Catalog module
+
+Read-through cache of the offering tree (items, ingredient groups and the
+links between them). The menu rarely changes, so a snapshot is built once and
+shared until the catalog version stored in the database is bumped, which
+happens automatically whenever Items or IngredientGroups are flushed.
+Snapshots built by a transaction that bumped the version are not shared,
+since it may still roll back and the version number be bumped again.
+"""
+
+import threading
+import weakref
+from flask import g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from app.core.models.inventory import Item, IngredientGroup, item_ig, ig_item
+from . import db
+
+
+class CatalogVersion(db.Model):
+  """Single row table holding the current catalog version"""
+  id = db.Column(db.Integer, primary_key=True)
+  version = db.Column(db.Integer, default=0)
+
+
+class CatalogItem:
+  """Read-only snapshot of an Item"""
+
+  __slots__ = ('id', 'root', 'stock_id', 'stock_unit', 'max_item',
+               'price_cents', 'image', 'name', 'identical', 'ingredientgroups')
+
+  def __init__(self, row):
+    self.id = row.id
+    self.root = bool(row.root)
+    self.stock_id = row.stock_id
+    self.stock_unit = row.stock_unit
+    self.max_item = row.max_item
+    self.price_cents = row.price_cents or 0
+    self.image = row.image
+    self.name = row.name
+    self.identical = bool(row.identical)
+    self.ingredientgroups = ()
+
+  def GetID(self):
+    return self.id
+
+  def IsRoot(self):
+    return self.root
+
+  def GetStockID(self):
+    return self.stock_id
+
+  def GetStockUnit(self):
+    return self.stock_unit
+
+  def GetPrice(self):
+    return self.price_cents / 100
+
+  def GetPriceCents(self):
+    return self.price_cents
+
+  def GetImage(self):
+    return self.image
+
+  def GetName(self):
+    return self.name
+
+  def GetMaxItem(self):
+    return self.max_item
+
+  def CanShareIdenticalIG(self):
+    return self.identical
+
+  def HasEnoughStock(self, number, stocks):
+    """Check stock level against stocks, a dict of stock id to Stock"""
+    if self.stock_id is None:
+      return True
+    return stocks[self.stock_id].GetAvailable() >= number * self.stock_unit
+
+
+class GroupValidator:
+  """Constraints of an IngredientGroup compiled for checking choices
+
+  Raises ValueError with a message for the customer on invalid choices.
+  """
+
+  __slots__ = ('name', 'max_item', 'min_item', 'max_option', 'min_option',
+               'option_ids', 'max_items')
+
+  def __init__(self, group):
+    self.name = group.name
+    self.max_item = group.max_item
+    self.min_item = group.min_item
+    self.max_option = group.max_option
+    self.min_option = group.min_option
+    self.option_ids = frozenset(item.id for item in group.options)
+    self.max_items = {
+        item.id: (item.max_item, item.name)
+        for item in group.options
+        if item.max_item is not None
+    }
+
+  def CheckChoice(self, item_id, number):
+    """Check number of the item with item_id can be chosen in the group"""
+    if item_id not in self.option_ids:
+      raise ValueError('Item %d is not an option of %s' % (item_id, self.name))
+    if item_id in self.max_items and number > self.max_items[item_id][0]:
+      raise ValueError('Number of %s can\'t exceed %d' %
+                       (self.max_items[item_id][1], self.max_items[item_id][0]))
+
+  def CheckFulfilled(self, nodes):
+    """Check the item nodes chosen in the group meet its constraints"""
+    options = set()
+    items = 0
+    for node in nodes:
+      if node.num > 0:
+        options.add(node.id)
+      items += node.num
+    options = len(options)
+    if self.min_option is not None and options < self.min_option:
+      raise ValueError(
+          "At least %d different offerings must be selected from %s" %
+          (self.min_option, self.name))
+    if self.max_option is not None and options > self.max_option:
+      raise ValueError(
+          "At most %d different offerings can be selected from %s" %
+          (self.max_option, self.name))
+    if self.min_item is not None and items < self.min_item:
+      raise ValueError("At least %d items must be chosen in %s" %
+                       (self.min_item, self.name))
+    if self.max_item is not None and items > self.max_item:
+      raise ValueError("At most %d items can be chosen in %s" %
+                       (self.max_item, self.name))
+
+
+class CatalogGroup:
+  """Read-only snapshot of an IngredientGroup"""
+
+  __slots__ = ('id', 'name', 'max_item', 'min_item', 'max_option',
+               'min_option', 'options', 'validator')
+
+  def __init__(self, row):
+    self.id = row.id
+    self.name = row.name
+    self.max_item = row.max_item
+    self.min_item = row.min_item
+    self.max_option = row.max_option
+    self.min_option = row.min_option
+    self.options = ()
+    self.validator = None
+
+  def GetID(self):
+    return self.id
+
+  def GetName(self):
+    return self.name
+
+  def GetMaxItem(self):
+    return self.max_item
+
+  def GetMinItem(self):
+    return self.min_item
+
+  def GetMaxOption(self):
+    return self.max_option
+
+  def GetMinOption(self):
+    return self.min_option
+
+  def GetValidator(self):
+    return self.validator
+
+
+class Catalog:
+  """Immutable snapshot of the whole offering tree"""
+
+  def __init__(self, version, items, groups, roots):
+    self.version = version
+    self.items = items
+    self.groups = groups
+    self.roots = roots
+
+  @staticmethod
+  def Load(version):
+    """Build a snapshot with one query per table"""
+    items = {
+        row.id: CatalogItem(row)
+        for row in db.session.execute(
+            Item.__table__.select().order_by(Item.id))
+    }
+    groups = {
+        row.id: CatalogGroup(row)
+        for row in db.session.execute(
+            IngredientGroup.__table__.select().order_by(IngredientGroup.id))
+    }
+    links = {}
+    for row in db.session.execute(item_ig.select()):
+      links.setdefault(row.item_id, []).append(groups[row.ig_id])
+    for item_id, item_groups in links.items():
+      items[item_id].ingredientgroups = tuple(item_groups)
+    links = {}
+    for row in db.session.execute(ig_item.select()):
+      links.setdefault(row.ig_id, []).append(items[row.item_id])
+    for ig_id, options in links.items():
+      groups[ig_id].options = tuple(options)
+    for group in groups.values():
+      group.validator = GroupValidator(group)
+    roots = tuple(item for item in items.values() if item.root)
+    return Catalog(version, items, groups, roots)
+
+  def GetVersion(self):
+    return self.version
+
+  def GetItem(self, item_id):
+    return self.items.get(item_id)
+
+  def GetGroup(self, ig_id):
+    return self.groups.get(ig_id)
+
+  def GetRootItems(self):
+    return self.roots
+
+  def GetStockIDs(self, item_ids):
+    """Return the ids of stocks used by the given items"""
+    return {
+        self.items[item_id].stock_id
+        for item_id in item_ids
+        if item_id in self.items and self.items[item_id].stock_id is not None
+    }
+
+
+_snapshots = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def GetCatalogVersion():
+  """Return the catalog version, read at most once per app context"""
+  if has_app_context() and 'catalog_version' in g:
+    return g.catalog_version
+  row = CatalogVersion.query.get(1)
+  version = 0 if row is None else row.version
+  if has_app_context():
+    g.catalog_version = version
+  return version
+
+
+def GetCatalog():
+  """Return the current catalog snapshot, loading it if it's stale
+
+  Within a transaction that bumped the version the catalog is loaded from
+  its uncommitted state each time and not shared.
+  """
+  version = GetCatalogVersion()
+  if db.session.info.get('catalog_bumped'):
+    return Catalog.Load(version)
+  engine = db.get_engine()
+  catalog = _snapshots.get(engine)
+  if catalog is None or catalog.version != version:
+    catalog = Catalog.Load(version)
+    with _lock:
+      _snapshots[engine] = catalog
+  return catalog
+
+
+def BumpCatalogVersion(session):
+  """Invalidate all catalog snapshots as part of the session's transaction"""
+  table = CatalogVersion.__table__
+  update = table.update().where(table.c.id == 1).values(
+      version=table.c.version + 1)
+  if session.execute(update).rowcount == 0:
+    # The row is created on first use; if a concurrent bump created it
+    # first, the insert is undone with its savepoint and the row bumped.
+    connection = session.connection()
+    try:
+      with connection.begin_nested():
+        connection.execute(table.insert().values(id=1, version=1))
+    except IntegrityError:
+      session.execute(update)
+  session.info['catalog_bumped'] = True
+  if has_app_context():
+    g.pop('catalog_version', None)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _OnAfterTransactionEnd(session, transaction):
+  if transaction.parent is None and session.info.pop('catalog_bumped', None):
+    # The version read in the transaction may have been rolled back
+    if has_app_context():
+      g.pop('catalog_version', None)
+
+
+@event.listens_for(Session, 'after_flush')
+def _OnAfterFlush(session, flush_context):  # pylint: disable=unused-argument
+  for obj in session.new | session.dirty | session.deleted:
+    if isinstance(obj, (Item, IngredientGroup)):
+      BumpCatalogVersion(session)
+      return
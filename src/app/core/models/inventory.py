@@ -1,5 +1,8 @@
 """Inventory module"""
 
+from sqlalchemy.orm.util import identity_key
+from app.core.metrics import STOCK_OUTS
+from app.core.models.money import ToCents
 from . import db
 
 item_ig = db.Table(
@@ -26,11 +29,11 @@ ig_item = db.Table(
 class Item(db.Model):
   """Item class"""
   id = db.Column(db.Integer, primary_key=True)
-  root = db.Column(db.Boolean)
-  stock_id = db.Column(db.Integer, db.ForeignKey('stock.id'))
+  root = db.Column(db.Boolean, index=True)
+  stock_id = db.Column(db.Integer, db.ForeignKey('stock.id'), index=True)
   stock_unit = db.Column(db.Integer, default=1)
   max_item = db.Column(db.Integer)
-  price = db.Column(db.Float, default=0)
+  price_cents = db.Column(db.Integer, default=0)
   image = db.Column(db.Text, default="default.png")
   name = db.Column(db.Text)
   identical = db.Column(db.Boolean, default=False)
@@ -48,9 +51,21 @@ class Item(db.Model):
   def GetStockUnit(self):
     return self.stock_unit
 
+  @property
+  def price(self):
+    """Price in dollars, stored as integer cents in price_cents"""
+    return None if self.price_cents is None else self.price_cents / 100
+
+  @price.setter
+  def price(self, dollars):
+    self.price_cents = ToCents(dollars)
+
   def GetPrice(self):
     return self.price
 
+  def GetPriceCents(self):
+    return self.price_cents
+
   def GetImage(self):
     return self.image
 
@@ -64,7 +79,7 @@ class Item(db.Model):
     return self.identical
 
   def HasEnoughStock(self, number):
-    return self.stock is None or self.stock.GetAmount(
+    return self.stock is None or self.stock.GetAvailable(
     ) >= number * self.stock_unit
 
 
@@ -102,8 +117,22 @@ class Stock(db.Model):
   id = db.Column(db.Integer, primary_key=True)
   name = db.Column(db.Text)
   amount = db.Column(db.Integer, default=0)
+  # amount held by unpaid orders, see app.core.models.reservation
+  reserved = db.Column(
+      db.Integer, nullable=False, default=0, server_default='0')
   items = db.relationship('Item', backref='stock')
 
+  @staticmethod
+  def LoadMany(ids):
+    """Load stocks by id in a single query
+
+    Returns a dict mapping stock id to Stock, missing ids are left out.
+    """
+    ids = set(ids)
+    if not ids:
+      return {}
+    return {stock.id: stock for stock in Stock.query.filter(Stock.id.in_(ids))}
+
   def GetID(self):
     return self.id
 
@@ -113,6 +142,13 @@ class Stock(db.Model):
   def GetAmount(self):
     return self.amount
 
+  def GetReserved(self):
+    return self.reserved or 0
+
+  def GetAvailable(self):
+    """Return amount not held by unpaid orders"""
+    return self.amount - self.GetReserved()
+
   def AdjustAmount(self, amount):
     """adjust amount by a variance
     If amount is negative after applying the variance, set it to 0.
@@ -133,3 +169,86 @@ class Stock(db.Model):
     if self.amount - amount < 0:
       raise RuntimeError("Stock not enough for %s" % self.name)
     self.amount -= amount
+
+  @staticmethod
+  def FindShortage(requirements, stocks):
+    """Return the first Stock without enough available, or None
+
+    requirements maps stock id to amount and stocks maps stock id to Stock.
+    A shortage is counted as a stock-out.
+    """
+    for stock_id in sorted(requirements):
+      if stocks[stock_id].GetAvailable() < requirements[stock_id]:
+        STOCK_OUTS.Inc(stock=stocks[stock_id].GetName())
+        return stocks[stock_id]
+    return None
+
+  @staticmethod
+  def DecreaseMany(requirements):
+    """Atomically decrease several stocks, or none of them
+
+    requirements maps stock id to the amount to take. Stock held by other
+    orders can't be taken, see Stock.ReserveMany.
+    """
+    Stock._TakeMany(requirements, Stock.__table__.c.amount,
+                    "Stock not enough for %s")
+
+  @staticmethod
+  def ReserveMany(requirements):
+    """Atomically hold several stocks for an unpaid order, or none of them"""
+    Stock._TakeMany(requirements, Stock.__table__.c.reserved,
+                    "We don't have enough stock for %s")
+
+  @staticmethod
+  def UnreserveMany(amounts):
+    """Give back stock held by ReserveMany"""
+    table = Stock.__table__
+    db.session.flush()
+    for stock_id in sorted(amounts):
+      db.session.execute(
+          table.update().where(table.c.id == stock_id).values(
+              reserved=table.c.reserved - amounts[stock_id]))
+    Stock._Expire(amounts)
+
+  @staticmethod
+  def _TakeMany(requirements, column, message):
+    """Take available stock by moving it out of amount or into reserved
+
+    Each row is updated with a conditional UPDATE in stock id order, so
+    concurrent checkouts can neither oversell nor deadlock. Raises
+    RuntimeError naming the first stock that ran out, after putting back
+    what was already taken.
+    """
+    for amount in requirements.values():
+      if amount < 0:
+        raise ValueError("Cannot decrease by negative stock")
+    sign = -1 if column.name == 'amount' else 1
+    db.session.flush()
+    table = Stock.__table__
+    taken = []
+    for stock_id in sorted(requirements):
+      amount = requirements[stock_id]
+      result = db.session.execute(
+          table.update().where(table.c.id == stock_id).where(
+              table.c.amount - table.c.reserved >= amount).values(
+                  {column: column + sign * amount}))
+      if result.rowcount != 1:
+        for taken_id, taken_amount in taken:
+          db.session.execute(
+              table.update().where(table.c.id == taken_id).values(
+                  {column: column - sign * taken_amount}))
+        Stock._Expire(dict(taken))
+        name = db.session.execute(
+            db.select([table.c.name]).where(table.c.id == stock_id)).scalar()
+        STOCK_OUTS.Inc(stock=name)
+        raise RuntimeError(message % name)
+      taken.append((stock_id, amount))
+    Stock._Expire(dict(taken))
+
+  @staticmethod
+  def _Expire(stock_ids):
+    """Make loaded Stock objects reload levels changed behind the ORM"""
+    for stock_id in stock_ids:
+      stock = db.session.identity_map.get(identity_key(Stock, stock_id))
+      if stock is not None:
+        db.session.expire(stock, ['amount', 'reserved'])
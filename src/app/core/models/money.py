@@ -0,0 +1,18 @@
+"""Money module
+
+Prices are stored and added up as integer cents so totals are exact. These
+helpers convert at the edges, where dollars come in or go out as text.
+"""
+
+
+def ToCents(dollars):
+  """Convert a dollar amount such as 12.99 to integer cents"""
+  if dollars is None:
+    return None
+  return int(round(dollars * 100))
+
+
+def FormatCents(cents):
+  """Format integer cents as a dollar string without the sign, e.g. 12.99"""
+  sign = "-" if cents < 0 else ""
+  return "%s%d.%02d" % ((sign,) + divmod(abs(cents), 100))
@@ -2,11 +2,26 @@
 
 from datetime import datetime
 import enum
-from functools import reduce
 import json
-from app.core.models.inventory import Item, IngredientGroup
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+from app.core.metrics import ITEMS_ADDED, CHECKOUTS
+from app.core.models.catalog import GetCatalog
+from app.core.models.inventory import Stock
+from app.core.models.money import ToCents, FormatCents
+from app.core.models.reservation import StockReservation
+from app.core.models.rollup import RecordSale
 from . import db
 
+# Version tag written as the first element of an encoded Order.content.
+# Version 1 (untagged) is the original list of nested node dicts, version 2
+# the flat node table with prices in dollars, version 3 in cents and
+# version 4 adds the paths of unfulfilled ingredient groups.
+CONTENT_VERSION = 4
+
+CURSOR_TIME_FORMAT = "%Y%m%d%H%M%S%f"
+
 
 class OrderStatus(enum.Enum):
   CREATED = 0
@@ -17,14 +32,24 @@ class OrderStatus(enum.Enum):
 class Order(db.Model):
   """Order class"""
   id = db.Column(db.Integer, primary_key=True)
-  user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+  user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
   status = db.Column(db.Enum(OrderStatus), default=OrderStatus.CREATED)
-  price = db.Column(db.Float, default=0)
+  price_cents = db.Column(db.Integer, default=0)
   created_at = db.Column(db.DateTime, default=datetime.now)
   updated_at = db.Column(
       db.DateTime, default=datetime.now, onupdate=datetime.now)
   content = db.Column(db.Text, default="[]")
 
+  __table_args__ = (db.Index('ix_order_status_updated_at', 'status',
+                             'updated_at', 'id'),)
+
+  # Decoded content, shared by all methods for the lifetime of the instance.
+  # _tree_source is the content string the tree corresponds to, and
+  # _tree_dirty means the tree has changes not yet encoded into content.
+  _tree = None
+  _tree_source = None
+  _tree_dirty = False
+
   def GetID(self):
     return self.id
 
@@ -37,9 +62,21 @@ class Order(db.Model):
   def GetStatusText(self):
     return self.status.name.lower()
 
+  @property
+  def price(self):
+    """Price in dollars, stored as integer cents in price_cents"""
+    return None if self.price_cents is None else self.price_cents / 100
+
+  @price.setter
+  def price(self, dollars):
+    self.price_cents = ToCents(dollars)
+
   def GetPrice(self):
     return self.price
 
+  def GetPriceCents(self):
+    return self.price_cents
+
   def GetCreatedAt(self):
     return self.created_at
 
@@ -47,6 +84,7 @@ class Order(db.Model):
     return self.updated_at
 
   def GetContent(self):
+    self.FlushTree()
     return self.content
 
   def SetID(self, oid):
@@ -55,91 +93,459 @@ class Order(db.Model):
   def SetStatus(self, status):
     self.status = status
 
+  def GetTree(self):
+    """Return the order content as a ContentTree of root ItemNodes
+
+    Content is decoded lazily and only once unless it is reassigned.
+    """
+    if self._tree_dirty:
+      return self._tree
+    content = self.content
+    if self._tree is None or content != self._tree_source:
+      self._tree = DecodeContent(content)
+      self._tree_source = content
+    return self._tree
+
+  def SetTree(self, roots):
+    """Replace the order content; it is encoded on the next FlushTree
+
+    That is when the session commits, so a request changing the tree in
+    several steps encodes it once however often the session flushes.
+    """
+    if not isinstance(roots, ContentTree):
+      roots = ContentTree(roots)
+    self._tree = roots
+    self._tree_dirty = True
+
+  def FlushTree(self):
+    """Encode pending tree changes into content"""
+    if not self._tree_dirty:
+      return
+    self._tree_dirty = False
+    self._tree_source = EncodeContent(self._tree)
+    self.content = self._tree_source
+
+  def _CheckEditable(self):
+    """Raise RuntimeError if the order is saved and no longer CREATED
+
+    Only unpaid orders hold stock, so paid ones must not change.
+    """
+    if self.id is not None and self.status not in (None, OrderStatus.CREATED):
+      raise RuntimeError("Order %d is already paid" % self.id)
+
   def AddIG(self, path, items, numbers):
     """fulfill an ingredient group of an existing item in the order"""
-    content = json.loads(self.content)
-    fids = path.split('.')
-    root_id = int(fids[0])
-    node = ItemNode.FromDict(content[root_id])
-    content[root_id] = node
-    coefficient = 1
-    for fid in fids[1:]:
-      if node.type == "item":
-        coefficient *= node.num
-      node = node.GetChild(int(fid))
-    self.price += node.SetItems(items, numbers, coefficient)
-    self.content = json.dumps(content)
+    self._CheckEditable()
+    content = self.GetTree()
+    node, _, coefficient = content.Resolve(path)
+    if node.type != "ig":
+      raise ValueError("Invalid ingredient group path %s" % path)
+    # build the queue, if it must be, before the node is fulfilled
+    content.GetPending()
+    price_cents = node.SetItems(items, numbers, coefficient)
+    try:
+      self._HoldStock([node], coefficient)
+      content.ReplacePending(path, node)
+    except (RuntimeError, ValueError):
+      # the caller rolls back the holds
+      node.children = []
+      node.fulfilled = False
+      raise
+    self.price_cents += price_cents
+    self.SetTree(content)
+    ITEMS_ADDED.Inc(sum(n for n in numbers if n > 0), kind="ingredient")
 
   def AddRootItem(self, item_id, num):
     """add a new root item to the order"""
-    item = Item.query.get(item_id)
+    self._CheckEditable()
+    item = GetCatalog().GetItem(item_id)
     if item is None:
-      raise ValueError('Item doesn\'t exist!' % item_id)
-    if not item.HasEnoughStock(num):
-      raise RuntimeError('We don\'t have enough stock for %s' % item.GetName())
-    if self.content is None:
-      content = []
-    else:
-      content = json.loads(self.content)
-    if self.price is None:
-      self.price = 0
+      raise ValueError('Item %d doesn\'t exist!' % item_id)
     if item.CanShareIdenticalIG():
-      node = ItemNode.FromItem(item, num)
-      self.price += node.price
-      content.append(node)
+      nodes = [ItemNode.FromItem(item, num)]
     else:
-      for _ in range(num):
-        node = ItemNode.FromItem(item, 1)
-        self.price += node.price
-        content.append(node)
-    self.content = json.dumps(content)
+      nodes = [ItemNode.FromItem(item, 1) for _ in range(num)]
+    if item.stock_id is not None:
+      requirements = {item.stock_id: num * item.stock_unit}
+      if Stock.FindShortage(requirements,
+                            Stock.LoadMany(requirements)) is not None:
+        raise RuntimeError(
+            'We don\'t have enough stock for %s' % item.GetName())
+    content = self.GetTree()
+    if self.price_cents is None:
+      self.price_cents = 0
+    self._HoldStock(nodes)
+    for node in nodes:
+      self.price_cents += node.price_cents
+      content.AppendRoot(node)
+    self.SetTree(content)
+    ITEMS_ADDED.Inc(num, kind="root")
+
+  def AddConfiguredItem(self, item_id, config, quantity):
+    """Add quantity root items configured with the same choices
+
+    config maps the path of each ingredient group relative to the item, e.g.
+    "0" for its first group and "0.1.0" for the first group of the second
+    item chosen there, to a pair of lists (item ids, numbers) as taken by
+    AddIG. The configuration is validated and priced once, stock is checked
+    for all items at once, and the content is written once.
+    Returns the price added in cents.
+    """
+    self._CheckEditable()
+    if quantity <= 0:
+      raise ValueError("Quantity must be positive")
+    catalog = GetCatalog()
+    item = catalog.GetItem(item_id)
+    if item is None or not item.IsRoot():
+      raise ValueError('Item %d doesn\'t exist!' % item_id)
+    identical = item.CanShareIdenticalIG()
+    prototype = ItemNode.FromItem(item, quantity if identical else 1)
+    price_cents = prototype.price_cents
+    stocks = Stock.LoadMany(
+        catalog.GetStockIDs([item_id] +
+                            [i for items, _ in config.values() for i in items]))
+    build = ContentTree([prototype])
+    unused = set(config)
+    while build.GetPending():
+      path = build.GetPending()[0]
+      node, _, coefficient = build.Resolve(path)
+      if path[2:] not in config:
+        raise ValueError("Please choose %s" % node.name)
+      items, numbers = config[path[2:]]
+      if len(items) != len(numbers):
+        raise ValueError("Each item needs a number")
+      price_cents += node.SetItems(items, numbers, coefficient, stocks)
+      build.ReplacePending(path, node)
+      unused.discard(path[2:])
+    if unused:
+      raise ValueError("Unknown ingredient group %s" % min(unused))
+
+    nodes = [prototype]
+    if not identical:
+      nodes += [prototype.Copy() for _ in range(quantity - 1)]
+      price_cents *= quantity
+    requirements = {}
+    for node in nodes:
+      node.AddStockRequirements(requirements, catalog)
+    shortage = Stock.FindShortage(requirements, stocks)
+    if shortage is not None:
+      raise RuntimeError(
+          'We don\'t have enough stock for %s' % shortage.GetName())
+    content = self.GetTree()
+    if self.price_cents is None:
+      self.price_cents = 0
+    self._HoldStock(nodes)
+    for node in nodes:
+      content.AppendRoot(node)
+    self.price_cents += price_cents
+    self.SetTree(content)
+    ITEMS_ADDED.Inc(quantity, kind="root")
+    return price_cents
+
+  def _HoldStock(self, nodes, coefficient=1):
+    """Reserve stock used by newly added nodes of a saved order"""
+    if self.id is None:
+      return
+    catalog = GetCatalog()
+    requirements = {}
+    for node in nodes:
+      node.AddStockRequirements(requirements, catalog, coefficient)
+    StockReservation.Hold(self.id, requirements)
 
   def GetDetailsString(self):
     """Return the details string of the order.
     """
-    content = json.loads(self.content)
     details = ""
-    for item in content:
-      details += ItemNode.FromDict(item).GetDetailsString()
-    if self.price is None:
-      self.price = 0
-    details += "\n\nTotal price: $%.2f" % self.price
+    for item in self.GetTree():
+      details += item.GetDetailsString()
+    if self.price_cents is None:
+      self.price_cents = 0
+    details += "\n\nTotal price: $%s" % FormatCents(self.price_cents)
     return details
 
   def GetUnfulfilledIGDetails(self):
-    content = json.loads(self.content)
-    for idx, item in enumerate(content):
-      ret = ItemNode.FromDict(item).GetUnfulfilledIGDetails(
-          str(idx), item["name"])
+    """Return the path, item name and id of the next group to fill in
+
+    Reads the head of the pending queue kept with the content, so it doesn't
+    depend on the size of the order. None if the order is complete.
+    """
+    content = self.GetTree()
+    for path in content.GetPending():
+      try:
+        node, item_name, _ = content.Resolve(path)
+      except ValueError:
+        continue
+      # skip entries left behind by a group filled in out of order
+      if node.type == "ig" and not node.fulfilled:
+        return {"path": path, "item_name": item_name, "id": node.id}
+    return None
+
+  def FindUnfulfilledIGDetails(self):
+    """Like GetUnfulfilledIGDetails but walks the whole tree"""
+    for idx, item in enumerate(self.GetTree()):
+      ret = item.GetUnfulfilledIGDetails(str(idx), item.name)
       if ret is not None:
         return ret
     return None
 
+  def GetLines(self):
+    """Return the item lines of the order, see FlattenTree"""
+    return list(FlattenTree(self.GetTree()))
+
   def DeductStock(self):
-    content = json.loads(self.content)
-    for item in content:
-      ItemNode.FromDict(item).DeductStock()
+    """Deduct stock used by the order from loaded Stocks without saving
+
+    Use Pay to take stock safely.
+    """
+    requirements = self.ComputeStockRequirements()
+    stocks = Stock.LoadMany(requirements)
+    for stock_id in sorted(requirements):
+      stocks[stock_id].DecreaseAmount(requirements[stock_id])
+
+  def ComputeStockRequirements(self):
+    """Return a dict of stock id to the amount used by the whole order
+
+    Stock shared by several nodes is summed, so callers touch each stock
+    row once however large the order is.
+    """
+    catalog = GetCatalog()
+    requirements = {}
+    for item in self.GetTree():
+      item.AddStockRequirements(requirements, catalog)
+    return requirements
 
   def Pay(self):
-    if self.GetUnfulfilledIGDetails() is not None:
-      raise RuntimeError("Ingredient group configuration is not complete")
-    content = json.loads(self.content)
-    for item in content:
-      ItemNode.FromDict(item).DeductStock()
-    self.status = OrderStatus.PAID
+    """Take stock for the order and mark it as paid
+
+    Stock held by the order is released and the whole order is then taken
+    with conditional UPDATEs in the current transaction, so the caller must
+    commit on success and roll back on failure. The order lines and the
+    sales facts are written in the same transaction, the sales rollups are
+    updated from the facts later by FoldSales.
+    """
+    try:
+      if self.FindUnfulfilledIGDetails() is not None:
+        raise RuntimeError("Ingredient group configuration is not complete")
+      self._MarkPaid()
+      if self.id is not None:
+        StockReservation.Release(self.id)
+      Stock.DecreaseMany(self.ComputeStockRequirements())
+    except (RuntimeError, ValueError) as e:
+      CHECKOUTS.Inc(result="failure", reason=type(e).__name__)
+      raise
+    lines = self.GetLines()
+    if self.id is not None:
+      OrderLine.Write(self.id, lines)
+      RecordSale(self.id, self.price_cents, lines, datetime.now())
+    CHECKOUTS.Inc(result="success", reason="")
+
+  def _MarkPaid(self):
+    """Move the order from CREATED to PAID, raising RuntimeError otherwise
+
+    Saved orders change status with a conditional UPDATE, so of concurrent
+    checkouts of one order only the first one goes on to take stock.
+    """
+    if self.id is None:
+      if self.status not in (None, OrderStatus.CREATED):
+        raise RuntimeError("Order is already paid")
+      self.status = OrderStatus.PAID
+      return
+    table = Order.__table__
+    result = db.session.execute(table.update().where(
+        table.c.id == self.id).where(
+            table.c.status == OrderStatus.CREATED).values(
+                status=OrderStatus.PAID))
+    if result.rowcount != 1:
+      raise RuntimeError("Order is already paid")
+    set_committed_value(self, 'status', OrderStatus.PAID)
+    db.session.expire(self, ['updated_at'])
+
+  @staticmethod
+  def SumPriceCents(*criteria):
+    """Return the exact total price in cents of orders matching criteria
+
+    The sum is done by the database, e.g.
+    Order.SumPriceCents(Order.status == OrderStatus.PAID)
+    """
+    return db.session.query(db.func.coalesce(
+        db.func.sum(Order.price_cents), 0)).filter(*criteria).scalar()
+
+  @staticmethod
+  def GetPage(status, page_size, after=None):
+    """Return a page of orders with the given status, most recent first
+
+    Pages are keyed on (updated_at, id) so each one costs the same however
+    deep it is. after is the cursor of the previous page, None for the first
+    one. Returns the orders, with their users loaded, and the cursor of the
+    next page or None if this is the last one.
+    """
+    query = Order.query.options(db.joinedload(Order.user)).filter(
+        Order.status == status)
+    if after is not None:
+      updated_at, oid = DecodeCursor(after)
+      # The redundant <= bound lets the index seek to the cursor.
+      query = query.filter(Order.updated_at <= updated_at,
+                           db.or_(Order.updated_at < updated_at,
+                                  Order.id < oid))
+    orders = query.order_by(Order.updated_at.desc(),
+                            Order.id.desc()).limit(page_size + 1).all()
+    if len(orders) <= page_size:
+      return orders, None
+    orders = orders[:page_size]
+    return orders, EncodeCursor(orders[-1])
+
+  @staticmethod
+  def ExpireReservations(cutoff):
+    """Release stock held by unpaid orders not updated since cutoff
+
+    Each order is checked again with a conditional UPDATE when it's
+    released, which also locks it against a concurrent checkout. Returns
+    the number of orders released.
+    """
+    order_ids = [
+        row.order_id for row in db.session.query(StockReservation.order_id)
+        .join(Order, Order.id == StockReservation.order_id).filter(
+            Order.status == OrderStatus.CREATED,
+            Order.updated_at < cutoff).distinct()
+    ]
+    table = Order.__table__
+    count = 0
+    for order_id in order_ids:
+      result = db.session.execute(table.update().where(
+          table.c.id == order_id).where(
+              table.c.status == OrderStatus.CREATED).where(
+                  table.c.updated_at < cutoff).values(
+                      updated_at=table.c.updated_at))
+      if result.rowcount == 1 and StockReservation.Release(order_id):
+        count += 1
+    return count
+
+
+class OrderLine(db.Model):
+  """An item line of a paid order, see FlattenTree
+
+  Lines mirror Order.content in indexed columns so questions such as how
+  many of an item were sold, or which orders contain it, are answered in
+  SQL. They are written by Order.Pay.
+  """
+  id = db.Column(db.Integer, primary_key=True)
+  order_id = db.Column(db.Integer, db.ForeignKey('order.id'), index=True)
+  path = db.Column(db.String(255))
+  item_id = db.Column(db.Integer, db.ForeignKey('item.id'))
+  ig_id = db.Column(db.Integer, db.ForeignKey('ingredient_group.id'))
+  quantity = db.Column(db.Integer)
+  unit_price_cents = db.Column(db.Integer)
+  price_cents = db.Column(db.Integer)
+  stock_id = db.Column(db.Integer, db.ForeignKey('stock.id'))
+  stock_amount = db.Column(db.Integer, default=0)
+
+  __table_args__ = (db.Index('ix_order_line_item_id_order_id', 'item_id',
+                             'order_id'),)
+
+  @staticmethod
+  def Write(order_id, lines, catalog=None):
+    """Replace the lines of an order with lines from FlattenTree"""
+    if catalog is None:
+      catalog = GetCatalog()
+    table = OrderLine.__table__
+    db.session.execute(table.delete().where(table.c.order_id == order_id))
+    rows = []
+    for line in lines:
+      item = catalog.GetItem(line["item_id"])
+      stock_id = item.stock_id if item is not None else None
+      rows.append({
+          "order_id": order_id,
+          "path": line["path"],
+          "item_id": line["item_id"],
+          "ig_id": line["ig_id"],
+          "quantity": line["quantity"],
+          "unit_price_cents": line["price_cents"] // max(line["quantity"], 1),
+          "price_cents": line["price_cents"],
+          "stock_id": stock_id,
+          "stock_amount": item.stock_unit * line["quantity"]
+                          if stock_id is not None else 0,
+      })
+    if rows:
+      db.session.execute(table.insert(), rows)
+
+  @staticmethod
+  def SumQuantity(item_id, *criteria):
+    """Return the quantity of an item in paid orders matching criteria"""
+    return db.session.query(db.func.coalesce(
+        db.func.sum(OrderLine.quantity), 0)).filter(
+            OrderLine.item_id == item_id, *criteria).scalar()
+
+  @staticmethod
+  def FindOrderIDs(item_id):
+    """Return the ids of paid orders containing an item, in id order"""
+    return [
+        row.order_id for row in db.session.query(OrderLine.order_id).filter(
+            OrderLine.item_id == item_id).distinct().order_by(
+                OrderLine.order_id)
+    ]
+
+
+@event.listens_for(Order.content, 'set')
+def _OnContentSet(target, value, oldvalue, initiator):  # pylint: disable=unused-argument
+  """Drop pending tree changes when content is assigned directly"""
+  if target._tree_dirty:  # pylint: disable=protected-access
+    target._tree = None  # pylint: disable=protected-access
+    target._tree_dirty = False  # pylint: disable=protected-access
+
+
+@event.listens_for(Session, 'before_flush')
+def _OnBeforeFlush(session, flush_context, instances):  # pylint: disable=unused-argument
+  # new orders are inserted with their content, saved ones wait for commit
+  for obj in session.new:
+    if isinstance(obj, Order):
+      obj.FlushTree()
 
 
-class OrderNode(dict):
-  """A node structure in order content"""
+@event.listens_for(Session, 'before_commit')
+def _OnBeforeCommit(session):
+  if session.transaction is not None and session.transaction.nested:
+    return  # releasing a savepoint, the transaction goes on
+  for obj in list(session.identity_map.values()) + list(session.new):
+    if isinstance(obj, Order):
+      obj.FlushTree()
 
-  def __init__(self, Type, Id, name):
-    super().__init__()
-    self.__dict__ = self
+
+@event.listens_for(Session, 'after_rollback')
+def _OnAfterRollback(session):
+  """Drop tree changes of orders whose content was rolled back"""
+  for obj in session.identity_map.values():
+    if isinstance(obj, Order) and obj._tree_dirty:  # pylint: disable=protected-access
+      obj._tree = None  # pylint: disable=protected-access
+      obj._tree_dirty = False  # pylint: disable=protected-access
+
+
+class OrderNode:
+  """A node structure in order content
+
+  Nodes use __slots__ as orders can hold thousands of them. Use ToDict and
+  FromDict to convert them to and from plain dicts.
+  """
+
+  __slots__ = ('id', 'name', 'children')
+  type = None
+
+  def __init__(self, Id, name):
     self.name = name
     self.id = Id
-    self.type = Type
     self.children = []
 
+  def ToDict(self):
+    """Return this node and its children as nested plain dicts
+
+    This is the version 1 content format, read back by FromDict.
+    """
+    return {
+        "name": self.name,
+        "id": self.id,
+        "type": self.type,
+        "children": [child.ToDict() for child in self.children],
+    }
+
   def AddChild(self, child):
     self.children.append(child)
 
@@ -158,6 +564,28 @@ class OrderNode(dict):
   def GetType(self):
     return self.type
 
+  def Walk(self):
+    """Iterate over this node and all its descendants in pre-order"""
+    stack = [self]
+    while stack:
+      node = stack.pop()
+      yield node
+      stack.extend(reversed(node.children))
+
+  def DeductStock(self, coefficient=1, stocks=None, catalog=None):
+    """Deduct stock used by this node and its children from loaded Stocks
+
+    stocks maps stock ids to Stocks preloaded by Stock.LoadMany.
+    """
+    if catalog is None:
+      catalog = GetCatalog()
+    requirements = {}
+    self.AddStockRequirements(requirements, catalog, coefficient)
+    if stocks is None:
+      stocks = Stock.LoadMany(requirements)
+    for stock_id in sorted(requirements):
+      stocks[stock_id].DecreaseAmount(requirements[stock_id])
+
   def GetUnfulfilledIGDetails(self, path, item_name):
     for idx, child in enumerate(self.children):
       if self.type == "item":
@@ -171,62 +599,90 @@ class OrderNode(dict):
 class ItemNode(OrderNode):
   """A node structure representing an item in order content"""
 
+  __slots__ = ('num', 'price_cents')
+  type = "item"
+
   @staticmethod
   def FromDict(dict_):
     """ Recursively (re)construct ItemNode-based tree from dictionary. """
-    root = ItemNode(dict_['id'], dict_['name'], dict_['num'], dict_['price'])
+    if 'price_cents' in dict_:
+      price_cents = dict_['price_cents']
+    else:
+      price_cents = ToCents(dict_['price'])
+    root = ItemNode(dict_['id'], dict_['name'], dict_['num'], price_cents)
     root.children = list(map(IGNode.FromDict, dict_['children']))
     return root
 
   @staticmethod
   def FromItem(item, number, coefficient=1):
+    """Build an item node and empty ig nodes from a CatalogItem"""
     if item.GetMaxItem() is not None and number > item.GetMaxItem():
       raise ValueError(
           'Number of %s can\'t exceed %d' % (item.name, item.max_item))
     ret = ItemNode(item.GetID(), item.GetName(), number,
-                   item.GetPrice() * number * coefficient)
+                   item.GetPriceCents() * number * coefficient)
     for ig in item.ingredientgroups:
       ret.AddChild(IGNode.FromIG(ig))
     return ret
 
-  def __init__(self, Id, name, num, price):
-    super().__init__("item", Id, name)
+  def __init__(self, Id, name, num, price_cents):
+    super().__init__(Id, name)
     self.num = num
-    self.price = price
+    self.price_cents = price_cents
+
+  def ToDict(self):
+    ret = super().ToDict()
+    ret["num"] = self.num
+    ret["price_cents"] = self.price_cents
+    return ret
+
+  def Copy(self):
+    """Return a deep copy of this node"""
+    ret = ItemNode(self.id, self.name, self.num, self.price_cents)
+    ret.children = [child.Copy() for child in self.children]
+    return ret
 
   def GetNum(self):
     return self.num
 
   def GetPrice(self):
-    return self.price
+    return self.price_cents / 100
+
+  def GetPriceCents(self):
+    return self.price_cents
 
   def GetDetailsString(self, prefix=""):
     """Recursively get the details string for an order item node
     for invoice and order details"""
     ret = "%s%s%s%s\n" % (
         prefix, self.name, "*%d" % self.num if self.num > 1 else "",
-        " ......$%.2f" % self.price if self.price != 0 else "")
+        " ......$%s" % FormatCents(self.price_cents)
+        if self.price_cents != 0 else "")
 
     prefix = (len(prefix) - len(prefix.lstrip()) + 2) * " "
     for child in self.children:
       ret += child.GetDetailsString(prefix)
     return ret
 
-  def DeductStock(self, coefficient=1):
-    item = Item.query.get(self.id)
-    try:
-      if item.stock is not None:
-        item.stock.DecreaseAmount(item.stock_unit * self.num * coefficient)
-    except RuntimeError:
-      raise RuntimeError("Stock not enough for %s" % self.name)
+  def AddStockRequirements(self, requirements, catalog, coefficient=1):
+    """Add stock used by this node and its children to requirements"""
+    item = catalog.GetItem(self.id)
+    if item is None:
+      raise ValueError('Item %d doesn\'t exist!' % self.id)
+    if item.stock_id is not None:
+      requirements[item.stock_id] = requirements.get(
+          item.stock_id, 0) + item.stock_unit * self.num * coefficient
     coefficient *= self.num
     for child in self.children:
-      child.DeductStock(coefficient)
+      child.AddStockRequirements(requirements, catalog, coefficient)
 
 
 class IGNode(OrderNode):
   """A node structure representing an ig in order content"""
 
+  __slots__ = ('fulfilled',)
+  type = "ig"
+
   @staticmethod
   def FromDict(dict_):
     """ Recursively (re)construct IGNode-based tree from dictionary. """
@@ -241,65 +697,82 @@ class IGNode(OrderNode):
     return IGNode(ig.GetID(), ig.GetName())
 
   def __init__(self, Id, name):
-    super().__init__("ig", Id, name)
+    super().__init__(Id, name)
     self.fulfilled = False
 
+  def ToDict(self):
+    ret = super().ToDict()
+    ret["fulfilled"] = self.fulfilled
+    return ret
+
+  def Copy(self):
+    """Return a deep copy of this node"""
+    ret = IGNode(self.id, self.name)
+    ret.fulfilled = self.fulfilled
+    ret.children = [child.Copy() for child in self.children]
+    return ret
+
   def IsFulfilled(self):
     return self.fulfilled
 
   def SetFulfilled(self, ig=None):
     """Check whether an order node fulfills all requirements
-    for this ingredient group and then mark it as fulfilled"""
+    for this ingredient group and then mark it as fulfilled
+
+    ig is the CatalogGroup of this node, whose validator is used.
+    """
     if ig is not None:
-      options = len({x.id for x in self.children if x.num > 0})
-      items = reduce((lambda x, y: x + y.num), self.children, 0)
-      if ig.GetMinOption() is not None and options < ig.GetMinOption():
-        raise ValueError(
-            "At least %d different offerings must be selected from %s" %
-            (ig.GetMinOption(), self.name))
-      if ig.GetMaxOption() is not None and options > ig.GetMaxOption():
-        raise ValueError(
-            "At most %d different offerings can be selected from %s" %
-            (ig.GetMaxOption(), self.name))
-      if ig.GetMinItem() is not None and items < ig.GetMinItem():
-        raise ValueError("At least %d items must be chosen in %s" %
-                         (ig.GetMinItem(), self.name))
-      if ig.GetMaxItem() is not None and items > ig.GetMaxItem():
-        raise ValueError("At most %d items can be chosen in %s" %
-                         (ig.GetMaxItem(), self.name))
+      ig.GetValidator().CheckFulfilled(self.children)
     self.fulfilled = True
 
-  def SetItems(self, items, numbers, coefficient=1):
+  def SetItems(self, items, numbers, coefficient=1, stocks=None):
     """Set customer's choice for items within this ig in an order
-    Returns added price
+    Returns added price in cents
+
+    stocks maps stock ids to Stocks preloaded by Stock.LoadMany, they are
+    loaded here in a single query if not given.
     """
 
-    price = 0
+    price_cents = 0
     if self.fulfilled:
       raise RuntimeError('Cannot fulfill %s twice' % self.name)
-    ig = IngredientGroup.query.get(self.id)
+    catalog = GetCatalog()
+    ig = catalog.GetGroup(self.id)
     if ig is None:
       raise ValueError('Cannot find IngredientGroup')
-    for i, item_id in enumerate(items):
-      if numbers[i] <= 0:
-        continue
-      item = Item.query.get(item_id)
-      if item is None:
-        raise ValueError('Item doesn\'t exist!' % item_id)
-      if not item.HasEnoughStock(numbers[i] * coefficient):
-        raise RuntimeError(
-            'We don\'t have enough stock for %s' % item.GetName())
-      if item.CanShareIdenticalIG():
-        node = ItemNode.FromItem(item, numbers[i], coefficient)
-        price += node.price
-        self.AddChild(node)
-      else:
-        for _ in range(numbers[i]):
-          node = ItemNode.FromItem(item, 1, coefficient)
-          price += node.price
+    if stocks is None:
+      stocks = Stock.LoadMany(
+          catalog.GetStockIDs(
+              item_id for i, item_id in enumerate(items) if numbers[i] > 0))
+    validator = ig.GetValidator()
+    try:
+      for i, item_id in enumerate(items):
+        if numbers[i] <= 0:
+          continue
+        validator.CheckChoice(item_id, numbers[i])
+        item = catalog.GetItem(item_id)
+        if item.CanShareIdenticalIG():
+          node = ItemNode.FromItem(item, numbers[i], coefficient)
+          price_cents += node.price_cents
           self.AddChild(node)
-    self.SetFulfilled(ig)
-    return price
+        else:
+          for _ in range(numbers[i]):
+            node = ItemNode.FromItem(item, 1, coefficient)
+            price_cents += node.price_cents
+            self.AddChild(node)
+      # items sharing a stock are checked together
+      requirements = {}
+      self.AddStockRequirements(requirements, catalog, coefficient)
+      shortage = Stock.FindShortage(requirements, stocks)
+      if shortage is not None:
+        raise RuntimeError(
+            'We don\'t have enough stock for %s' % shortage.GetName())
+      self.SetFulfilled(ig)
+    except (ValueError, RuntimeError):
+      # leave the node untouched so a cached order tree stays consistent
+      self.children = []
+      raise
+    return price_cents
 
   def GetDetailsString(self, prefix=""):
     """Recursively get the details string for an order ig node
@@ -315,6 +788,193 @@ class IGNode(OrderNode):
       return {"path": path, "item_name": item_name, "id": self.id}
     return super().GetUnfulfilledIGDetails(path, item_name)
 
-  def DeductStock(self, coefficient):
+  def AddStockRequirements(self, requirements, catalog, coefficient):
     for child in self.children:
-      child.DeductStock(coefficient)
+      child.AddStockRequirements(requirements, catalog, coefficient)
+
+
+class ContentTree(list):
+  """List of root ItemNodes and the queue of groups to fill in
+
+  pending holds the paths of unfulfilled IGNodes in pre-order, which is
+  the order customers are asked for them, or None if it must be rebuilt
+  from the tree.
+  """
+
+  def __init__(self, roots=(), pending=None):
+    super().__init__(roots)
+    self.pending = pending
+
+  def GetPending(self):
+    if self.pending is None:
+      self.pending = []
+      for idx, root in enumerate(self):
+        self.pending.extend(FindPending(root, str(idx)))
+    return self.pending
+
+  def Resolve(self, path):
+    """Return the node at path, the name of its item and its coefficient
+
+    The coefficient is the product of the numbers of the items above it.
+    Raises ValueError unless path is a canonical path of an existing node,
+    e.g. "0.1" but not "00.1" or "-1.1".
+    """
+    fids = path.split('.')
+    if not all(fid.isdigit() and fid == str(int(fid)) for fid in fids):
+      raise ValueError("Invalid path %s" % path)
+    try:
+      node = self[int(fids[0])]
+      item_name = node.name
+      coefficient = 1
+      for fid in fids[1:]:
+        if node.type == "item":
+          coefficient *= node.num
+          item_name = node.name
+        node = node.GetChild(int(fid))
+    except IndexError:
+      raise ValueError("Invalid path %s" % path) from None
+    return node, item_name, coefficient
+
+  def AppendRoot(self, node):
+    pending = self.GetPending()
+    self.append(node)
+    pending.extend(FindPending(node, str(len(self) - 1)))
+
+  def ReplacePending(self, path, node):
+    """Queue the groups below node, just fulfilled at path, in its place"""
+    pending = self.GetPending()
+    if path not in pending:
+      raise ValueError("%s is not waiting to be filled in" % path)
+    idx = pending.index(path)
+    pending[idx:idx + 1] = FindPending(node, path)
+
+
+def FindPending(node, path):
+  """Return the paths of unfulfilled groups at or below node in pre-order"""
+  pending = []
+  stack = [(node, path)]
+  while stack:
+    node, path = stack.pop()
+    if node.type == "ig" and not node.fulfilled:
+      pending.append(path)
+      continue
+    for idx in reversed(range(len(node.children))):
+      stack.append((node.children[idx], "%s.%d" % (path, idx)))
+  return pending
+
+
+def FlattenTree(roots):
+  """Yield one line per item node of an order tree in pre-order
+
+  Each line is a dict of the item's path, id and name, the id and name of
+  the group it was chosen in (None for root items), its total quantity in
+  the order, i.e. its number times those of the items above it, and its
+  price in cents, which already counts that quantity.
+  """
+  stack = [(root, str(idx), None, 1)
+           for idx, root in reversed(list(enumerate(roots)))]
+  while stack:
+    node, path, ig, coefficient = stack.pop()
+    if node.type == "item":
+      yield {
+          "path": path,
+          "item_id": node.id,
+          "item_name": node.name,
+          "ig_id": ig.id if ig is not None else None,
+          "ig_name": ig.name if ig is not None else None,
+          "quantity": node.num * coefficient,
+          "price_cents": node.price_cents,
+      }
+      group, coefficient = None, coefficient * node.num
+    else:
+      group = node
+    for idx in reversed(range(len(node.children))):
+      stack.append((node.children[idx], "%s.%d" % (path, idx), group,
+                    coefficient))
+
+
+def EncodeContent(roots):
+  """Encode a list of root ItemNodes as a compact flat node table
+
+  Nodes are written in pre-order, one array per node, each ending with its
+  number of children so the tree can be rebuilt in a single linear pass:
+    item: [id, name, num, price_cents, nchildren]
+    ig:   [id, name, fulfilled, nchildren]
+  The table is prefixed by CONTENT_VERSION, the number of roots and the
+  paths of pending groups, rebuilt from the tree if roots is a plain list.
+  """
+  if not isinstance(roots, ContentTree):
+    roots = ContentTree(roots)
+  table = [CONTENT_VERSION, len(roots), roots.GetPending()]
+  stack = list(reversed(roots))
+  while stack:
+    node = stack.pop()
+    if node.type == "item":
+      table.append(
+          [node.id, node.name, node.num, node.price_cents,
+           len(node.children)])
+    else:
+      table.append(
+          [node.id, node.name, 1 if node.fulfilled else 0,
+           len(node.children)])
+    stack.extend(reversed(node.children))
+  return json.dumps(table, separators=(',', ':'))
+
+
+def DecodeContent(content):
+  """Decode Order.content into a ContentTree of root ItemNodes
+
+  Accepts the current flat node table as well as older versions, so legacy
+  rows are migrated transparently the next time the order is saved.
+  """
+  if not content:
+    return ContentTree()
+  table = json.loads(content)
+  if not table:
+    return ContentTree()
+  if isinstance(table[0], dict):
+    return ContentTree(map(ItemNode.FromDict, table))
+  if table[0] not in (2, 3, CONTENT_VERSION):
+    raise ValueError("Unknown order content version %r" % table[0])
+
+  if table[0] == CONTENT_VERSION:
+    roots = ContentTree(pending=table[2])
+    rows = table[3:]
+  else:
+    roots = ContentTree()
+    rows = table[2:]
+  # each frame is [node, children still to be read]
+  stack = [[None, table[1]]]
+  for row in rows:
+    frame = stack[-1]
+    while frame[1] == 0:
+      stack.pop()
+      frame = stack[-1]
+    frame[1] -= 1
+    if frame[0] is None or frame[0].type == "ig":
+      price_cents = ToCents(row[3]) if table[0] == 2 else row[3]
+      node = ItemNode(row[0], row[1], row[2], price_cents)
+    else:
+      node = IGNode(row[0], row[1])
+      node.fulfilled = bool(row[2])
+    if frame[0] is None:
+      roots.append(node)
+    else:
+      frame[0].children.append(node)
+    if row[-1]:
+      stack.append([node, row[-1]])
+  return roots
+
+
+def EncodeCursor(order):
+  """Encode the page position just after order as an opaque string"""
+  return "%s_%d" % (order.updated_at.strftime(CURSOR_TIME_FORMAT), order.id)
+
+
+def DecodeCursor(cursor):
+  """Return the (updated_at, id) encoded by EncodeCursor
+
+  Raises ValueError on a malformed cursor.
+  """
+  timestamp, _, oid = cursor.rpartition("_")
+  return datetime.strptime(timestamp, CURSOR_TIME_FORMAT), int(oid)
@@ -0,0 +1,185 @@
+"""Rollup module
+
+Sales analytics derived from paid orders, so reports never decode
+Order.content. Paying an order only appends facts: one OrderFact and one
+SalesFact per item line. FoldSales later adds the facts not yet folded to
+the SalesRollup and ItemRollup rows of their hour and day, outside of the
+checkout transaction, so checkouts never wait on the shared rollup rows.
+Reports read the rollups only, so their cost depends on the number of
+buckets shown rather than on the number of orders.
+"""
+
+from sqlalchemy.exc import IntegrityError
+from . import db
+
+PERIODS = ("hour", "day")
+
+
+class SalesFact(db.Model):
+  """An item line of a paid order, never updated"""
+  id = db.Column(db.Integer, primary_key=True)
+  order_id = db.Column(db.Integer, db.ForeignKey('order.id'), index=True)
+  item_id = db.Column(db.Integer, db.ForeignKey('item.id'))
+  quantity = db.Column(db.Integer)
+  price_cents = db.Column(db.Integer)
+  hour = db.Column(db.DateTime, index=True)
+
+
+class OrderFact(db.Model):
+  """A paid order, folded into the rollups once"""
+  order_id = db.Column(db.Integer, db.ForeignKey('order.id'), primary_key=True)
+  price_cents = db.Column(db.Integer)
+  hour = db.Column(db.DateTime)
+  folded = db.Column(db.Boolean, default=False, index=True)
+
+
+class SalesRollup(db.Model):
+  """Number of orders paid and their revenue in an hour or a day"""
+  period = db.Column(db.String(4), primary_key=True)
+  bucket = db.Column(db.DateTime, primary_key=True)
+  orders = db.Column(db.Integer, default=0)
+  revenue_cents = db.Column(db.Integer, default=0)
+
+  def GetAverageCents(self):
+    """Return the average basket in cents"""
+    return self.revenue_cents // self.orders if self.orders else 0
+
+
+class ItemRollup(db.Model):
+  """Quantity and revenue of an item sold in an hour or a day"""
+  period = db.Column(db.String(4), primary_key=True)
+  bucket = db.Column(db.DateTime, primary_key=True)
+  item_id = db.Column(db.Integer, db.ForeignKey('item.id'), primary_key=True)
+  quantity = db.Column(db.Integer, default=0)
+  revenue_cents = db.Column(db.Integer, default=0)
+
+
+def Bucket(period, when):
+  """Return the start of the hour or day containing when"""
+  if period == "hour":
+    return when.replace(minute=0, second=0, microsecond=0)
+  return when.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _Add(table, key, **amounts):
+  """Add amounts to the rollup row with the given key, creating it
+
+  A concurrent fold may create the row first, the insert is then undone
+  with its savepoint and the amounts are added to that row.
+  """
+  clause = db.and_(*(table.c[name] == value for name, value in key.items()))
+  update = table.update().where(clause).values(
+      {table.c[name]: table.c[name] + value for name, value in amounts.items()})
+  if db.session.execute(update).rowcount:
+    return
+  try:
+    with db.session.begin_nested():
+      db.session.execute(table.insert().values(dict(key, **amounts)))
+  except IntegrityError:
+    db.session.execute(update)
+
+
+def RecordSale(order_id, price_cents, lines, when):
+  """Append the facts of a paid order in the current transaction
+
+  lines are the item lines of the order as given by FlattenTree. Only new
+  rows are inserted, the rollups are updated by FoldSales.
+  """
+  hour = Bucket("hour", when)
+  db.session.execute(OrderFact.__table__.insert().values(
+      order_id=order_id, price_cents=price_cents or 0, hour=hour,
+      folded=False))
+  rows = [{
+      "order_id": order_id,
+      "item_id": line["item_id"],
+      "quantity": line["quantity"],
+      "price_cents": line["price_cents"],
+      "hour": hour,
+  } for line in lines]
+  if rows:
+    db.session.execute(SalesFact.__table__.insert(), rows)
+
+
+def FoldSales(limit=1000):
+  """Add up to limit unfolded orders to the rollups
+
+  Runs in the current transaction, which the caller commits. Each order is
+  first claimed with a conditional UPDATE of its folded flag and only the
+  orders claimed are folded, so concurrent folds never count one twice.
+  Returns the number of orders folded, 0 once everything is folded.
+  """
+  table = OrderFact.__table__
+  unfolded = table.c.folded == db.false()
+  candidates = db.session.execute(
+      db.select([table.c.order_id]).where(unfolded).order_by(
+          table.c.order_id).limit(limit)).fetchall()
+  claimed = []
+  for row in candidates:
+    claim = table.update().where(table.c.order_id == row.order_id).where(
+        unfolded).values(folded=True)
+    if db.session.execute(claim).rowcount == 1:
+      claimed.append(row.order_id)
+  if not claimed:
+    return 0
+  facts = OrderFact.query.filter(OrderFact.order_id.in_(claimed)).all()
+  hours = {fact.order_id: fact.hour for fact in facts}
+  lines = SalesFact.query.filter(SalesFact.order_id.in_(claimed)).all()
+  sales = {}
+  items = {}
+  for period in PERIODS:
+    for fact in facts:
+      totals = sales.setdefault((period, Bucket(period, fact.hour)), [0, 0])
+      totals[0] += 1
+      totals[1] += fact.price_cents
+    for line in lines:
+      totals = items.setdefault(
+          (period, Bucket(period, hours[line.order_id]), line.item_id), [0, 0])
+      totals[0] += line.quantity
+      totals[1] += line.price_cents
+  for (period, bucket), (orders, revenue) in sorted(sales.items()):
+    _Add(SalesRollup.__table__, {"period": period, "bucket": bucket},
+         orders=orders, revenue_cents=revenue)
+  for (period, bucket, item_id), (quantity, revenue) in sorted(items.items()):
+    _Add(ItemRollup.__table__, {
+        "period": period,
+        "bucket": bucket,
+        "item_id": item_id
+    }, quantity=quantity, revenue_cents=revenue)
+  return len(claimed)
+
+
+def GetUnfolded():
+  """Return the number of orders not folded yet and the oldest one's hour"""
+  return db.session.query(
+      db.func.count(OrderFact.order_id), db.func.min(OrderFact.hour)).filter(
+          OrderFact.folded == db.false()).one()
+
+
+def GetSales(period, start, end):
+  """Return the SalesRollups of period with buckets in [start, end)"""
+  return SalesRollup.query.filter(
+      SalesRollup.period == period, SalesRollup.bucket >= start,
+      SalesRollup.bucket < end).order_by(SalesRollup.bucket).all()
+
+
+def GetTotalSales():
+  """Return the number of orders and revenue in cents of all days"""
+  orders, revenue = db.session.query(
+      db.func.sum(SalesRollup.orders),
+      db.func.sum(SalesRollup.revenue_cents)).filter(
+          SalesRollup.period == "day").one()
+  return orders or 0, revenue or 0
+
+
+def GetTopItems(start, end, limit=10):
+  """Return (item id, quantity, revenue in cents) of the best sellers
+
+  Items are summed over the daily rollups of [start, end).
+  """
+  quantity = db.func.sum(ItemRollup.quantity)
+  return db.session.query(
+      ItemRollup.item_id, quantity,
+      db.func.sum(ItemRollup.revenue_cents)).filter(
+          ItemRollup.period == "day", ItemRollup.bucket >= start,
+          ItemRollup.bucket < end).group_by(ItemRollup.item_id).order_by(
+              quantity.desc(), ItemRollup.item_id).limit(limit).all()
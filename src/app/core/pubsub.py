@@ -0,0 +1,71 @@
+"""Publish/subscribe module
+
+The hub used by the app is picked by the PUBSUB_HUB setting, an import path
+to a class taking the app. LocalHub only reaches subscribers of the same
+process; a hub backed by a broker needs the same Subscribe/Publish methods.
+"""
+
+import queue
+import threading
+
+
+class Subscription:
+  """Queue of messages published on one channel since subscribing"""
+
+  def __init__(self, hub, channel, maxsize):
+    self.hub = hub
+    self.channel = channel
+    self.messages = queue.Queue(maxsize)
+
+  def Get(self, timeout=None):
+    """Return the next message, or None if none arrives within timeout"""
+    try:
+      return self.messages.get(timeout=timeout)
+    except queue.Empty:
+      return None
+
+  def Put(self, message):
+    """Queue message, dropping it if the subscriber is too far behind"""
+    try:
+      self.messages.put_nowait(message)
+    except queue.Full:
+      pass
+
+  def Close(self):
+    self.hub.Unsubscribe(self)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.Close()
+
+
+class LocalHub:
+  """In-process hub delivering messages to subscribers' queues"""
+
+  def __init__(self, app):
+    self.maxsize = app.config.get('PUBSUB_QUEUE_SIZE', 100)
+    self.subscriptions = {}
+    self.lock = threading.Lock()
+
+  def Subscribe(self, channel):
+    subscription = Subscription(self, channel, self.maxsize)
+    with self.lock:
+      self.subscriptions.setdefault(channel, set()).add(subscription)
+    return subscription
+
+  def Unsubscribe(self, subscription):
+    with self.lock:
+      self.subscriptions.get(subscription.channel, set()).discard(subscription)
+
+  def Publish(self, channel, message):
+    """Send message to all current subscribers of channel
+
+    Returns the number of subscribers.
+    """
+    with self.lock:
+      subscriptions = list(self.subscriptions.get(channel, ()))
+    for subscription in subscriptions:
+      subscription.Put(message)
+    return len(subscriptions)
@@ -2,10 +2,45 @@
 
 # pylint: disable=unused-import
 
+from datetime import datetime, timedelta
+import os
+import threading
+import time
+from sqlalchemy.engine.url import make_url
+from werkzeug.utils import import_string
+from app.core import menu, migrations
 from app.core.models import db
 from app.core.models.user import User
-from app.core.models.order import Order
+from app.core.models.order import Order, OrderStatus, OrderLine
 from app.core.models.inventory import Item, IngredientGroup, Stock
+from app.core.models.catalog import CatalogVersion, GetCatalog
+from app.core.models.reservation import StockReservation
+from app.core.models.rollup import SalesFact, OrderFact, SalesRollup, \
+    ItemRollup, RecordSale, FoldSales
+
+DEFAULT_MENU = os.path.join(os.path.dirname(__file__), "default_menu.json")
+
+
+def EngineOptions(config):
+  """Return the create_engine options of the DB_* pool settings
+
+  SQLite keeps the pools picked by Flask-SQLAlchemy, so no options are
+  returned for it. Options given in SQLALCHEMY_ENGINE_OPTIONS win.
+  """
+  url = make_url(config.get('SQLALCHEMY_DATABASE_URI') or "sqlite://")
+  options = {}
+  if not url.drivername.startswith('sqlite'):
+    options = {
+        "pool_size": config.get('DB_POOL_SIZE', 10),
+        "max_overflow": config.get('DB_MAX_OVERFLOW', 10),
+        "pool_timeout": config.get('DB_POOL_TIMEOUT', 30),
+        "pool_recycle": config.get('DB_POOL_RECYCLE', 3600),
+        "pool_pre_ping": config.get('DB_POOL_PRE_PING', True),
+    }
+    if config.get('DB_ISOLATION_LEVEL'):
+      options["isolation_level"] = config['DB_ISOLATION_LEVEL']
+  options.update(config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+  return options
 
 
 class SalesSystem:
@@ -13,404 +48,224 @@ class SalesSystem:
 
   def __init__(self, app):
     self.app = app
+    self.sweeper = None
+    self.hub = import_string(
+        app.config.get('PUBSUB_HUB', 'app.core.pubsub.LocalHub'))(app)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = EngineOptions(app.config)
     db.init_app(self.app)
 
+  def PublishOrder(self, order):
+    """Notify subscribers of the orders channel of an order's new state
+
+    Call after the change is committed.
+    """
+    self.hub.Publish(
+        "orders", {
+            "id": order.GetID(),
+            "user": order.user.GetName() if order.user else None,
+            "price_cents": order.GetPriceCents(),
+            "status": order.GetStatusText(),
+            "created_at": str(order.GetCreatedAt()),
+            "updated_at": str(order.GetUpdatedAt()),
+        })
+
+  def Migrate(self):
+    """Bring the schema of an existing database up to date
+
+    Returns the list of migration versions applied.
+    """
+    with self.app.app_context():
+      applied = migrations.Upgrade(db.engine)
+      db.create_all()
+    return applied
+
+  def _IterPaidOrders(self, batch_size):
+    """Yield all paid or ready orders in id order, loading them in batches
+
+    Call within an app context; the session is cleared between batches.
+    """
+    last_id = 0
+    while True:
+      orders = Order.query.filter(
+          Order.status != OrderStatus.CREATED,
+          Order.id > last_id).order_by(Order.id).limit(batch_size).all()
+      if not orders:
+        return
+      yield from orders
+      last_id = orders[-1].id
+      db.session.expunge_all()
+
+  def RebuildRollups(self, batch_size=500):
+    """Recompute the sales facts and rollups from all paid orders
+
+    Orders are taken as paid at their last update. Returns the number of
+    orders recorded.
+    """
+    count = 0
+    with self.app.app_context():
+      for model in (SalesFact, OrderFact, SalesRollup, ItemRollup):
+        db.session.execute(model.__table__.delete())
+      for order in self._IterPaidOrders(batch_size):
+        RecordSale(order.id, order.price_cents, order.GetLines(),
+                   order.updated_at)
+        count += 1
+      db.session.commit()
+    self.FoldRollups(batch_size)
+    return count
+
+  def FoldRollups(self, batch_size=1000):
+    """Add the sales facts not folded yet to the sales rollups
+
+    Facts are folded and committed batch_size orders at a time. Returns the
+    number of orders folded.
+    """
+    count = 0
+    with self.app.app_context():
+      while True:
+        folded = FoldSales(batch_size)
+        db.session.commit()
+        if not folded:
+          break
+        count += folded
+    return count
+
+  def BackfillOrderLines(self, batch_size=500):
+    """Write the OrderLines of all paid orders, replacing existing ones
+
+    Returns the number of orders written.
+    """
+    count = 0
+    with self.app.app_context():
+      catalog = GetCatalog()
+      for order in self._IterPaidOrders(batch_size):
+        OrderLine.Write(order.id, order.GetLines(), catalog)
+        count += 1
+      db.session.commit()
+    return count
+
+  def DiagnosePool(self, checkouts=200, threads=8, hold=0.01):
+    """Time connection checkouts from the pool under concurrent use
+
+    threads threads each check out a connection checkouts times in total,
+    run SELECT 1 on it and keep it for hold seconds. Returns a dict of the
+    engine options in effect, checkout time percentiles in ms, failed
+    checkouts and the pool status.
+    """
+    with self.app.app_context():
+      engine = db.get_engine()
+    times = []
+    errors = []
+    remaining = [checkouts]
+    lock = threading.Lock()
+
+    def Work():
+      while True:
+        with lock:
+          if remaining[0] <= 0:
+            return
+          remaining[0] -= 1
+        start = time.perf_counter()
+        try:
+          connection = engine.connect()
+        except Exception as e:  # pylint: disable=broad-except
+          with lock:
+            errors.append(type(e).__name__)
+          continue
+        elapsed = time.perf_counter() - start
+        try:
+          connection.execute("SELECT 1")
+          time.sleep(hold)
+        finally:
+          connection.close()
+        with lock:
+          times.append(elapsed)
+
+    workers = [threading.Thread(target=Work) for _ in range(threads)]
+    for worker in workers:
+      worker.start()
+    for worker in workers:
+      worker.join()
+    times.sort()
+    return {
+        "options": dict(self.app.config['SQLALCHEMY_ENGINE_OPTIONS']),
+        "pool": type(engine.pool).__name__,
+        "status": engine.pool.status(),
+        "checkouts": len(times),
+        "errors": len(errors),
+        "checkout_ms": {
+            name: times[min(int(len(times) * q), len(times) - 1)] * 1e3
+            for name, q in (("min", 0), ("p50", 0.5), ("p95", 0.95),
+                            ("p99", 0.99), ("max", 1))
+        } if times else {},
+    }
+
+  def SweepReservations(self):
+    """Release stock held by orders idle for more than RESERVATION_TTL
+
+    Returns the number of orders released.
+    """
+    cutoff = datetime.now() - timedelta(
+        seconds=self.app.config.get('RESERVATION_TTL', 1800))
+    with self.app.app_context():
+      count = Order.ExpireReservations(cutoff)
+      db.session.commit()
+    return count
+
+  def StartReservationSweeper(self):
+    """Run SweepReservations every RESERVATION_SWEEP_INTERVAL seconds
+
+    The sweeper is a daemon thread, which also runs FoldRollups so the
+    sales rollups stay current. Start it in the serving process only, not
+    in a reloader parent or CLI commands; concurrent sweepers are safe
+    but do the same work twice.
+    """
+    interval = self.app.config.get('RESERVATION_SWEEP_INTERVAL', 0)
+    if not interval or self.sweeper is not None:
+      return
+    stop = threading.Event()
+
+    def Sweep():
+      while not stop.wait(interval):
+        try:
+          self.SweepReservations()
+        except Exception:  # pylint: disable=broad-except
+          self.app.logger.exception("Failed to sweep reservations")
+        try:
+          self.FoldRollups()
+        except Exception:  # pylint: disable=broad-except
+          self.app.logger.exception("Failed to fold sales rollups")
+
+    self.sweeper = threading.Thread(
+        target=Sweep, name="reservation-sweeper", daemon=True)
+    self.sweeper.stop = stop
+    self.sweeper.start()
+
   def InitializeDb(self, skeleton=False):
-    """Create db schema and populate it with default inventory data"""
+    """Create db schema and populate it with the default menu"""
     with self.app.app_context():
+      migrations.Upgrade(db.engine)
       db.create_all()
 
       if not skeleton:
-        main = Item(name="Main", root=True)
-        db.session.add(main)
-
-        main_type_group = IngredientGroup(
-            name="Main Type",
-            max_item=1,
-            min_item=1,
-            max_option=1,
-            min_option=1)
-        main.ingredientgroups.append(main_type_group)
-        db.session.add(main_type_group)
-
-        base_burger = Item(
-            name="Standard Burger(non-customizable)",
-            root=False,
-            price=12.99,
-            stock_unit=1)
-        db.session.add(base_burger)
-        main_type_group.options.append(base_burger)
-
-        base_burger_stock = Stock(name="Standard Burger", amount=1000)
-        db.session.add(base_burger_stock)
-        base_burger_stock.items.append(base_burger)
-
-        burger = Item(name="Customizable Burger", root=False, price=9.99)
-        db.session.add(burger)
-        main_type_group.options.append(burger)
-
-        bun_group = IngredientGroup(
-            name="Bun", max_item=3, min_item=2, max_option=1, min_option=1)
-        db.session.add(bun_group)
-        burger.ingredientgroups.append(bun_group)
-
-        muffin_bun = Item(
-            name="Muffin Bun",
-            root=False,
-            identical=True,
-            price=0.99,
-            stock_unit=1)
-        sesame_bun = Item(
-            name="Sesame Bun",
-            root=False,
-            identical=True,
-            price=0.99,
-            stock_unit=1)
-        standard_bun = Item(
-            name="Standard Bun", root=False, identical=True, stock_unit=1)
-        db.session.add(muffin_bun)
-        db.session.add(sesame_bun)
-        db.session.add(standard_bun)
-        bun_group.options.append(muffin_bun)
-        bun_group.options.append(sesame_bun)
-        bun_group.options.append(standard_bun)
-
-        muffin_bun_stock = Stock(name="Muffin Bun", amount=1000)
-        db.session.add(muffin_bun_stock)
-        muffin_bun_stock.items.append(muffin_bun)
-
-        sesame_bun_stock = Stock(name="Sesame Bun", amount=1000)
-        db.session.add(sesame_bun_stock)
-        sesame_bun_stock.items.append(sesame_bun)
-
-        standard_bun_stock = Stock(name="Standard Bun", amount=1000)
-        db.session.add(standard_bun_stock)
-        standard_bun_stock.items.append(standard_bun)
-
-        wrap = Item(
-            name="Wrap", root=False, identical=False, price=8.99, stock_unit=1)
-        db.session.add(wrap)
-        main_type_group.options.append(wrap)
-
-        wrap_stock = Stock(name="Wrap", amount=1000)
-        db.session.add(wrap_stock)
-        wrap_stock.items.append(wrap)
-
-        patty_group = IngredientGroup(
-            name="Patties", max_item=3, min_item=1, max_option=3, min_option=1)
-        db.session.add(patty_group)
-        burger.ingredientgroups.append(patty_group)
-        wrap.ingredientgroups.append(patty_group)
-
-        chicken_patty = Item(
-            name="Chicken Patty",
-            root=False,
-            identical=True,
-            price=0.99,
-            stock_unit=1)
-        beef_patty = Item(
-            name="Beef Patty",
-            root=False,
-            identical=True,
-            price=1.99,
-            stock_unit=1)
-        vegetarian_patty = Item(
-            name="Vegetarian Patty",
-            root=False,
-            identical=True,
-            price=0.99,
-            stock_unit=1)
-        db.session.add(chicken_patty)
-        db.session.add(beef_patty)
-        db.session.add(vegetarian_patty)
-        patty_group.options.append(chicken_patty)
-        patty_group.options.append(beef_patty)
-        patty_group.options.append(vegetarian_patty)
-
-        chicken_patty_stock = Stock(name="Chicken Patty", amount=1000)
-        db.session.add(chicken_patty_stock)
-        chicken_patty_stock.items.append(chicken_patty)
-
-        beef_patty_stock = Stock(name="Beef Patty", amount=1000)
-        db.session.add(beef_patty_stock)
-        beef_patty_stock.items.append(beef_patty)
-
-        vegetarian_patty_stock = Stock(name="Vegetarian Patty", amount=1000)
-        db.session.add(vegetarian_patty_stock)
-        vegetarian_patty_stock.items.append(vegetarian_patty)
-
-        ingredients = IngredientGroup(
-            name="Other Ingredients", max_item=5, max_option=5)
-        db.session.add(ingredients)
-        burger.ingredientgroups.append(ingredients)
-        wrap.ingredientgroups.append(ingredients)
-
-        tomato = Item(
-            name="Tomato", root=False, identical=True, price=0.99, stock_unit=1)
-        tomato_sauce = Item(
-            name="Tomato Sauce",
-            root=False,
-            identical=True,
-            price=0.99,
-            stock_unit=1)
-        bbq_sauce = Item(
-            name="BBQ Sauce",
-            root=False,
-            identical=True,
-            price=0.99,
-            stock_unit=1)
-        cheddar_cheese = Item(
-            name="Cheddar Cheese",
-            root=False,
-            identical=True,
-            price=0.99,
-            stock_unit=1)
-        db.session.add(tomato)
-        db.session.add(tomato_sauce)
-        db.session.add(bbq_sauce)
-        db.session.add(cheddar_cheese)
-        ingredients.options.append(tomato)
-        ingredients.options.append(tomato_sauce)
-        ingredients.options.append(bbq_sauce)
-        ingredients.options.append(cheddar_cheese)
-
-        tomato_stock = Stock(name="Tomato", amount=1000)
-        db.session.add(tomato_stock)
-        tomato_stock.items.append(tomato)
-
-        tomato_sauce_stock = Stock(name="Tomato Sauce", amount=1000)
-        db.session.add(tomato_sauce_stock)
-        tomato_sauce_stock.items.append(tomato_sauce)
-
-        bbq_sauce_stock = Stock(name="BBQ Sauce", amount=1000)
-        db.session.add(bbq_sauce_stock)
-        bbq_sauce_stock.items.append(bbq_sauce)
-
-        cheddar_cheese_stock = Stock(name="Cheddar Cheese", amount=1000)
-        db.session.add(cheddar_cheese_stock)
-        cheddar_cheese_stock.items.append(cheddar_cheese)
-
-        nuggets = Item(name="Nuggets", root=True, price=1.99)
-        db.session.add(nuggets)
-
-        nuggets_stock = Stock(name="Nuggets", amount=1000)
-        db.session.add(nuggets_stock)
-
-        nuggets_amount = IngredientGroup(
-            name="Nuggets Amount",
-            max_item=1,
-            min_item=1,
-            max_option=1,
-            min_option=1)
-        db.session.add(nuggets)
-        nuggets.ingredientgroups.append(nuggets_amount)
-
-        nuggets_3_pack = Item(
-            name="3-pack Nuggets",
-            root=False,
-            identical=True,
-            price=0,
-            stock_unit=3)
-        nuggets_6_pack = Item(
-            name="6-pack Nuggets",
-            root=False,
-            identical=True,
-            price=1,
-            stock_unit=6)
-        nuggets_12_pack = Item(
-            name="12-pack Nuggets",
-            root=False,
-            identical=True,
-            price=2,
-            stock_unit=12)
-        db.session.add(nuggets_3_pack)
-        db.session.add(nuggets_6_pack)
-        db.session.add(nuggets_12_pack)
-        nuggets_stock.items.append(nuggets_3_pack)
-        nuggets_stock.items.append(nuggets_6_pack)
-        nuggets_stock.items.append(nuggets_12_pack)
-        nuggets_amount.options.append(nuggets_3_pack)
-        nuggets_amount.options.append(nuggets_6_pack)
-        nuggets_amount.options.append(nuggets_12_pack)
-
-        fries = Item(name="Fries", root=True, price=1.99)
-        db.session.add(fries)
-
-        fries_stock = Stock(name="Fries (g)", amount=1000)
-        db.session.add(fries_stock)
-
-        fries_size = IngredientGroup(
-            name="fries Size",
-            max_item=1,
-            min_item=1,
-            max_option=1,
-            min_option=1)
-        db.session.add(fries_size)
-        fries.ingredientgroups.append(fries_size)
-
-        small_size = Item(
-            name="Small Fries",
-            root=False,
-            identical=True,
-            price=0,
-            stock_unit=150)
-        medium_size = Item(
-            name="Medium Fries",
-            root=False,
-            identical=True,
-            price=1,
-            stock_unit=200)
-        large_size = Item(
-            name="Large Fries",
-            root=False,
-            identical=True,
-            price=2,
-            stock_unit=250)
-        db.session.add(small_size)
-        db.session.add(medium_size)
-        db.session.add(large_size)
-        fries_stock.items.append(small_size)
-        fries_stock.items.append(medium_size)
-        fries_stock.items.append(large_size)
-        fries_size.options.append(small_size)
-        fries_size.options.append(medium_size)
-        fries_size.options.append(large_size)
-
-        sauce = IngredientGroup(name="Sauce", max_item=3, max_option=3)
-        db.session.add(sauce)
-        nuggets.ingredientgroups.append(sauce)
-        fries.ingredientgroups.append(sauce)
-
-        chilli_sauce_stock = Stock(name="Chilli Sauce", amount=1000)
-        db.session.add(chilli_sauce_stock)
-
-        tomato_sauce = Item(
-            name="Tomato Sauce",
-            root=False,
-            identical=True,
-            price=0,
-            max_item=1,
-            stock_unit=1)
-        bbq_sauce = Item(
-            name="BBQ Sauce", root=False, identical=True, price=1, stock_unit=1)
-        chilli_sauce = Item(
-            name="Chilli Sauce",
-            root=False,
-            identical=True,
-            price=1,
-            stock_unit=1)
-        db.session.add(tomato_sauce)
-        db.session.add(bbq_sauce)
-        db.session.add(chilli_sauce)
-        tomato_sauce_stock.items.append(tomato_sauce)
-        bbq_sauce_stock.items.append(bbq_sauce)
-        chilli_sauce_stock.items.append(chilli_sauce)
-        sauce.options.append(tomato_sauce)
-        sauce.options.append(bbq_sauce)
-        sauce.options.append(chilli_sauce)
-
-        coke = Item(name="Coke", root=True, price=1.99)
-        db.session.add(coke)
-
-        coke_stock = Stock(name="Coke (ml)", amount=1000)
-        db.session.add(coke_stock)
-
-        coke_size = IngredientGroup(
-            name="Coke Size",
-            max_item=1,
-            min_item=1,
-            max_option=1,
-            min_option=1)
-        db.session.add(coke_size)
-        coke.ingredientgroups.append(coke_size)
-
-        small_coke = Item(
-            name="Small Coke",
-            root=False,
-            identical=True,
-            price=0,
-            stock_unit=150)
-        medium_coke = Item(
-            name="Medium Coke",
-            root=False,
-            identical=True,
-            price=1,
-            stock_unit=250)
-        large_coke = Item(
-            name="Large Coke",
-            root=False,
-            identical=True,
-            price=2,
-            stock_unit=350)
-        db.session.add(small_coke)
-        db.session.add(medium_coke)
-        db.session.add(large_coke)
-        coke_stock.items.append(small_coke)
-        coke_stock.items.append(medium_coke)
-        coke_stock.items.append(large_coke)
-        coke_size.options.append(small_coke)
-        coke_size.options.append(medium_coke)
-        coke_size.options.append(large_coke)
-
-        sundaes = Item(name="Sundaes", root=True, price=2.99)
-        db.session.add(sundaes)
-
-        sundaes_stock = Stock(name="Sundaes (ml)", amount=1000)
-        db.session.add(sundaes_stock)
-
-        sundaes_flavor = IngredientGroup(
-            name="Sundaes Flavors",
-            max_item=1,
-            min_item=1,
-            max_option=1,
-            min_option=1)
-        db.session.add(sundaes)
-        sundaes.ingredientgroups.append(sundaes_flavor)
-
-        chocolate_flavor = Item(
-            name="Chocolate Sundaes", root=False, identical=True, price=0)
-        strawberry_flavor = Item(
-            name="Strawberry Sundaes", root=False, identical=True, price=0)
-        db.session.add(chocolate_flavor)
-        db.session.add(strawberry_flavor)
-        sundaes_flavor.options.append(chocolate_flavor)
-        sundaes_flavor.options.append(strawberry_flavor)
-
-        sundaes_size = IngredientGroup(
-            name="Sundaes Size",
-            max_item=1,
-            min_item=1,
-            max_option=1,
-            min_option=1)
-        db.session.add(sundaes_size)
-        sundaes.ingredientgroups.append(sundaes_size)
-
-        small_sundaes = Item(
-            name="Small Sundaes",
-            root=False,
-            identical=True,
-            price=0,
-            stock_unit=100)
-        medium_sundaes = Item(
-            name="Medium Sundaes",
-            root=False,
-            identical=True,
-            price=1,
-            stock_unit=150)
-        large_sundaes = Item(
-            name="Large Sundaes",
-            root=False,
-            identical=True,
-            price=2,
-            stock_unit=200)
-        db.session.add(small_sundaes)
-        db.session.add(medium_sundaes)
-        db.session.add(large_sundaes)
-        sundaes_stock.items.append(small_sundaes)
-        sundaes_stock.items.append(medium_sundaes)
-        sundaes_stock.items.append(large_sundaes)
-        sundaes_size.options.append(small_sundaes)
-        sundaes_size.options.append(medium_sundaes)
-        sundaes_size.options.append(large_sundaes)
-
+        menu.LoadMenu(menu.ReadMenuFile(DEFAULT_MENU))
         db.session.commit()
+
+  def LoadMenu(self, path, replace=False):
+    """Insert the menu definition in a JSON or YAML file
+
+    With replace, the current menu and stock are deleted first. Raises
+    ValueError if the definition is invalid or it would replace the menu
+    of a database with orders.
+    """
+    with self.app.app_context():
+      try:
+        menu.LoadMenu(menu.ReadMenuFile(path), replace=replace)
+      except Exception:
+        db.session.rollback()
+        raise
+      db.session.commit()
+
+  def ExportMenu(self):
+    """Return the menu in the database as a menu definition"""
+    with self.app.app_context():
+      return menu.ExportMenu()
@@ -1,7 +1,34 @@
 # pylint: skip-file
 
+import os
+
 DEBUG = True
 SECRET_KEY = "lmao_very_very_secret"
-# SQLALCHEMY_DATABASE_URI = "mysql+pymysql://sales:SECURE_SALES_PWD@db/sales"
-SQLALCHEMY_DATABASE_URI = "sqlite:////tmp/db.sql"
+# e.g. SALES_DATABASE_URI=mysql+pymysql://sales:SECURE_SALES_PWD@db/sales
+SQLALCHEMY_DATABASE_URI = os.environ.get("SALES_DATABASE_URI",
+                                         "sqlite:////tmp/db.sql")
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+# Connection pool of each worker process, ignored for SQLite. Every worker
+# may open up to DB_POOL_SIZE + DB_MAX_OVERFLOW connections.
+DB_POOL_SIZE = int(os.environ.get("SALES_DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.environ.get("SALES_DB_MAX_OVERFLOW", 10))
+# seconds to wait for a free connection before failing the request
+DB_POOL_TIMEOUT = int(os.environ.get("SALES_DB_POOL_TIMEOUT", 30))
+# seconds after which connections are replaced, below MySQL's wait_timeout
+DB_POOL_RECYCLE = int(os.environ.get("SALES_DB_POOL_RECYCLE", 3600))
+# test connections on checkout so dropped ones are replaced transparently
+DB_POOL_PRE_PING = os.environ.get("SALES_DB_POOL_PRE_PING", "1") == "1"
+# e.g. "READ COMMITTED", None for the server default
+DB_ISOLATION_LEVEL = os.environ.get("SALES_DB_ISOLATION_LEVEL") or None
+# seconds an unpaid order holds its stock after its last change
+RESERVATION_TTL = 1800
+# seconds between sweeps for abandoned orders, 0 to disable
+RESERVATION_SWEEP_INTERVAL = 60
+# class publishing order events to the admin order feed
+PUBSUB_HUB = "app.core.pubsub.LocalHub"
+# seconds between keepalive comments on idle event streams
+ORDER_FEED_KEEPALIVE = 15
+# record queries and render time per request, see /admin/querystats
+SQL_INSTRUMENTATION = False
+# bearer token letting scrapers read /admin/metrics, None for admins only
+METRICS_TOKEN = None
@@ -6,3 +6,4 @@ DEBUG = True
 TESTING = True
 SECRET_KEY = "lmao_very_very_secret"
 SQLALCHEMY_DATABASE_URI = "sqlite:///:memory:"
+RESERVATION_SWEEP_INTERVAL = 0
@@ -1,5 +1,7 @@
 """Module to test the admin blueprint"""
 
+from datetime import datetime
+
 from app.core.models.order import Order, OrderStatus
 from app.core.models import db
 from app.core.models.user import User, UserType
@@ -114,3 +116,65 @@ def test_mark_as_done(client, app):
     client.get('/admin/order/%d/done' % order.GetID())
     response = client.get('/order/%d' % order.GetID())
     assert b"ready" in response.data
+
+
+def test_order_list_pages(client, app):
+  """test order list is paged from the most recent order"""
+  with app.app_context():
+    updated_at = datetime(2020, 1, 1)
+    for price in range(1, 6):
+      db.session.add(
+          Order(price=price, status=OrderStatus.PAID, updated_at=updated_at))
+    db.session.add(Order(price=77, status=OrderStatus.CREATED))
+    user = User(
+        name="Dickson", email="dickon@gmail.com", user_type=UserType.ADMIN)
+    user.SetPassword("123456")
+    db.session.add(user)
+    db.session.commit()
+
+    orders, after = Order.GetPage(OrderStatus.PAID, 2)
+    assert [order.GetPrice() for order in orders] == [5, 4]
+    orders, after = Order.GetPage(OrderStatus.PAID, 2, after)
+    assert [order.GetPrice() for order in orders] == [3, 2]
+    orders, after = Order.GetPage(OrderStatus.PAID, 2, after)
+    assert [order.GetPrice() for order in orders] == [1]
+    assert after is None
+    login(client, "dickon@gmail.com", "123456")
+  app.system.RebuildRollups()
+
+  response = client.get('/admin/orderlist?size=3')
+  rsp = str(response.data)
+  assert "$5.00" in rsp
+  assert "$3.00" in rsp
+  assert "$2.00" not in rsp
+  assert "$77.00" not in rsp
+  assert "Total of paid orders: $15.00" in rsp
+  assert "Older orders" in rsp
+
+  response = client.get('/admin/orderlist?after=garbage')
+  assert response.status_code == 302
+
+
+def test_order_feed(client, app):
+  """test order changes are streamed to the order feed"""
+  with app.app_context():
+    user = User(
+        name="Dickson", email="dickon@gmail.com", user_type=UserType.ADMIN)
+    user.SetPassword("123456")
+    order = Order(price=5, status=OrderStatus.PAID)
+    user.orders.append(order)
+    db.session.add(user)
+    db.session.commit()
+    oid = order.GetID()
+    login(client, "dickon@gmail.com", "123456")
+
+  response = client.get('/admin/orderfeed', buffered=False)
+  assert response.mimetype == "text/event-stream"
+  stream = iter(response.response)
+  assert next(stream).startswith(b"retry:")
+  client.get('/admin/order/%d/done' % oid)
+  event = next(stream)
+  response.close()
+  assert event.startswith(b"event: order\n")
+  assert b'"status": "ready"' in event
+  assert b'"user": "Dickson"' in event
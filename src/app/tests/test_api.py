@@ -0,0 +1,110 @@
+"""Module to test the JSON API blueprint"""
+
+from app.core.models.inventory import Item
+from app.core.models.user import User, UserType
+from app.core.models import db
+
+
+def login(client, email, password):
+  return client.post(
+      '/accounts/signin',
+      data={
+          "email": email,
+          "password": password
+      },
+      follow_redirects=True)
+
+
+def test_order_flow(client, app):
+  """ Test ordering a configured burger through the API
+  """
+  assert client.post('/api/orders').status_code == 401
+  with app.app_context():
+    user = User(
+        name="Jeff", email="jeff@google.com", user_type=UserType.CUSTOMER)
+    user.SetPassword("123456")
+    db.session.add(user)
+    db.session.commit()
+    ids = {item.name: item.GetID() for item in Item.query.all()}
+    nitems = Item.query.count()
+  login(client, "jeff@google.com", "123456")
+
+  menu = client.get('/api/menu').get_json()
+  assert ids["Main"] in menu["roots"]
+  assert len(menu["items"]) == nitems
+
+  response = client.post('/api/orders')
+  assert response.status_code == 201
+  oid = response.get_json()["id"]
+
+  state = client.post(
+      '/api/orders/%d/items' % oid,
+      json={
+          "items": [ids["Main"]],
+          "numbers": [1]
+      }).get_json()
+  assert state["next"]["path"] == "0.0"
+  assert state["next"]["name"] == "Main Type"
+
+  # only root items can be ordered on their own
+  for item_id in (ids["Wrap"], 9999):
+    response = client.post(
+        '/api/orders/%d/items' % oid, json={
+            "items": [item_id],
+            "numbers": [1]
+        })
+    assert response.status_code == 400
+    assert "not on the menu" in response.get_json()["error"]
+  assert len(client.get('/api/orders/%d' % oid).get_json()["items"]) == 1
+  assert ids["Wrap"] in [x["id"] for x in state["next"]["options"]]
+
+  response = client.post(
+      '/api/orders/%d/groups' % oid,
+      json={
+          "path": "0.0",
+          "items": [ids["Standard Burger(non-customizable)"]],
+          "numbers": [2]
+      })
+  assert response.status_code == 400
+  assert "At most 1 items" in response.get_json()["error"]
+
+  response = client.post('/api/orders/%d/checkout' % oid)
+  assert response.status_code == 409
+
+  state = client.post(
+      '/api/orders/%d/groups' % oid,
+      json={
+          "items": [ids["Standard Burger(non-customizable)"]],
+          "numbers": [1]
+      }).get_json()
+  assert state["next"] is None
+  assert state["price_cents"] == 1299
+  assert state["items"][0]["children"][0]["fulfilled"]
+
+  response = client.post(
+      '/api/orders/%d/groups' % oid,
+      json={
+          "path": "0",
+          "items": [],
+          "numbers": []
+      })
+  assert response.status_code == 400
+
+  state = client.post('/api/orders/%d/checkout' % oid).get_json()
+  assert state["status"] == "paid"
+  assert client.get('/api/orders/%d' % oid).get_json()["status"] == "paid"
+  assert client.post('/api/orders/%d/checkout' % oid).status_code == 409
+  for url, body in (('items', {"items": [ids["Main"]], "numbers": [1]}),
+                    ('groups', {"path": "0.0", "items": [], "numbers": []})):
+    response = client.post('/api/orders/%d/%s' % (oid, url), json=body)
+    assert response.status_code == 409
+    assert response.get_json()["error"] == "Order is already paid"
+
+  with app.app_context():
+    other = User(
+        name="Tim", email="tim@google.com", user_type=UserType.CUSTOMER)
+    other.SetPassword("123456")
+    db.session.add(other)
+    db.session.commit()
+  login(client, "tim@google.com", "123456")
+  assert client.get('/api/orders/%d' % oid).status_code == 404
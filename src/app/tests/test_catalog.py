@@ -0,0 +1,116 @@
+"""Module to test the catalog cache module"""
+import pytest
+from sqlalchemy import event
+from app.core.models.catalog import GetCatalog, GetCatalogVersion
+from app.core.models.inventory import Stock, Item, IngredientGroup
+from app.core.models.order import IGNode
+from app.core.models import db
+
+
+def test_catalog_snapshot(app):
+  """ Test catalog snapshot mirrors the offering tree
+  """
+  with app.app_context():
+    catalog = GetCatalog()
+    roots = [item.GetName() for item in catalog.GetRootItems()]
+    assert roots == [
+        item.GetName() for item in Item.query.filter(Item.root).all()
+    ]
+    for ig in IngredientGroup.query.all():
+      group = catalog.GetGroup(ig.GetID())
+      assert group.GetName() == ig.GetName()
+      assert group.GetMinItem() == ig.GetMinItem()
+      assert group.GetMaxOption() == ig.GetMaxOption()
+      assert [x.GetID() for x in group.options
+             ] == [x.GetID() for x in ig.options]
+    for item in Item.query.all():
+      snapshot = catalog.GetItem(item.GetID())
+      assert snapshot.GetPrice() == item.GetPrice()
+      assert snapshot.GetStockID() == item.GetStockID()
+      assert [x.GetID() for x in snapshot.ingredientgroups
+             ] == [x.GetID() for x in item.ingredientgroups]
+
+
+def test_catalog_invalidation(app):
+  """ Test catalog is served from memory until the menu changes
+  """
+  with app.app_context():
+    catalog = GetCatalog()
+    version = GetCatalogVersion()
+
+    statements = []
+
+    def Count(conn, cursor, statement, *args):  # pylint: disable=unused-argument
+      statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", Count)
+    try:
+      assert GetCatalog() is catalog
+      assert not statements
+    finally:
+      event.remove(db.engine, "before_cursor_execute", Count)
+
+    # stock levels are not part of the catalog
+    stock = Stock.query.first()
+    stock.IncreaseAmount(1)
+    db.session.commit()
+    assert GetCatalog() is catalog
+
+    item = Item(name="Salad", root=True, price=4)
+    db.session.add(item)
+    db.session.commit()
+    assert GetCatalogVersion() == version + 1
+    assert GetCatalog().GetItem(item.GetID()).GetName() == "Salad"
+
+    item.price = 5
+    db.session.commit()
+    assert GetCatalog().GetItem(item.GetID()).GetPrice() == 5
+
+
+def test_catalog_rollback(app):
+  """ Test snapshots of a rolled back menu change are never served
+  """
+  with app.app_context():
+    version = GetCatalogVersion()
+    item = Item(name="Salad", root=True, price=4)
+    db.session.add(item)
+    db.session.flush()
+    assert GetCatalog().GetItem(item.GetID()).GetName() == "Salad"
+    db.session.rollback()
+    assert GetCatalogVersion() == version
+    assert "Salad" not in [x.GetName() for x in GetCatalog().GetRootItems()]
+
+    item = Item(name="Soup", root=True, price=3)
+    db.session.add(item)
+    db.session.commit()
+    assert GetCatalogVersion() == version + 1
+    catalog = GetCatalog()
+    assert [x.GetName() for x in catalog.GetRootItems()][-1] == "Soup"
+    assert GetCatalog() is catalog
+
+
+def test_group_validator(app):
+  """ Test ingredient groups only accept their own options within limits
+  """
+  with app.app_context():
+    bun = IngredientGroup.query.filter_by(name="Bun").first()
+    sesame = Item.query.filter_by(name="Sesame Bun").first()
+    wrap = Item.query.filter_by(name="Wrap").first()
+    validator = GetCatalog().GetGroup(bun.GetID()).GetValidator()
+    assert validator.option_ids == {x.GetID() for x in bun.options}
+    validator.CheckChoice(sesame.GetID(), 3)
+
+    node = IGNode.FromIG(bun)
+    with pytest.raises(ValueError, match="not an option of Bun"):
+      node.SetItems([wrap.GetID()], [1])
+    assert not node.GetChildren()
+    with pytest.raises(ValueError, match="At least 2 items"):
+      node.SetItems([sesame.GetID()], [1])
+
+    sesame.max_item = 2
+    db.session.commit()
+    validator = GetCatalog().GetGroup(bun.GetID()).GetValidator()
+    with pytest.raises(ValueError, match="can't exceed 2"):
+      validator.CheckChoice(sesame.GetID(), 3)
+    node.SetItems([sesame.GetID()], [2])
+    assert node.IsFulfilled()
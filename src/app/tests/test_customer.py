@@ -154,3 +154,98 @@ def test_checkout_page(client, app):
     client.get('/admin/order/%d/done' % order.GetID())
     # Check if the customer can see the details of his order.
     assert order.GetDetailsString().encode("utf-8") in response.data
+
+
+def test_checkout_twice(client, app):
+  """ Test posting the checkout of a paid order again takes no stock
+  """
+  with app.app_context():
+    user = User(
+        name="Jeff", email="jeff@google.com", user_type=UserType.CUSTOMER)
+    user.SetPassword("123456")
+    order = Order(price=0)
+    user.orders.append(order)
+    db.session.add(user)
+    db.session.commit()
+    order.AddRootItem(26, 1)
+    order.AddIG("0.0", [28], [1])
+    db.session.commit()
+    oid = order.GetID()
+    login(client, "jeff@google.com", "123456")
+
+  response = client.post('/order/%d/checkout' % oid)
+  assert response.status_code == 302
+  response = client.post('/order/%d/checkout' % oid)
+  assert b"already paid" in response.data
+  with app.app_context():
+    assert Stock.query.get(16).GetAmount() == 750
+    assert Order.query.get(oid).GetStatus() == OrderStatus.PAID
+
+
+def test_bulk_add(client, app):
+  """ Test adding configured items with the JSON and form endpoint
+  """
+  with app.app_context():
+    user = User(
+        name="Jeff", email="jeff@google.com", user_type=UserType.CUSTOMER)
+    user.SetPassword("123456")
+    order = Order(price=0)
+    user.orders.append(order)
+    db.session.add(user)
+    db.session.commit()
+    oid = order.GetID()
+    ids = {item.name: item.GetID() for item in Item.query.all()}
+    login(client, "jeff@google.com", "123456")
+
+  config = {
+      "0": {
+          "items": [ids["Customizable Burger"]],
+          "numbers": [1]
+      },
+      "0.0.0": {
+          "items": [ids["Sesame Bun"]],
+          "numbers": [2]
+      },
+      "0.0.1": {
+          "items": [ids["Beef Patty"]],
+          "numbers": [1]
+      },
+      "0.0.2": {
+          "items": [],
+          "numbers": []
+      },
+  }
+  response = client.post(
+      '/order/%d/bulk' % oid,
+      json={
+          "item": ids["Main"],
+          "quantity": 3,
+          "config": config
+      })
+  assert response.status_code == 200
+  assert response.get_json()["added_cents"] == 3 * 1396
+
+  response = client.post(
+      '/order/%d/bulk' % oid, json={
+          "item": ids["Main"],
+          "quantity": 1
+      })
+  assert response.status_code == 400
+  assert "Please choose" in response.get_json()["error"]
+
+  response = client.post(
+      '/order/%d/bulk' % oid,
+      data={
+          "item": ids["Fries"],
+          "quantity": 2,
+          "items.0": [ids["Small Fries"]],
+          "numbers.0": [1],
+          "items.1": "",
+      },
+      follow_redirects=True)
+  assert b"Added 2 items" in response.data
+
+  with app.app_context():
+    order = Order.query.get(oid)
+    assert order.GetPriceCents() == 3 * 1396 + 2 * 199
+    assert order.GetUnfulfilledIGDetails() is None
@@ -0,0 +1,101 @@
+"""Module to test the order export module"""
+import csv
+from datetime import datetime
+import io
+import json
+import pytest
+from app.core import export
+from app.core.models.order import Order, OrderStatus, ItemNode, IGNode, \
+    FlattenTree
+from app.core.models.user import User, UserType
+from app.core.models import db
+from .test_admin import login
+
+
+def test_flatten_tree():
+  """ Test item lines carry their group and total quantity
+  """
+  root = ItemNode(1, "main", 2, 200)
+  group = IGNode(2, "patties")
+  group.AddChild(ItemNode(3, "patty", 3, 600))
+  root.AddChild(group)
+  lines = list(FlattenTree([ItemNode(4, "coke", 1, 199), root]))
+  assert [line["path"] for line in lines] == ["0", "1", "1.0.0"]
+  assert lines[0]["ig_id"] is None
+  assert lines[2] == {
+      "path": "1.0.0",
+      "item_id": 3,
+      "item_name": "patty",
+      "ig_id": 2,
+      "ig_name": "patties",
+      "quantity": 6,
+      "price_cents": 600,
+  }
+
+
+def AddOrders():
+  """Add a paid nuggets order in 2020 and an empty order in 2021"""
+  user = User(
+      name="Dickson", email="dickon@gmail.com", user_type=UserType.ADMIN)
+  user.SetPassword("123456")
+  db.session.add(user)
+  order = Order(status=OrderStatus.CREATED, price=0)
+  order.AddRootItem(15, 1)
+  order.AddIG("0.0", [17], [1])
+  order.AddIG("0.1", [24], [2])
+  order.SetStatus(OrderStatus.PAID)
+  order.created_at = datetime(2020, 5, 1, 12)
+  user.orders.append(order)
+  user.orders.append(
+      Order(status=OrderStatus.CREATED, created_at=datetime(2021, 1, 1)))
+  db.session.commit()
+
+
+def test_export_orders(app):
+  """ Test orders export as CSV lines and NDJSON objects with filters
+  """
+  with app.app_context():
+    AddOrders()
+    rows = list(csv.reader(io.StringIO("".join(export.ExportOrders("csv")))))
+    assert rows[0] == list(export.CSV_COLUMNS)
+    assert [row[8] for row in rows[1:]] == [
+        "Nuggets", "6-pack Nuggets", "BBQ Sauce", ""
+    ]
+    assert rows[2][1:4] == ["Dickson", "paid", "4.99"]
+    assert rows[3][9:] == ["Sauce", "2", "2.00"]
+
+    lines = "".join(
+        export.ExportOrders("ndjson", status=OrderStatus.PAID)).splitlines()
+    assert len(lines) == 1
+    order = json.loads(lines[0])
+    assert order["price_cents"] == 499
+    assert [line["quantity"] for line in order["lines"]] == [1, 1, 2]
+
+    lines = "".join(
+        export.ExportOrders("ndjson", start=datetime(2020, 6, 1))).splitlines()
+    assert [json.loads(line)["status"] for line in lines] == ["created"]
+    assert not "".join(
+        export.ExportOrders("ndjson", end=datetime(2020, 1, 1)))
+    with pytest.raises(ValueError):
+      export.ExportOrders("xml")
+    with pytest.raises(ValueError):
+      export.ParseStatus("lost")
+
+
+def test_export_endpoint(client, app):
+  """ Test admins download the export as a stream
+  """
+  with app.app_context():
+    AddOrders()
+    login(client, "dickon@gmail.com", "123456")
+
+  response = client.get('/admin/export?format=ndjson&start=2020-05-01'
+                        '&end=2020-05-02&status=paid')
+  assert response.status_code == 200
+  assert response.is_streamed
+  assert response.mimetype == "application/x-ndjson"
+  assert response.headers["Content-Disposition"].endswith("orders.ndjson")
+  assert json.loads(response.data)["user"] == "Dickson"
+
+  response = client.get('/admin/export?start=May')
+  assert response.status_code == 302
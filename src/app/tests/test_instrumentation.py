@@ -0,0 +1,55 @@
+"""Module to test the instrumentation module"""
+
+import asyncio
+from flask import g
+from jinja2 import Environment
+from app.core.instrumentation import RequestRecord, TimedTemplate
+from app.core.models import db
+from app.core.models.user import User, UserType
+
+
+def test_request_stats(client, app):
+  """ Test queries and render time are recorded per endpoint when enabled
+  """
+  response = client.get('/admin/')
+  assert 'X-DB-Queries' not in response.headers
+  assert not app.request_stats.ToDict()
+
+  app.config['SQL_INSTRUMENTATION'] = True
+  with app.app_context():
+    user = User(
+        name="Dickson", email="dickon@gmail.com", user_type=UserType.ADMIN)
+    user.SetPassword("123456")
+    db.session.add(user)
+    db.session.commit()
+  client.post(
+      '/accounts/signin',
+      data={
+          "email": "dickon@gmail.com",
+          "password": "123456"
+      })
+
+  response = client.get('/admin/orderlist')
+  assert int(response.headers['X-DB-Queries']) >= 3
+  assert response.headers['X-Render-Time'].endswith("ms")
+
+  stats = client.get('/admin/querystats').get_json()
+  assert stats['enabled']
+  orderlist = stats['endpoints']['admin.OrderList']
+  assert orderlist['requests'] == 1
+  assert orderlist['queries'] == int(response.headers['X-DB-Queries'])
+  assert orderlist['render_time_ms'] > 0
+  assert "SELECT" in orderlist['slowest_statement']
+  assert sum(orderlist['duration_buckets_ms'].values()) == 1
+
+
+def test_timed_template_async(app):
+  """ Test templates rendered asynchronously add their render time too
+  """
+  env = Environment(enable_async=True)
+  env.template_class = TimedTemplate
+  template = env.from_string("{% for x in range(3) %}{{ x }}{% endfor %}")
+  with app.test_request_context('/'):
+    g.request_record = RequestRecord()
+    assert asyncio.run(template.render_async()) == "012"
+    assert g.request_record.render_time > 0
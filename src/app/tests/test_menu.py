@@ -0,0 +1,94 @@
+"""Module to test the menu module"""
+import json
+import pytest
+from app.core.menu import LoadMenu, ExportMenu, ValidateMenu
+from app.core.models.catalog import GetCatalog, GetCatalogVersion
+from app.core.models.inventory import Item, Stock
+from app.core.models.order import Order, OrderStatus
+from app.core.models import db
+from app.core.system import DEFAULT_MENU
+
+
+def test_default_menu(app):
+  """ Test the seeded database exports as the bundled menu
+  """
+  with open(DEFAULT_MENU, encoding="utf-8") as f:
+    default = json.load(f)
+  with app.app_context():
+    assert ExportMenu() == default
+    assert Item.query.get(1).GetName() == "Main"
+    assert [x.GetID() for x in GetCatalog().GetGroup(1).options] == [2, 3, 7]
+
+
+def test_load_menu_replace(app):
+  """ Test a menu replaces the current one and invalidates the catalog
+  """
+  menu = {
+      "stocks": [{"id": 5, "name": "Soup", "amount": 20}],
+      "groups": [{"id": 3, "name": "Size", "min_item": 1, "max_item": 1,
+                  "options": [11, 10]}],
+      "items": [
+          {"id": 1, "name": "Soup", "root": True, "price_cents": 450,
+           "groups": [3]},
+          {"id": 10, "name": "Cup", "stock": 5},
+          {"id": 11, "name": "Bowl", "stock": 5, "stock_unit": 2},
+      ],
+  }
+  with app.app_context():
+    version = GetCatalogVersion()
+    with pytest.raises(ValueError):
+      LoadMenu(menu)
+    LoadMenu(menu, replace=True)
+    db.session.commit()
+    assert GetCatalogVersion() != version
+    catalog = GetCatalog()
+    assert [x.GetName() for x in catalog.GetRootItems()] == ["Soup"]
+    assert sorted(x.GetID() for x in catalog.GetGroup(3).options) == [10, 11]
+    assert Stock.query.count() == 1
+    exported = ExportMenu()
+    assert sorted(exported["groups"][0]["options"]) == [10, 11]
+    assert exported["items"][2]["stock_unit"] == 2
+    assert exported["items"][0]["image"] == "default.png"
+
+    db.session.add(Order(status=OrderStatus.CREATED, price=0))
+    db.session.commit()
+    with pytest.raises(ValueError):
+      LoadMenu(menu, replace=True)
+
+
+@pytest.mark.parametrize("change", [
+    lambda m: m["items"].append({"id": 1, "name": "Again"}),
+    lambda m: m["items"][0].update(stock=9),
+    lambda m: m["items"][0].update(groups=[9]),
+    lambda m: m["items"][0].update(price_cents=-1),
+    lambda m: m["items"][0].update(colour="red"),
+    lambda m: m["groups"][0].update(options=[9]),
+    lambda m: m["groups"][0].update(min_item=3, max_item=2),
+    lambda m: m["groups"][0].update(min_item="1"),
+    lambda m: m["groups"][0].update(max_option=-1),
+    lambda m: m["groups"][0].update(options=2),
+    lambda m: m["groups"][0].update(options=[2, 2]),
+    lambda m: m["stocks"][0].pop("name"),
+    lambda m: m["stocks"][0].update(amount=1.5),
+    lambda m: m["stocks"][0].update(amount=-3),
+    lambda m: m["items"][0].update(price_cents="450"),
+    lambda m: m["items"][0].update(price_cents=True),
+    lambda m: m["items"][0].update(root="yes"),
+    lambda m: m["items"][1].update(stock_unit=0),
+    lambda m: m["items"][1].update(max_item=2.5),
+    lambda m: m["items"][1].update(image=None),
+    lambda m: m["items"][0].update(groups="1"),
+])
+def test_validate_menu(change):
+  """ Test invalid menu definitions are refused
+  """
+  menu = {
+      "stocks": [{"id": 1, "name": "Tea"}],
+      "groups": [{"id": 1, "name": "Size", "options": [2]}],
+      "items": [{"id": 1, "name": "Tea", "root": True, "groups": [1]},
+                {"id": 2, "name": "Cup", "stock": 1}],
+  }
+  ValidateMenu(menu)
+  change(menu)
+  with pytest.raises(ValueError):
+    ValidateMenu(menu)
@@ -0,0 +1,101 @@
+"""Module to test the metrics module"""
+
+import threading
+import pytest
+from app.core.metrics import Metric, Counter, Histogram, CHECKOUTS, \
+    STOCK_OUTS
+from app.core.models.order import Order
+from app.core.models.inventory import Stock, Item, IngredientGroup
+from app.core.models import db
+
+
+def test_metric_is_abstract():
+  """ Test metrics must say how to merge and expose their values
+  """
+  with pytest.raises(TypeError):
+    Metric("base", "Base")  # pylint: disable=abstract-class-instantiated
+
+
+def test_counter_threads():
+  """ Test counts from several threads, finished or not, are all exposed
+  """
+  counter = Counter("test_total", "Test counter", ("kind",))
+
+  def Count():
+    for _ in range(1000):
+      counter.Inc(kind="a")
+
+  threads = [threading.Thread(target=Count) for _ in range(4)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  # registering a new thread folds the finished ones
+  counter.Inc(2, kind='b"')
+  assert counter.Get(kind="a") == 4000
+  assert counter.Expose() == [
+      "# HELP test_total Test counter", "# TYPE test_total counter",
+      'test_total{kind="a"} 4000', 'test_total{kind="b\\""} 2'
+  ]
+
+
+def test_histogram():
+  """ Test observations are exposed in cumulative buckets
+  """
+  histogram = Histogram("test_seconds", "Test histogram", buckets=(1, 2))
+  for value in (0.5, 1.5, 1.5, 3):
+    histogram.Observe(value)
+  assert histogram.Collect() == [
+      'test_seconds_bucket{le="1"} 1', 'test_seconds_bucket{le="2"} 3',
+      'test_seconds_bucket{le="+Inf"} 4', 'test_seconds_sum 6.5',
+      'test_seconds_count 4'
+  ]
+
+
+def test_checkout_metrics(app):
+  """ Test failed checkouts and stock-outs are counted
+  """
+  with app.app_context():
+    sbun = Stock(name="metrics bun", amount=2)
+    db.session.add(sbun)
+    imain = Item(name="main", root=True)
+    ibun = Item(name="bun", identical=True, stock_unit=1)
+    gbun = IngredientGroup(name="bun", min_item=1)
+    db.session.add(imain)
+    db.session.add(ibun)
+    db.session.add(gbun)
+    sbun.items.append(ibun)
+    gbun.options.append(ibun)
+    imain.ingredientgroups.append(gbun)
+    db.session.commit()
+
+    failures = CHECKOUTS.Get(result="failure", reason="RuntimeError")
+    stock_outs = STOCK_OUTS.Get(stock="metrics bun")
+    order = Order()
+    order.AddRootItem(imain.GetID(), 1)
+    with pytest.raises(RuntimeError):
+      order.Pay()
+    assert CHECKOUTS.Get(result="failure", reason="RuntimeError") == \
+        failures + 1
+    with pytest.raises(RuntimeError):
+      order.AddIG("0.0", [ibun.GetID()], [3])
+    assert STOCK_OUTS.Get(stock="metrics bun") == stock_outs + 1
+
+
+def test_metrics_endpoint(client, app):
+  """ Test metrics are readable with the token only
+  """
+  app.config['METRICS_TOKEN'] = "secret"
+  response = client.get('/admin/metrics')
+  assert response.status_code == 302
+  response = client.get(
+      '/admin/metrics', headers={"Authorization": "Bearer wrong"})
+  assert response.status_code == 302
+  response = client.get(
+      '/admin/metrics', headers={"Authorization": "Bearer secret"})
+  assert response.status_code == 200
+  assert response.content_type.startswith("text/plain")
+  text = response.data.decode()
+  assert "# TYPE sales_checkouts_total counter" in text
+  assert 'sales_request_duration_seconds_count{endpoint="admin.Metrics"}' \
+      in text
@@ -0,0 +1,67 @@
+"""Module to test the migrations module and the indexes it ships"""
+from sqlalchemy import inspect
+from app.core import migrations
+from app.core.models.inventory import Item
+from app.core.models.order import Order, OrderStatus, OrderLine
+from app.core.models import db
+
+
+def QueryPlan(query):
+  """Return the SQLite query plan of an ORM query as a single string"""
+  statement = query.statement.compile(
+      dialect=db.engine.dialect, compile_kwargs={"literal_binds": True})
+  rows = db.session.execute('EXPLAIN QUERY PLAN %s' % statement)
+  return " | ".join(row[-1] for row in rows)
+
+
+def test_fresh_database_version(app):
+  """ Test a new database is created at the latest version
+  """
+  with app.app_context():
+    with db.engine.connect() as connection:
+      assert migrations.GetVersion(connection) == migrations.LATEST
+    assert migrations.Upgrade(db.engine) == []
+    model_indexes = {
+        index.name
+        for table in db.metadata.tables.values()
+        for index in table.indexes
+    }
+    created = {
+        index['name']
+        for table in ('order', 'item')
+        for index in inspect(db.engine).get_indexes(table)
+    }
+    assert created <= model_indexes
+
+
+def test_query_plans(app):
+  """ Test hot lookups use an index instead of scanning their table
+  """
+  with app.app_context():
+    plans = {
+        "orders of a user":
+            QueryPlan(Order.query.filter(Order.user_id == 1)),
+        "order list page":
+            QueryPlan(
+                Order.query.filter(
+                    Order.status == OrderStatus.PAID,
+                    Order.updated_at <= db.func.current_timestamp()).order_by(
+                        Order.updated_at.desc(), Order.id.desc()).limit(50)),
+        "root items":
+            QueryPlan(Item.query.filter(Item.root == True)),  # pylint: disable=singleton-comparison
+        "items of a stock":
+            QueryPlan(Item.query.filter(Item.stock_id == 1)),
+        "orders with an item":
+            QueryPlan(
+                db.session.query(OrderLine.order_id).filter(
+                    OrderLine.item_id == 9).distinct()),
+        "lines of an order":
+            QueryPlan(OrderLine.query.filter(OrderLine.order_id == 1)),
+    }
+    assert "ix_order_user_id" in plans["orders of a user"]
+    assert "ix_order_status_updated_at" in plans["order list page"]
+    assert "TEMP B-TREE" not in plans["order list page"]
+    assert "ix_item_root" in plans["root items"]
+    assert "ix_item_stock_id" in plans["items of a stock"]
+    assert "ix_order_line_item_id_order_id" in plans["orders with an item"]
+    assert "ix_order_line_order_id" in plans["lines of an order"]
@@ -1,7 +1,13 @@
 """Module to test the order model module"""
+import json
 import pytest
+from sqlalchemy import event
+from sqlalchemy.orm.attributes import set_committed_value
 from app.core.models.inventory import Stock, Item, IngredientGroup
-from app.core.models.order import Order, OrderStatus
+from app.core.models.reservation import StockReservation
+from app.core.models import order as order_module
+from app.core.models.order import Order, OrderStatus, OrderLine, ItemNode, \
+    IGNode, CONTENT_VERSION
 from app.core.models import db
 
 
@@ -1009,3 +1015,527 @@ def test_pay_order(app):
 
     assert order.GetStatus() == OrderStatus.PAID
     assert order.GetPrice() == 64
+
+
+def test_order_content_encoding(app):
+  """ Test order content is stored as a versioned node table and that legacy
+      JSON content is still readable
+  """
+  with app.app_context():
+    sburger = Stock(name="burger", amount=10)
+    db.session.add(sburger)
+    imain = Item(name="main", price=1)
+    iburger = Item(name="burger", price=5)
+    gtype = IngredientGroup(
+        name="type", min_item=1, max_item=1, min_option=1, max_option=1)
+    db.session.add(imain)
+    db.session.add(iburger)
+    db.session.add(gtype)
+    sburger.items.append(iburger)
+    gtype.options.append(iburger)
+    imain.ingredientgroups.append(gtype)
+    db.session.commit()
+
+    order = Order()
+    order.AddRootItem(imain.GetID(), 2)
+    order.AddIG("1.0", [iburger.GetID()], [1])
+    assert json.loads(order.GetContent())[0] == CONTENT_VERSION
+    details = order.GetDetailsString()
+    assert order.GetUnfulfilledIGDetails()["path"] == "0.0"
+
+    legacy = Order(price=order.GetPrice())
+    legacy.content = json.dumps([node.ToDict() for node in order.GetTree()])
+    assert isinstance(json.loads(legacy.GetContent())[0], dict)
+    assert legacy.GetDetailsString() == details
+    legacy.AddIG("0.0", [iburger.GetID()], [1])
+    assert json.loads(legacy.GetContent())[0] == CONTENT_VERSION
+    assert legacy.GetUnfulfilledIGDetails() is None
+
+
+def test_pending_ig_queue(app):
+  """ Test the next group to fill in comes from the persisted queue and
+      matches a walk of the whole tree
+  """
+  with app.app_context():
+    imain = Item(name="main", root=True)
+    iburger = Item(name="burger", identical=False)
+    ipatty = Item(name="patty", identical=True)
+    gtype = IngredientGroup(name="type", min_item=1)
+    gpatty = IngredientGroup(name="patty", min_item=1)
+    for obj in (imain, iburger, ipatty, gtype, gpatty):
+      db.session.add(obj)
+    gtype.options.append(iburger)
+    gpatty.options.append(ipatty)
+    imain.ingredientgroups.append(gtype)
+    iburger.ingredientgroups.append(gpatty)
+    db.session.commit()
+
+    order = Order()
+    order.AddRootItem(imain.GetID(), 2)
+    paths = []
+    while order.GetUnfulfilledIGDetails() is not None:
+      details = order.GetUnfulfilledIGDetails()
+      assert details == order.FindUnfulfilledIGDetails()
+      paths.append(details["path"])
+      if details["id"] == gtype.GetID():
+        order.AddIG(details["path"], [iburger.GetID()], [2])
+      else:
+        order.AddIG(details["path"], [ipatty.GetID()], [1])
+    assert paths == [
+        "0.0", "0.0.0.0", "0.0.1.0", "1.0", "1.0.0.0", "1.0.1.0"
+    ]
+    assert order.FindUnfulfilledIGDetails() is None
+
+    # the queue is decoded with the content, without walking the tree
+    partial = Order()
+    partial.AddRootItem(imain.GetID(), 1)
+    partial.AddIG("0.0", [iburger.GetID()], [2])
+    partial.AddRootItem(imain.GetID(), 1)
+    reloaded = Order(price=0, content=partial.GetContent())
+    assert reloaded.GetTree().pending == ["0.0.0.0", "0.0.1.0", "1.0"]
+    assert reloaded.GetUnfulfilledIGDetails() == {
+        "path": "0.0.0.0",
+        "item_name": "burger",
+        "id": gpatty.GetID()
+    }
+    reloaded.AddIG("0.0.0.0", [ipatty.GetID()], [1])
+    assert reloaded.GetUnfulfilledIGDetails()["path"] == "0.0.1.0"
+
+    # groups are only reached through their canonical path
+    stuck = Order()
+    stuck.AddRootItem(imain.GetID(), 1)
+    for path in ("-1.0", "00.0", "0.+0", "0.0.0", "1.0", "0", ""):
+      with pytest.raises(ValueError):
+        stuck.AddIG(path, [iburger.GetID()], [1])
+    assert stuck.GetTree()[0].GetChild(0).GetChildren() == []
+    stuck.AddIG("0.0", [iburger.GetID()], [1])
+    assert stuck.GetUnfulfilledIGDetails()["path"] == "0.0.0.0"
+
+    # a queue entry whose group was filled in anyway is skipped
+    tree = stuck.GetTree()
+    tree.pending.insert(0, "0.0")
+    assert stuck.GetUnfulfilledIGDetails()["path"] == "0.0.0.0"
+    with pytest.raises(ValueError):
+      tree.ReplacePending("0.1", tree[0])
+
+
+def test_order_tree_cache(app, monkeypatch):
+  """ Test order content is decoded once and encoded once on commit
+  """
+  with app.app_context():
+    imain = Item(name="main", price=1)
+    iburger = Item(name="burger", price=5)
+    gtype = IngredientGroup(
+        name="type", min_item=1, max_item=1, min_option=1, max_option=1)
+    db.session.add(imain)
+    db.session.add(iburger)
+    db.session.add(gtype)
+    gtype.options.append(iburger)
+    imain.ingredientgroups.append(gtype)
+    order = Order()
+    db.session.add(order)
+    db.session.commit()
+
+    calls = {"decode": 0, "encode": 0}
+    decode = order_module.DecodeContent
+    encode = order_module.EncodeContent
+
+    def CountingDecode(content):
+      calls["decode"] += 1
+      return decode(content)
+
+    def CountingEncode(roots):
+      calls["encode"] += 1
+      return encode(roots)
+
+    monkeypatch.setattr(order_module, "DecodeContent", CountingDecode)
+    monkeypatch.setattr(order_module, "EncodeContent", CountingEncode)
+
+    order.AddRootItem(imain.GetID(), 1)
+    order.GetUnfulfilledIGDetails()
+    order.AddIG("0.0", [iburger.GetID()], [1])
+    with pytest.raises(RuntimeError):
+      order.AddIG("0.0", [iburger.GetID()], [1])
+    order.GetDetailsString()
+    order.DeductStock()
+    db.session.flush()
+    assert calls["encode"] == 0
+    db.session.commit()
+    assert calls["decode"] == 1
+    encoded = calls["encode"]
+    assert encoded == 1
+
+    # reading a flushed order neither decodes nor encodes again
+    assert order.GetUnfulfilledIGDetails() is None
+    order.GetDetailsString()
+    db.session.commit()
+    assert calls == {"decode": 1, "encode": encoded}
+    oid = order.GetID()
+    db.session.expunge(order)
+    order = Order.query.get(oid)
+    assert order.GetUnfulfilledIGDetails() is None
+    assert calls == {"decode": 2, "encode": encoded}
+
+    # holding stock flushes mid-request but the tree is encoded on commit
+    order = Order(status=OrderStatus.CREATED, price=0)
+    db.session.add(order)
+    db.session.commit()
+    calls["encode"] = 0
+    order.AddRootItem(15, 1)
+    order.AddIG("0.0", [17], [1])
+    order.AddIG("0.1", [24], [2])
+    assert StockReservation.query.filter_by(order_id=order.GetID()).count()
+    assert calls["encode"] == 0
+    db.session.commit()
+    assert calls["encode"] == 1
+    assert Order.query.get(order.GetID()).GetTree()[0].children[1].fulfilled
+
+    # rolling back drops tree changes that were never encoded
+    order.AddRootItem(26, 1)
+    db.session.rollback()
+    assert len(order.GetTree()) == 1
+
+    # assigning content directly discards the cached tree
+    order.AddRootItem(imain.GetID(), 1)
+    order.content = "[]"
+    assert order.GetTree() == []
+    db.session.commit()
+    assert Order.query.get(order.GetID()).GetContent() == "[]"
+
+
+def test_order_query_count(app):
+  """ Test building and deducting an order tree doesn't query once per item
+  """
+  with app.app_context():
+    imain = Item(name="main")
+    gtype = IngredientGroup(name="type", max_item=10)
+    imain.ingredientgroups.append(gtype)
+    db.session.add(imain)
+    for i in range(5):
+      stock = Stock(name="stock %d" % i, amount=100)
+      item = Item(name="item %d" % i, price=1)
+      item.ingredientgroups.append(IngredientGroup(name="sub %d" % i))
+      stock.items.append(item)
+      gtype.options.append(item)
+      db.session.add(stock)
+    db.session.commit()
+    option_ids = [item.GetID() for item in gtype.options]
+
+    statements = []
+
+    def Count(conn, cursor, statement, *args):  # pylint: disable=unused-argument
+      statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", Count)
+    try:
+      order = Order()
+      for _ in range(4):
+        order.AddRootItem(imain.GetID(), 1)
+      for idx in range(4):
+        del statements[:]
+        order.AddIG("%d.0" % idx, option_ids, [2] * len(option_ids))
+        assert len(statements) <= 3
+      del statements[:]
+      order.DeductStock()
+      assert len(statements) <= 3
+    finally:
+      event.remove(db.engine, "before_cursor_execute", Count)
+
+
+def test_pay_concurrent_stock(app):
+  """ Test checkout takes stock atomically even if loaded amounts are stale
+  """
+  with app.app_context():
+    sbun = Stock(name="bun", amount=5)
+    spatty = Stock(name="patty", amount=3)
+    db.session.add(sbun)
+    db.session.add(spatty)
+    iburger = Item(name="burger", root=True, price=5)
+    ibun = Item(name="bun", identical=True, stock_unit=2)
+    ipatty = Item(name="patty", identical=True)
+    gbun = IngredientGroup(name="bun", min_item=1)
+    gpatty = IngredientGroup(name="patty", min_item=1)
+    db.session.add(iburger)
+    db.session.add(ibun)
+    db.session.add(ipatty)
+    sbun.items.append(ibun)
+    spatty.items.append(ipatty)
+    gbun.options.append(ibun)
+    gpatty.options.append(ipatty)
+    iburger.ingredientgroups.append(gbun)
+    iburger.ingredientgroups.append(gpatty)
+    db.session.commit()
+
+    first = Order()
+    second = Order()
+    for order in (first, second):
+      order.AddRootItem(iburger.GetID(), 1)
+      order.AddIG("0.0", [ibun.GetID()], [1])
+      order.AddIG("0.1", [ipatty.GetID()], [2])
+      db.session.add(order)
+    db.session.commit()
+    assert first.ComputeStockRequirements() == {
+        sbun.GetID(): 2,
+        spatty.GetID(): 2
+    }
+
+    # both orders were validated against the same stock levels
+    assert spatty.GetAmount() == 3
+    first.Pay()
+    db.session.commit()
+    assert sbun.GetAmount() == 3
+    assert spatty.GetAmount() == 1
+
+    with pytest.raises(RuntimeError, match="patty"):
+      second.Pay()
+    db.session.rollback()
+    assert second.GetStatus() == OrderStatus.CREATED
+    assert sbun.GetAmount() == 3
+    assert spatty.GetAmount() == 1
+
+
+def test_pay_once(app):
+  """ Test an order is only paid once, even from a stale copy of it
+  """
+  with app.app_context():
+    order = Order(status=OrderStatus.CREATED, price=0)
+    db.session.add(order)
+    db.session.commit()
+    order.AddRootItem(26, 1)
+    order.AddIG("0.0", [27], [1])
+    db.session.commit()
+    oid = order.GetID()
+    stock = Stock.query.get(16)
+    order.Pay()
+    db.session.commit()
+    assert stock.GetAmount() == 850
+
+    # a concurrent checkout that loaded the order before it was paid
+    stale = Order.query.get(oid)
+    set_committed_value(stale, 'status', OrderStatus.CREATED)
+    with pytest.raises(RuntimeError, match="already paid"):
+      stale.Pay()
+    db.session.rollback()
+    assert stock.GetAmount() == 850
+    assert OrderLine.query.filter(OrderLine.order_id == oid).count() == 2
+    assert Order.query.get(oid).GetStatus() == OrderStatus.PAID
+
+
+def test_shared_stock_requirements(app):
+  """ Test items sharing a stock are checked and deducted together
+  """
+  with app.app_context():
+    ssauce = Stock(name="tomato sauce", amount=3)
+    db.session.add(ssauce)
+    iburger = Item(name="burger", root=True)
+    inuggets = Item(name="nuggets", root=True)
+    isauce = Item(name="burger sauce", identical=True)
+    idip = Item(name="dipping sauce", identical=True, stock_unit=2)
+    gsauce = IngredientGroup(name="sauce", max_item=3)
+    db.session.add(iburger)
+    db.session.add(inuggets)
+    db.session.add(isauce)
+    db.session.add(idip)
+    ssauce.items.append(isauce)
+    ssauce.items.append(idip)
+    gsauce.options.append(isauce)
+    gsauce.options.append(idip)
+    iburger.ingredientgroups.append(gsauce)
+    inuggets.ingredientgroups.append(gsauce)
+    db.session.commit()
+
+    order = Order()
+    order.AddRootItem(iburger.GetID(), 1)
+    # 1 + 2 units, each fits on its own but not together
+    with pytest.raises(RuntimeError):
+      order.AddIG("0.0", [isauce.GetID(), idip.GetID()], [2, 1])
+    order.AddIG("0.0", [isauce.GetID(), idip.GetID()], [1, 1])
+    order.AddRootItem(inuggets.GetID(), 1)
+    order.AddIG("1.0", [], [])
+    assert order.ComputeStockRequirements() == {ssauce.GetID(): 3}
+
+    order.DeductStock()
+    assert ssauce.GetAmount() == 0
+    db.session.rollback()
+    order.Pay()
+    db.session.commit()
+    assert ssauce.GetAmount() == 0
+
+
+def test_order_price_cents(app):
+  """ Test prices are added up exactly in integer cents
+  """
+  with app.app_context():
+    imain = Item(name="main", root=True, price=0.1)
+    iside = Item(name="side", root=True, price=0.2)
+    db.session.add(imain)
+    db.session.add(iside)
+    db.session.commit()
+    assert imain.GetPriceCents() == 10
+
+    order = Order()
+    for _ in range(10):
+      order.AddRootItem(imain.GetID(), 1)
+      order.AddRootItem(iside.GetID(), 1)
+    assert order.GetPriceCents() == 300
+    assert order.GetPrice() == 3
+    assert order.GetDetailsString().endswith("Total price: $3.00")
+
+    order.SetStatus(OrderStatus.PAID)
+    db.session.add(order)
+    db.session.add(Order(price=0.7, status=OrderStatus.PAID))
+    db.session.add(Order(price=100, status=OrderStatus.CREATED))
+    db.session.commit()
+    assert Order.SumPriceCents(Order.status == OrderStatus.PAID) == 370
+
+
+def test_add_configured_item(app):
+  """ Test several identically configured items are validated, priced and
+      stocked once
+  """
+  with app.app_context():
+    spatty = Stock(name="patty", amount=10)
+    db.session.add(spatty)
+    imain = Item(name="main", root=True, price=1)
+    iburger = Item(name="burger", identical=False, price=5)
+    ipatty = Item(name="patty", identical=True, price=2, stock_unit=1)
+    gtype = IngredientGroup(name="type", min_item=1, max_item=1)
+    gpatty = IngredientGroup(name="patty", min_item=1, max_item=3)
+    for obj in (imain, iburger, ipatty, gtype, gpatty):
+      db.session.add(obj)
+    spatty.items.append(ipatty)
+    gtype.options.append(iburger)
+    gpatty.options.append(ipatty)
+    imain.ingredientgroups.append(gtype)
+    iburger.ingredientgroups.append(gpatty)
+    db.session.commit()
+
+    config = {
+        "0": ([iburger.GetID()], [1]),
+        "0.0.0": ([ipatty.GetID()], [3]),
+    }
+    order = Order(price=0)
+    assert order.AddConfiguredItem(imain.GetID(), config, 3) == 3 * 1200
+    assert order.GetPriceCents() == 3600
+    assert len(order.GetTree()) == 3
+    assert order.GetUnfulfilledIGDetails() is None
+    assert order.FindUnfulfilledIGDetails() is None
+    assert order.ComputeStockRequirements() == {spatty.GetID(): 9}
+    order.GetTree()[0].GetChild(0).GetChild(0).num = 7
+    assert order.GetTree()[1].GetChild(0).GetChild(0).num == 1
+
+    with pytest.raises(RuntimeError):
+      order.AddConfiguredItem(imain.GetID(), config, 4)
+    with pytest.raises(ValueError):
+      order.AddConfiguredItem(imain.GetID(), {"0": config["0"]}, 1)
+    with pytest.raises(ValueError):
+      order.AddConfiguredItem(imain.GetID(),
+                              dict(config, **{"1": config["0"]}), 1)
+    with pytest.raises(ValueError):
+      order.AddConfiguredItem(imain.GetID(),
+                              dict(config, **{"0.0.0": ([ipatty.GetID()],
+                                                        [4])}), 1)
+    assert order.GetPriceCents() == 3600
+    assert len(order.GetTree()) == 3
+
+
+def test_order_node_dicts():
+  """ Test nodes are compact and convert to and from plain dicts
+  """
+  root = ItemNode(1, "main", 2, 300)
+  group = IGNode(2, "type")
+  group.AddChild(ItemNode(3, "burger", 1, 999))
+  group.fulfilled = True
+  root.AddChild(group)
+  root.AddChild(IGNode(4, "side"))
+  assert not hasattr(root, '__dict__')
+  with pytest.raises(AttributeError):
+    # the point of the test: nodes have no room for other attributes
+    root.extra = 1  # pylint: disable=assigning-non-slot
+
+  plain = root.ToDict()
+  assert plain["children"][0] == {
+      "name": "type",
+      "id": 2,
+      "type": "ig",
+      "fulfilled": True,
+      "children": [{
+          "name": "burger",
+          "id": 3,
+          "type": "item",
+          "num": 1,
+          "price_cents": 999,
+          "children": []
+      }]
+  }
+  copy = ItemNode.FromDict(json.loads(json.dumps(plain)))
+  assert copy.ToDict() == plain
+  assert copy.GetDetailsString() == root.GetDetailsString()
+  assert copy.GetUnfulfilledIGDetails("0", copy.name)["path"] == "0.1"
+
+
+def test_order_lines(app):
+  """ Test paying an order writes its item lines for SQL queries
+  """
+  with app.app_context():
+    oids = []
+    for patty in (9, 10):
+      order = Order(status=OrderStatus.CREATED, price=0)
+      db.session.add(order)
+      db.session.commit()
+      order.AddRootItem(1, 1)
+      order.AddIG("0.0", [3], [1])
+      order.AddIG("0.0.0.0", [5], [2])
+      order.AddIG("0.0.0.1", [patty], [1])
+      order.AddIG("0.0.0.2", [], [])
+      order.Pay()
+      db.session.commit()
+      oids.append(order.GetID())
+
+    lines = OrderLine.query.filter(OrderLine.order_id == oids[0]).order_by(
+        OrderLine.id).all()
+    assert [(line.path, line.item_id, line.ig_id) for line in lines] == [
+        ("0", 1, None), ("0.0.0", 3, 1), ("0.0.0.0.0", 5, 2),
+        ("0.0.0.1.0", 9, 3)
+    ]
+    bun = lines[2]
+    assert (bun.quantity, bun.unit_price_cents, bun.price_cents) == \
+        (2, 99, 198)
+    assert (bun.stock_id, bun.stock_amount) == (3, 2)
+    assert lines[0].stock_id is None
+    assert OrderLine.SumQuantity(5) == 4
+    assert OrderLine.SumQuantity(5, OrderLine.order_id == oids[1]) == 2
+    assert OrderLine.FindOrderIDs(9) == [oids[0]]
+    assert OrderLine.FindOrderIDs(3) == oids
+
+    before = [(line.order_id, line.path, line.quantity)
+              for line in OrderLine.query.order_by(OrderLine.id)]
+    db.session.execute(OrderLine.__table__.delete())
+    db.session.commit()
+    assert app.system.BackfillOrderLines(batch_size=1) == 2
+    assert [(line.order_id, line.path, line.quantity)
+            for line in OrderLine.query.order_by(OrderLine.id)] == before
+
+
+def test_paid_order_is_frozen(app):
+  """ Test items can't be added to a saved order once it is paid
+  """
+  with app.app_context():
+    order = Order(status=OrderStatus.CREATED, price=0)
+    db.session.add(order)
+    db.session.commit()
+    order.AddRootItem(26, 1)
+    order.AddIG("0.0", [27], [1])
+    order.Pay()
+    db.session.commit()
+    with pytest.raises(RuntimeError, match="already paid"):
+      order.AddRootItem(26, 1)
+    with pytest.raises(RuntimeError, match="already paid"):
+      order.AddConfiguredItem(26, {"0": ([27], [1])}, 1)
+    order.SetStatus(OrderStatus.READY)
+    db.session.commit()
+    with pytest.raises(RuntimeError, match="already paid"):
+      order.AddIG("0.0", [27], [1])
+    db.session.rollback()
+    assert Stock.query.get(16).GetReserved() == 0
+    assert len(order.GetTree()) == 1
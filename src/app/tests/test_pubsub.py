@@ -0,0 +1,20 @@
+"""Module to test the pubsub module"""
+
+from app.core.pubsub import LocalHub
+
+
+def test_local_hub(app):
+  """ Test messages reach current subscribers of their channel only
+  """
+  app.config['PUBSUB_QUEUE_SIZE'] = 2
+  hub = LocalHub(app)
+  assert hub.Publish("orders", 0) == 0
+  with hub.Subscribe("orders") as orders, hub.Subscribe("other") as other:
+    assert hub.Publish("orders", 1) == 1
+    hub.Publish("orders", 2)
+    hub.Publish("orders", 3)
+    assert orders.Get(0) == 1
+    assert orders.Get(0) == 2
+    assert orders.Get(0) is None
+    assert other.Get(0) is None
+  assert hub.Publish("orders", 4) == 0
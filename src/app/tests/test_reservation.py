@@ -0,0 +1,127 @@
+"""Module to test the stock reservation module"""
+from datetime import datetime, timedelta
+import pytest
+from app.core.models.inventory import Stock, Item, IngredientGroup
+from app.core.models.order import Order, OrderStatus
+from app.core.models.reservation import StockReservation
+from app.core.models import db
+
+
+def CreateMenu():
+  """Create a coke with a size group and return (coke, large, stock)"""
+  scoke = Stock(name="coke", amount=1000)
+  db.session.add(scoke)
+  icoke = Item(name="coke", root=True, price=2)
+  ilarge = Item(name="large", identical=True, stock_unit=300)
+  gsize = IngredientGroup(
+      name="size", min_item=1, max_item=1, min_option=1, max_option=1)
+  db.session.add(icoke)
+  db.session.add(ilarge)
+  scoke.items.append(ilarge)
+  gsize.options.append(ilarge)
+  icoke.ingredientgroups.append(gsize)
+  db.session.commit()
+  return icoke, ilarge, scoke
+
+
+def test_reservation_hold(app):
+  """ Test adding items to a saved order holds stock until it is paid
+  """
+  with app.app_context():
+    icoke, ilarge, scoke = CreateMenu()
+    order = Order()
+    db.session.add(order)
+    db.session.commit()
+
+    order.AddRootItem(icoke.GetID(), 3)
+    for idx in range(3):
+      order.AddIG("%d.0" % idx, [ilarge.GetID()], [1])
+    db.session.commit()
+    assert scoke.GetAmount() == 1000
+    assert scoke.GetReserved() == 900
+    assert scoke.GetAvailable() == 100
+
+    # a fourth large coke doesn't fit in what is left
+    other = Order()
+    db.session.add(other)
+    db.session.commit()
+    other.AddRootItem(icoke.GetID(), 1)
+    with pytest.raises(RuntimeError):
+      other.AddIG("0.0", [ilarge.GetID()], [1])
+    assert other.GetUnfulfilledIGDetails()["path"] == "0.0"
+    db.session.commit()
+    assert scoke.GetReserved() == 900
+
+    order.Pay()
+    db.session.commit()
+    assert order.GetStatus() == OrderStatus.PAID
+    assert scoke.GetAmount() == 100
+    assert scoke.GetReserved() == 0
+    assert StockReservation.query.count() == 0
+
+
+def test_reservation_expiry(app):
+  """ Test abandoned orders give their stock back
+  """
+  with app.app_context():
+    icoke, ilarge, scoke = CreateMenu()
+    order = Order()
+    db.session.add(order)
+    db.session.commit()
+    order.AddRootItem(icoke.GetID(), 1)
+    order.AddIG("0.0", [ilarge.GetID()], [1])
+    db.session.commit()
+    assert scoke.GetReserved() == 300
+
+    assert Order.ExpireReservations(datetime.now() - timedelta(hours=1)) == 0
+    assert scoke.GetReserved() == 300
+
+    assert Order.ExpireReservations(datetime.now() + timedelta(hours=1)) == 1
+    db.session.commit()
+    assert scoke.GetReserved() == 0
+    assert scoke.GetAmount() == 1000
+
+    # an expired order can still be paid if there is stock left
+    order.Pay()
+    db.session.commit()
+    assert scoke.GetAmount() == 700
+
+  assert app.system.SweepReservations() == 0
+
+
+def test_release_once(app, monkeypatch):
+  """ Test holds released twice at once are given back once
+  """
+  with app.app_context():
+    _, _, scoke = CreateMenu()
+    orders = [Order(), Order()]
+    for order in orders:
+      db.session.add(order)
+    db.session.commit()
+    for order in orders:
+      StockReservation.Hold(order.GetID(), {scoke.GetID(): 150})
+    StockReservation.Hold(orders[0].GetID(), {scoke.GetID(): 150})
+    db.session.commit()
+    assert scoke.GetReserved() == 450
+    assert [r.amount for r in StockReservation.query.order_by(
+        StockReservation.order_id)] == [300, 150]
+
+    # another release deletes the holds between this one's read and delete
+    original = db.session.execute
+    table = StockReservation.__table__
+
+    def ReleasedMeanwhile(statement, *args, **kwargs):
+      if str(statement).startswith("DELETE FROM stock_reservation"):
+        original(table.delete().where(
+            table.c.order_id == orders[0].GetID()))
+      return original(statement, *args, **kwargs)
+
+    monkeypatch.setattr(db.session, "execute", ReleasedMeanwhile)
+    assert StockReservation.Release(orders[0].GetID()) == {}
+    monkeypatch.undo()
+    db.session.commit()
+    assert scoke.GetReserved() == 450
+    assert StockReservation.Release(orders[1].GetID()) == {scoke.GetID(): 150}
+    assert StockReservation.Release(orders[1].GetID()) == {}
+    db.session.commit()
+    assert scoke.GetReserved() == 300
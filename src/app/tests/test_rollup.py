@@ -0,0 +1,135 @@
+"""Module to test the sales rollup module"""
+from datetime import datetime, timedelta
+from app.core.models.order import Order, OrderStatus
+from app.core.models.rollup import SalesFact, OrderFact, SalesRollup, \
+    ItemRollup, Bucket, GetSales, GetTopItems, FoldSales
+from app.core.models.user import User, UserType
+from app.core.models import db
+from .test_admin import login
+
+
+def PayNuggets(sauces):
+  """Pay for nuggets with a 6-pack and a number of BBQ sauces"""
+  order = Order(status=OrderStatus.CREATED, price=0)
+  db.session.add(order)
+  db.session.commit()
+  order.AddRootItem(15, 1)
+  order.AddIG("0.0", [17], [1])
+  order.AddIG("0.1", [24], [sauces])
+  order.Pay()
+  db.session.commit()
+  return order
+
+
+def Rollups():
+  return sorted((row.period, row.bucket, row.orders, row.revenue_cents)
+                for row in SalesRollup.query.all()), sorted(
+                    (row.period, row.bucket, row.item_id, row.quantity,
+                     row.revenue_cents) for row in ItemRollup.query.all())
+
+
+def test_record_sale(app):
+  """ Test paying orders adds facts folded into the hour and day rollups
+  """
+  with app.app_context():
+    PayNuggets(1)
+    order = PayNuggets(3)
+    facts = SalesFact.query.filter(SalesFact.order_id == order.GetID()).all()
+    assert sorted((f.item_id, f.quantity, f.price_cents) for f in facts) == [
+        (15, 1, 199), (17, 1, 100), (24, 3, 300)
+    ]
+    assert facts[0].hour == Bucket("hour", datetime.now())
+    assert Rollups() == ([], [])
+
+    today = Bucket("day", datetime.now())
+    tomorrow = today + timedelta(days=1)
+    assert FoldSales(limit=1) == 1
+    assert [row.orders for row in GetSales("day", today, tomorrow)] == [1]
+    assert app.system.FoldRollups() == 1
+    assert app.system.FoldRollups() == 0
+    assert OrderFact.query.filter(OrderFact.folded == db.false()).count() == 0
+    for period in ("hour", "day"):
+      rows = GetSales(period, today, tomorrow)
+      assert [(row.orders, row.revenue_cents) for row in rows] == [(2, 998)]
+      assert rows[0].GetAverageCents() == 499
+    assert GetTopItems(today, tomorrow, 2) == [(24, 4, 400), (15, 2, 398)]
+    assert not GetSales("day", tomorrow, tomorrow + timedelta(days=1))
+
+    before = Rollups()
+    assert app.system.RebuildRollups(batch_size=1) == 2
+    assert Rollups() == before
+    assert SalesFact.query.count() == 6
+
+
+def test_dashboard(client, app):
+  """ Test the dashboard shows totals and top items from the rollups
+  """
+  with app.app_context():
+    user = User(
+        name="Dickson", email="dickon@gmail.com", user_type=UserType.ADMIN)
+    user.SetPassword("123456")
+    db.session.add(user)
+    PayNuggets(2)
+    login(client, "dickon@gmail.com", "123456")
+
+  # the dashboard only reads the rollups, and says what they don't count
+  rsp = client.get('/admin/dashboard?days=1').data.decode()
+  assert "<b>Orders:</b> 0" in rsp
+  assert "1 orders paid since" in rsp
+  assert app.system.FoldRollups() == 1
+
+  response = client.get('/admin/dashboard?days=1')
+  rsp = response.data.decode()
+  assert response.status_code == 200
+  assert "not counted yet" not in rsp
+  assert "Sales of the last 1 days" in rsp
+  assert "<b>Revenue:</b> $4.99" in rsp
+  assert "<td>BBQ Sauce</td>" in rsp
+
+
+def test_fold_existing_bucket(app, monkeypatch):
+  """ Test a fold adds to a rollup row created by a concurrent fold
+  """
+  with app.app_context():
+    PayNuggets(1)
+    app.system.FoldRollups()
+    PayNuggets(1)
+    original = db.session.execute
+    calls = []
+
+    def MissFirstUpdate(statement, *args, **kwargs):
+      # The first update runs before the concurrent fold commits its row
+      if not calls and str(statement).startswith(
+          "UPDATE sales_rollup"):
+        calls.append(statement)
+        statement = statement.where(SalesRollup.orders < 0)
+      return original(statement, *args, **kwargs)
+
+    monkeypatch.setattr(db.session, "execute", MissFirstUpdate)
+    assert FoldSales() == 1
+    monkeypatch.undo()
+    db.session.commit()
+    assert calls
+    today = Bucket("day", datetime.now())
+    rows = GetSales("day", today, today + timedelta(days=1))
+    assert [(row.orders, row.revenue_cents) for row in rows] == [(2, 798)]
+
+
+def test_fold_claimed_order(app, monkeypatch):
+  """ Test a fold skips orders claimed by a concurrent fold after its read
+  """
+  with app.app_context():
+    PayNuggets(1)
+    original = db.session.execute
+
+    def ClaimedMeanwhile(statement, *args, **kwargs):
+      if str(statement).startswith("UPDATE order_fact"):
+        # another fold claims and folds the order between read and claim
+        original(OrderFact.__table__.update().values(folded=True))
+      return original(statement, *args, **kwargs)
+
+    monkeypatch.setattr(db.session, "execute", ClaimedMeanwhile)
+    assert FoldSales() == 0
+    monkeypatch.undo()
+    db.session.commit()
+    assert Rollups() == ([], [])
@@ -0,0 +1,101 @@
+"""Module to test the core SalesSystem module"""
+from sqlalchemy.engine.url import make_url
+from app.core import create_app, migrations
+from app.core.system import EngineOptions
+from app.core.models.inventory import Item, Stock
+from app.core.models.order import Order
+from app.core.models import db
+
+
+def test_migrate():
+  """ Test an old database is brought up to date, keeping its data
+  """
+  app = create_app('app.tests.settings')
+  with app.app_context():
+    db.session.execute('CREATE TABLE item (id INTEGER PRIMARY KEY, '
+                       'root BOOLEAN, stock_id INTEGER, stock_unit INTEGER, '
+                       'max_item INTEGER, price FLOAT, image TEXT, '
+                       'name TEXT, identical BOOLEAN)')
+    db.session.execute('CREATE TABLE "order" (id INTEGER PRIMARY KEY, '
+                       'user_id INTEGER, status VARCHAR(7), price FLOAT, '
+                       'created_at DATETIME, updated_at DATETIME, '
+                       'content TEXT)')
+    db.session.execute('CREATE TABLE stock (id INTEGER PRIMARY KEY, '
+                       'name TEXT, amount INTEGER)')
+    db.session.execute("INSERT INTO item (id, name, price) "
+                       "VALUES (1, 'Burger', 12.99)")
+    db.session.execute("INSERT INTO \"order\" (id, status, price, content) "
+                       "VALUES (1, 'PAID', 109.5, '[]')")
+    db.session.execute("INSERT INTO stock (id, name, amount) "
+                       "VALUES (1, 'Bun', 10)")
+    db.session.commit()
+
+  assert app.system.Migrate() == list(range(1, migrations.LATEST + 1))
+  assert app.system.Migrate() == []
+
+  with app.app_context():
+    assert Item.query.get(1).GetPriceCents() == 1299
+    assert Order.query.get(1).GetPriceCents() == 10950
+    assert Stock.query.get(1).GetAvailable() == 10
+    indexes = {i['name'] for i in db.inspect(db.engine).get_indexes('order')}
+    assert {'ix_order_user_id', 'ix_order_status_updated_at'} <= indexes
+    # tables added since are created
+    assert db.engine.has_table('stock_reservation')
+
+
+def test_engine_options():
+  """ Test pool settings become engine options except for SQLite
+  """
+  config = {
+      'SQLALCHEMY_DATABASE_URI': "mysql+pymysql://sales@db/sales",
+      'DB_POOL_SIZE': 5,
+      'DB_MAX_OVERFLOW': 2,
+      'DB_POOL_RECYCLE': 600,
+      'DB_POOL_PRE_PING': True,
+      'DB_ISOLATION_LEVEL': "READ COMMITTED",
+  }
+  assert EngineOptions(config) == {
+      "pool_size": 5,
+      "max_overflow": 2,
+      "pool_timeout": 30,
+      "pool_recycle": 600,
+      "pool_pre_ping": True,
+      "isolation_level": "READ COMMITTED",
+  }
+  config['SQLALCHEMY_ENGINE_OPTIONS'] = {"pool_size": 1}
+  assert EngineOptions(config)["pool_size"] == 1
+  config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/sales.db"
+  assert EngineOptions(config) == {"pool_size": 1}
+  assert EngineOptions({}) == {}
+
+
+def test_create_app_overrides():
+  """ Test settings given to create_app apply before the engine is set up
+  """
+  app = create_app(
+      'app.tests.settings',
+      SQLALCHEMY_DATABASE_URI="mysql+pymysql://sales@db/sales",
+      RESERVATION_SWEEP_INTERVAL=60)
+  assert app.config['SQLALCHEMY_ENGINE_OPTIONS']["pool_size"] == 10
+  assert app.system.sweeper is None
+
+
+def test_engine_options_applied(app):
+  """ Test engine options override the driver defaults of the extension
+  """
+  app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {"pool_recycle": 600}
+  options = {}
+  db.apply_driver_hacks(app, make_url("mysql+pymysql://sales@db/sales"),
+                        options)
+  assert options["pool_recycle"] == 600
+  assert options["pool_size"] == 10
+
+
+def test_diagnose_pool(app):
+  """ Test pool diagnostics time every checkout
+  """
+  report = app.system.DiagnosePool(checkouts=20, threads=1, hold=0)
+  assert report["checkouts"] == 20
+  assert report["errors"] == 0
+  assert report["pool"] == "StaticPool"
+  assert 0 <= report["checkout_ms"]["min"] <= report["checkout_ms"]["max"]